@@ -0,0 +1,57 @@
+"""Measure the cold start latency of rcollate.
+
+Each sample runs in a fresh interpreter, timing `import rcollate` and then
+create_app(schedule=False), which sets up the database, config and
+subreddit index. Run from the repository root:
+
+    CONFIG_DIR=config/tests_config python benchmarks/import_time.py
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SAMPLE_CODE = """
+import json
+import time
+
+start = time.perf_counter()
+import rcollate
+imported = time.perf_counter()
+rcollate.create_app(schedule=False)
+created = time.perf_counter()
+
+print(json.dumps({
+    'import_seconds': imported - start,
+    'create_app_seconds': created - imported,
+}))
+"""
+
+def sample():
+    output = subprocess.check_output(
+        [sys.executable, '-c', SAMPLE_CODE],
+        env=dict(os.environ, PYTHONDONTWRITEBYTECODE='1'),
+        stderr=subprocess.DEVNULL,
+    )
+    return json.loads(output.decode('utf-8').splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--samples', type=int, default=10)
+    args = parser.parse_args()
+
+    samples = [sample() for _ in range(args.samples)]
+
+    for key in ('import_seconds', 'create_app_seconds'):
+        values = [s[key] for s in samples]
+        print("{:<20} min {:.1f}ms  median {:.1f}ms  max {:.1f}ms".format(
+            key,
+            min(values) * 1000,
+            statistics.median(values) * 1000,
+            max(values) * 1000,
+        ))
+
+if __name__ == '__main__':
+    main()
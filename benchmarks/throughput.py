@@ -0,0 +1,467 @@
+"""Measure end-to-end job throughput against fake Reddit and SMTP servers.
+
+A fake Reddit (OAuth token and top listings) and a sink SMTP server are
+started on localhost, a fresh database is seeded with synthetic jobs, and
+every job is fired at once through scheduler.run_job (or run_jobs with
+--batch). Each sample seeds and runs in fresh interpreters with their own
+config, so caches start cold and peak RSS only covers the run.
+
+Reports jobs per second, p50/p99 latency from firing to the job's email
+being sent, p99 of each pipeline stage and peak RSS. Results are appended
+to benchmarks/results/throughput.jsonl and compared with the last result
+recorded with the same options. Run from the repository root:
+
+    python benchmarks/throughput.py --jobs 1000 --pipeline-workers 8
+"""
+import argparse
+from datetime import datetime, timezone
+import http.server
+import json
+import math
+import os
+import resource
+import shutil
+import socketserver
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+RESULTS_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'results', 'throughput.jsonl'
+)
+
+# Metrics compared between runs, and whether a higher value is better
+COMPARED_RESULTS = (
+    ('jobs_per_second', True),
+    ('p50_seconds', False),
+    ('p99_seconds', False),
+    ('peak_rss_mb', False),
+)
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+class _ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class FakeRedditHandler(http.server.BaseHTTPRequestHandler):
+    """Serves app-only OAuth tokens and /r/<subreddit>/top listings"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        if urlparse(self.path).path != '/api/v1/access_token':
+            return self._reply(404, {'error': 404})
+
+        self._reply(200, {
+            'access_token': 'benchmark',
+            'token_type': 'bearer',
+            'expires_in': 3600,
+            'scope': '*',
+        })
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        if len(parts) != 3 or parts[0] != 'r' or parts[2] != 'top':
+            return self._reply(404, {'error': 404})
+
+        subreddit = parts[1]
+        limit = int(parse_qs(url.query).get('limit', ['25'])[0])
+
+        time.sleep(self.server.latency)
+        with self.server.lock:
+            self.server.request_count += 1
+
+        self._reply(200, {
+            'kind': 'Listing',
+            'data': {
+                'after': None,
+                'before': None,
+                'children': [
+                    {'kind': 't3', 'data': _fake_thread(subreddit, i)}
+                    for i in range(min(limit, 100))
+                ],
+            },
+        })
+
+    def _reply(self, status, body):
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def _fake_thread(subreddit, i):
+    thread_id = '{}{}'.format(subreddit, i)
+    return {
+        'id': thread_id,
+        'name': 't3_{}'.format(thread_id),
+        'permalink': '/r/{}/comments/{}/thread_{}/'.format(subreddit, thread_id, i),
+        'selftext': 'Text of thread {} in /r/{}. '.format(i, subreddit) * 20,
+        'title': 'Thread {} in /r/{}'.format(i, subreddit),
+        'ups': 1000 - i,
+        'url': 'https://example.com/{}/{}'.format(subreddit, i),
+    }
+
+class SinkSMTPHandler(socketserver.StreamRequestHandler):
+    """Accepts and discards every message, speaking just enough SMTP"""
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.reply('220 localhost rcollate benchmark SMTP sink')
+
+        for line in self.rfile:
+            command = line.decode('ascii', 'replace').strip().split(' ', 1)[0].upper()
+
+            if command in ('HELO', 'EHLO'):
+                self.reply('250 localhost')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                for data_line in self.rfile:
+                    if data_line == b'.\r\n':
+                        break
+
+                time.sleep(self.server.latency)
+                with self.server.lock:
+                    self.server.message_count += 1
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
+
+def _start_server(server_class, handler_class, latency):
+    server = server_class(('127.0.0.1', 0), handler_class)
+    server.latency = latency
+    server.lock = threading.Lock()
+    server.request_count = 0
+    server.message_count = 0
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def write_config(config_dir, args, reddit_port, smtp_port):
+    reddit_url = 'http://127.0.0.1:{}'.format(reddit_port)
+    settings = {
+        'user_agent': 'rcollate benchmark',
+        'sender_name': 'rcollate',
+        'sender_email': 'rcollate@localhost',
+        'smtp_host': '127.0.0.1',
+        'smtp_port': smtp_port,
+        'smtp_timeout': 30,
+        'app_url': 'http://localhost:5000',
+        'db_file': os.path.join(config_dir, 'jobs.db'),
+        'reddit_backend': args.reddit_backend,
+        'reddit_url': reddit_url,
+        'reddit_oauth_url': reddit_url,
+        # Measure rcollate rather than the Reddit request quota
+        'reddit_rate_limit': 1000000.0,
+        'reddit_rate_limit_burst': 1000000,
+        'job_run_history': True,
+        'consolidate_digests': args.consolidate_digests,
+    }
+    if args.smtp_pool_size is not None:
+        settings['smtp_pool_size'] = args.smtp_pool_size
+    if args.pipeline_workers is not None:
+        settings['pipeline'] = {
+            'fetch_workers': args.pipeline_workers,
+            'render_workers': args.pipeline_workers,
+            'send_workers': args.pipeline_workers,
+        }
+
+    secrets = {
+        'client_id': 'benchmark',
+        'client_secret': 'benchmark',
+        'admin_username': 'benchmark',
+        'admin_password': 'benchmark',
+        'session_secret_key': 'benchmark',
+    }
+
+    for file_name, contents in [
+        ('settings.json', settings),
+        ('secrets.json', secrets),
+    ]:
+        with open(os.path.join(config_dir, file_name), 'w') as f:
+            json.dump(contents, f)
+
+def seed_jobs(job_count, subreddit_count, thread_limit):
+    """Insert synthetic jobs, all due at the same time"""
+    from rcollate.models import Job
+    import rcollate.db as db
+
+    db.init()
+    db_conn = db.open_conn()
+    try:
+        db.insert_jobs(db_conn, [
+            Job(
+                subreddit='bench{}'.format(i % subreddit_count),
+                target_email='user{}@example.com'.format(i),
+                cron_trigger={'hour': 7},
+                thread_limit=thread_limit,
+            )
+            for i in range(job_count)
+        ])
+    finally:
+        db.close_conn(db_conn)
+
+def _percentile(values, percentile):
+    """Nearest-rank percentile, as in the job run history"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(int(math.ceil(percentile / 100.0 * len(values))) - 1, 0)]
+
+def _peak_rss_mb():
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    if sys.platform == 'darwin':
+        peak_rss /= 1024
+    return peak_rss / 1024.0
+
+def run_jobs(batch):
+    """Fire every job at once and wait for them all to finish"""
+    import rcollate.db as db
+    import rcollate.rcollate as rcollate
+    from rcollate import scheduler
+
+    rcollate.create_app(schedule=False)
+
+    db_conn = db.open_conn()
+    jobs = list(db.iter_jobs(db_conn))
+
+    # Note when each job's run finishes, on its way into the history
+    finished = []
+    record_job_runs = scheduler.record_job_runs
+
+    def record_finished_job_runs(rows):
+        finished_at = time.perf_counter()
+        finished.extend((finished_at, row['outcome']) for row in rows)
+        record_job_runs(rows)
+
+    scheduler.record_job_runs = record_finished_job_runs
+
+    started_at = time.time()
+    start = time.perf_counter()
+
+    if batch:
+        scheduler.run_jobs(jobs)
+    else:
+        for job in jobs:
+            scheduler.run_job(job)
+    scheduler.pipeline.join()
+
+    elapsed = time.perf_counter() - start
+
+    latencies = [finished_at - start for finished_at, _ in finished]
+    stage_percentiles = db.get_job_run_percentiles(
+        db_conn, started_at, percentiles=(99,)
+    )
+    db.close_conn(db_conn)
+
+    return {
+        'jobs': len(jobs),
+        'sent': sum(1 for _, outcome in finished if outcome == 'sent'),
+        'seconds': elapsed,
+        'jobs_per_second': len(jobs) / elapsed,
+        'p50_seconds': _percentile(latencies, 50),
+        'p99_seconds': _percentile(latencies, 99),
+        # Lag is measured from the jobs' schedule, which means nothing here
+        'stage_p99_seconds': {
+            stage: percentiles[99]
+            for stage, percentiles in stage_percentiles.items()
+            if stage != 'lag'
+        },
+        'peak_rss_mb': _peak_rss_mb(),
+    }
+
+def _run_child(command, config_dir, args):
+    output = subprocess.check_output(
+        [
+            sys.executable, os.path.abspath(__file__),
+            '--child', command,
+            '--jobs', str(args.jobs),
+            '--subreddits', str(args.subreddits),
+            '--thread-limit', str(args.thread_limit),
+        ] + (['--batch'] if args.batch else []),
+        # Logs go to rcollate.log in the config dir rather than the repo
+        cwd=config_dir,
+        env=dict(os.environ, CONFIG_DIR=config_dir),
+        stderr=subprocess.DEVNULL,
+    )
+    return json.loads(output.decode('utf-8').splitlines()[-1])
+
+def sample(args):
+    reddit = _start_server(
+        _ThreadingHTTPServer, FakeRedditHandler, args.reddit_latency / 1000.0
+    )
+    smtp = _start_server(
+        _ThreadingTCPServer, SinkSMTPHandler, args.smtp_latency / 1000.0
+    )
+    config_dir = tempfile.mkdtemp(prefix='rcollate-benchmark-')
+
+    try:
+        write_config(
+            config_dir, args, reddit.server_address[1], smtp.server_address[1]
+        )
+        _run_child('seed', config_dir, args)
+        result = _run_child('run', config_dir, args)
+    finally:
+        reddit.shutdown()
+        smtp.shutdown()
+        shutil.rmtree(config_dir)
+
+    result['reddit_requests'] = reddit.request_count
+    result['emails_received'] = smtp.message_count
+    return result
+
+def _options(args):
+    return {
+        name: getattr(args, name)
+        for name in (
+            'jobs', 'subreddits', 'thread_limit', 'batch',
+            'consolidate_digests', 'pipeline_workers', 'smtp_pool_size',
+            'reddit_backend', 'reddit_latency', 'smtp_latency',
+        )
+    }
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def load_results(results_file):
+    if not os.path.exists(results_file):
+        return []
+
+    with open(results_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def save_result(results_file, result):
+    os.makedirs(os.path.dirname(results_file), exist_ok=True)
+    with open(results_file, 'a') as f:
+        f.write(json.dumps(result, sort_keys=True) + '\n')
+
+def summarize(samples, options):
+    return {
+        'time': datetime.now(timezone.utc).isoformat(),
+        'commit': _git_commit(),
+        'python': sys.version.split()[0],
+        'options': options,
+        'jobs_per_second': statistics.median(
+            s['jobs_per_second'] for s in samples
+        ),
+        'p50_seconds': statistics.median(s['p50_seconds'] for s in samples),
+        'p99_seconds': statistics.median(s['p99_seconds'] for s in samples),
+        'peak_rss_mb': max(s['peak_rss_mb'] for s in samples),
+        'samples': samples,
+    }
+
+def print_result(result, previous):
+    for key, higher_is_better in COMPARED_RESULTS:
+        line = "{:<16} {:>10.3f}".format(key, result[key])
+
+        if previous is not None and previous.get(key):
+            change = (result[key] - previous[key]) / previous[key] * 100
+            line += "  {:+.1f}% vs {}".format(change, previous['commit'])
+
+        print(line)
+
+    stages = result['samples'][0]['stage_p99_seconds']
+    print("stage p99        {}".format("  ".join(
+        "{} {:.3f}".format(stage, statistics.median(
+            s['stage_p99_seconds'][stage] or 0 for s in result['samples']
+        ))
+        for stage in stages
+    )))
+
+    print("per sample       {}".format("  ".join(
+        "{} emails, {} reddit requests".format(
+            s['emails_received'], s['reddit_requests']
+        )
+        for s in result['samples']
+    )))
+
+    for s in result['samples']:
+        if s['sent'] != s['jobs']:
+            print("Warning: only {} of {} jobs were sent".format(
+                s['sent'], s['jobs']
+            ))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--samples', type=int, default=3)
+    parser.add_argument('--jobs', type=int, default=500)
+    parser.add_argument('--subreddits', type=int, default=50)
+    parser.add_argument('--thread-limit', type=int, default=10)
+    parser.add_argument(
+        '--batch', action='store_true',
+        help="Fire jobs together with run_jobs, as in dispatcher mode",
+    )
+    parser.add_argument('--consolidate-digests', action='store_true')
+    parser.add_argument(
+        '--pipeline-workers', type=int,
+        help="Workers per pipeline stage (default: run stages inline)",
+    )
+    parser.add_argument('--smtp-pool-size', type=int)
+    parser.add_argument(
+        '--reddit-backend', choices=['praw', 'aiohttp'], default='praw',
+    )
+    parser.add_argument(
+        '--reddit-latency', type=float, default=50,
+        help="Milliseconds the fake Reddit takes to serve a listing",
+    )
+    parser.add_argument(
+        '--smtp-latency', type=float, default=5,
+        help="Milliseconds the SMTP sink takes to accept a message",
+    )
+    parser.add_argument('--results', default=RESULTS_FILE)
+    parser.add_argument(
+        '--no-save', action='store_true', help="Don't record the results",
+    )
+    parser.add_argument(
+        '--child', choices=['seed', 'run'], help=argparse.SUPPRESS,
+    )
+    args = parser.parse_args()
+
+    if args.child == 'seed':
+        seed_jobs(args.jobs, args.subreddits, args.thread_limit)
+        print(json.dumps({}))
+        return
+    if args.child == 'run':
+        print(json.dumps(run_jobs(args.batch)))
+        return
+
+    options = _options(args)
+    samples = [sample(args) for _ in range(args.samples)]
+    result = summarize(samples, options)
+
+    previous = [
+        r for r in load_results(args.results) if r['options'] == options
+    ]
+    print_result(result, previous[-1] if previous else None)
+
+    if not args.no_save:
+        save_result(args.results, result)
+
+if __name__ == '__main__':
+    main()
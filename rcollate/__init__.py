@@ -1 +1 @@
-from .rcollate import app, socketio
+from .rcollate import app, create_app, socketio
@@ -0,0 +1,235 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import (
+    create_engine,
+    event,
+    and_,
+    Column,
+    Float,
+    MetaData,
+    String,
+    Table,
+    Text,
+)
+from sqlalchemy.exc import SQLAlchemyError
+
+from rcollate import db, logs
+from rcollate.config import settings
+
+CACHE_FILE_NAME = 'cache.db'
+
+logger = logs.get_logger()
+
+metadata = MetaData()
+
+cache_entries_table = Table('cache_entries', metadata,
+    Column('namespace', String, primary_key=True),
+    Column('key', String, primary_key=True),
+    Column('value', Text, nullable=False),
+    Column('expires_at', Float, nullable=False),
+)
+
+def cache_db_file():
+    """Path of the persistent cache, kept next to settings['db_file']"""
+    return os.path.join(
+        os.path.dirname(settings['db_file']),
+        CACHE_FILE_NAME,
+    )
+
+class TwoTierCache(object):
+    """TTL cache with an in-process LRU tier backed by a shared SQLite tier.
+
+    Values must be JSON serialisable. The SQLite tier lets restarted and
+    sibling worker processes reuse entries written by other processes.
+    """
+
+    def __init__(self, namespace, ttl, max_entries, db_file=None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.db_file = db_file
+
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._engine = None
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    @property
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'persistent_hits': self.persistent_hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+        }
+
+    def get(self, key, accept=None):
+        """Return the cached value for key, or None on a miss.
+
+        If accept is given, entries for which accept(value) is false are
+        treated as misses.
+        """
+        if not self.enabled:
+            return None
+
+        value, from_memory = self._lookup(key)
+
+        if value is None or (accept is not None and not accept(value)):
+            self.misses += 1
+            return None
+
+        if from_memory:
+            self.hits += 1
+        else:
+            self.persistent_hits += 1
+
+        return value
+
+    def peek(self, key):
+        """Return the cached value for key, or None, without counting it"""
+        if not self.enabled:
+            return None
+
+        return self._lookup(key)[0]
+
+    def _lookup(self, key):
+        """Return (value, whether it came from memory)"""
+        now = time.time()
+        value = self._get_memory(key, now)
+        if value is not None:
+            return value, True
+
+        value, expires_at = self._get_persistent(key, now)
+        if value is not None:
+            self._set_memory(key, value, expires_at)
+
+        return value, False
+
+    def set(self, key, value, ttl=None):
+        if not self.enabled:
+            return
+
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        self._set_memory(key, value, expires_at)
+        self._set_persistent(key, value, expires_at)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+        engine = self._get_engine()
+        if engine is None:
+            return
+
+        try:
+            engine.execute(cache_entries_table.delete().where(
+                cache_entries_table.c.namespace == self.namespace
+            ))
+        except SQLAlchemyError as e:
+            logger.warning("Cache clear failed for %s: %s", self.namespace, e)
+
+    def purge_expired(self):
+        engine = self._get_engine()
+        if engine is None:
+            return
+
+        try:
+            engine.execute(cache_entries_table.delete().where(
+                cache_entries_table.c.expires_at <= time.time()
+            ))
+        except SQLAlchemyError as e:
+            logger.warning("Cache purge failed for %s: %s", self.namespace, e)
+
+    def _get_memory(self, key, now):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires_at, value = entry
+            if expires_at <= now:
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def _set_memory(self, key, value, expires_at):
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _get_persistent(self, key, now):
+        engine = self._get_engine()
+        if engine is None:
+            return None, None
+
+        try:
+            row = engine.execute(
+                cache_entries_table.select().where(and_(
+                    cache_entries_table.c.namespace == self.namespace,
+                    cache_entries_table.c.key == key,
+                    cache_entries_table.c.expires_at > now,
+                ))
+            ).first()
+        except SQLAlchemyError as e:
+            logger.warning("Cache read failed for %s/%s: %s", self.namespace, key, e)
+            return None, None
+
+        if row is None:
+            return None, None
+
+        return json.loads(row['value']), row['expires_at']
+
+    def _set_persistent(self, key, value, expires_at):
+        engine = self._get_engine()
+        if engine is None:
+            return
+
+        try:
+            engine.execute(
+                cache_entries_table.insert().prefix_with('OR REPLACE'),
+                namespace=self.namespace,
+                key=key,
+                value=json.dumps(value),
+                expires_at=expires_at,
+            )
+        except SQLAlchemyError as e:
+            logger.warning("Cache write failed for %s/%s: %s", self.namespace, key, e)
+
+    def _get_engine(self):
+        if self.db_file is None:
+            return None
+
+        if self._engine is None:
+            with self._lock:
+                if self._engine is None:
+                    os.makedirs(os.path.dirname(self.db_file), exist_ok=True)
+                    engine = create_engine('sqlite:///{}'.format(self.db_file))
+                    # Shared between processes like the jobs database
+                    event.listen(engine, 'connect', db.set_sqlite_pragmas)
+                    try:
+                        metadata.create_all(bind=engine)
+                    except SQLAlchemyError as e:
+                        # Carry on with the in-process tier alone
+                        logger.warning("Cache database unusable for %s: %s", self.namespace, e)
+                        self.db_file = None
+                        return None
+                    self._engine = engine
+                    self.purge_expired()
+
+        return self._engine
@@ -1,6 +1,8 @@
+from collections.abc import MutableMapping
 import json
 import os
 import sys
+import threading
 
 from jsonschema import validate
 from jsonschema.exceptions import ValidationError
@@ -15,8 +17,60 @@ SETTINGS_SCHEMA = {
         'sender_email': {'type': 'string'},
         'smtp_host': {'type': 'string'},
         'smtp_timeout': {'type': 'integer'},
+        'smtp_port': {'type': 'integer'},
+        'smtp_tls': {'type': 'boolean'},
+        'smtp_pool_size': {'type': 'integer', 'minimum': 0},
+        'smtp_pool_max_messages': {'type': 'integer', 'minimum': 1},
         'app_url': {'type': 'string'},
         'db_file': {'type': 'string'},
+        'db_url': {'type': 'string'},
+        'db_pool_size': {'type': 'integer', 'minimum': 1},
+        'db_max_overflow': {'type': 'integer', 'minimum': 0},
+        'sqlite': {
+            'type': 'object',
+            'properties': {
+                'journal_mode': {
+                    'enum': ['delete', 'truncate', 'persist', 'memory', 'wal'],
+                },
+                'synchronous': {'enum': ['off', 'normal', 'full', 'extra']},
+                'busy_timeout': {'type': 'integer', 'minimum': 0},
+                'mmap_size': {'type': 'integer', 'minimum': 0},
+            },
+            'additionalProperties': False,
+        },
+        'sql_echo': {'type': 'boolean'},
+        'query_stats': {'type': 'boolean'},
+        'reddit_backend': {'enum': ['praw', 'aiohttp']},
+        'reddit_url': {'type': 'string'},
+        'reddit_oauth_url': {'type': 'string'},
+        'reddit_rate_limit': {'type': 'number', 'minimum': 0.001},
+        'reddit_rate_limit_burst': {'type': 'integer', 'minimum': 1},
+        'thread_cache_ttl': {'type': 'integer', 'minimum': 0},
+        'thread_cache_size': {'type': 'integer', 'minimum': 1},
+        'subreddit_exists_ttl': {'type': 'integer', 'minimum': 0},
+        'subreddit_missing_ttl': {'type': 'integer', 'minimum': 0},
+        'embedded_scheduler': {'type': 'boolean'},
+        'scheduler_mode': {'enum': ['per_job', 'dispatcher']},
+        'job_claims': {'type': 'boolean'},
+        'scheduler_partition_count': {'type': 'integer', 'minimum': 1},
+        'scheduler_partition': {'type': 'integer', 'minimum': 0},
+        'worker_metrics_port': {'type': 'integer', 'minimum': 1, 'maximum': 65535},
+        'batch_execution': {'type': 'boolean'},
+        'consolidate_digests': {'type': 'boolean'},
+        'digest_fetch_workers': {'type': 'integer', 'minimum': 1},
+        'job_run_history': {'type': 'boolean'},
+        'outbox': {'type': 'boolean'},
+        'outbox_workers': {'type': 'integer', 'minimum': 1},
+        'pipeline': {
+            'type': 'object',
+            'properties': {
+                'fetch_workers': {'type': 'integer', 'minimum': 1},
+                'render_workers': {'type': 'integer', 'minimum': 1},
+                'send_workers': {'type': 'integer', 'minimum': 1},
+                'queue_size': {'type': 'integer', 'minimum': 0},
+            },
+            'additionalProperties': False,
+        },
     },
     'required': [
         'user_agent',
@@ -38,6 +92,8 @@ SECRETS_SCHEMA = {
         'admin_username': {'type': 'string'},
         'admin_password': {'type': 'string'},
         'session_secret_key': {'type': 'string'},
+        'smtp_username': {'type': 'string'},
+        'smtp_password': {'type': 'string'},
     },
     'required': [
         'client_id',
@@ -62,14 +118,47 @@ def read_config_file(path, schema):
         ))
         sys.exit(1)
 
-config_dir = os.environ.get('CONFIG_DIR', 'config')
+def get_config_dir():
+    return os.environ.get('CONFIG_DIR', 'config')
 
-settings = read_config_file(
-    '{}/settings.json'.format(config_dir),
-    SETTINGS_SCHEMA
-)
+class LazyConfig(MutableMapping):
+    """A config file that is read and validated when first accessed"""
 
-secrets = read_config_file(
-    '{}/secrets.json'.format(config_dir),
-    SECRETS_SCHEMA
-)
+    def __init__(self, file_name, schema):
+        self.file_name = file_name
+        self.schema = schema
+
+        self._contents = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._contents is None:
+            with self._lock:
+                if self._contents is None:
+                    self._contents = read_config_file(
+                        os.path.join(get_config_dir(), self.file_name),
+                        self.schema,
+                    )
+        return self._contents
+
+    def copy(self):
+        return dict(self.load())
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __setitem__(self, key, value):
+        self.load()[key] = value
+
+    def __delitem__(self, key):
+        del self.load()[key]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
+settings = LazyConfig('settings.json', SETTINGS_SCHEMA)
+
+secrets = LazyConfig('secrets.json', SECRETS_SCHEMA)
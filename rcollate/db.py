@@ -1,61 +1,645 @@
+from collections import OrderedDict
+import json
+import math
 import os
-import random
+import pickle
 import string
+import threading
+import time
 
 from sqlalchemy import (
+    and_,
+    bindparam,
     create_engine,
+    event,
+    func,
+    inspect,
+    or_,
+    select,
     Column,
+    Float,
+    Index,
     Integer,
     MetaData,
-    PickleType,
     String,
     Table,
+    Text,
 )
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateColumn
 from sqlalchemy.orm import mapper, sessionmaker
+from sqlalchemy.pool import QueuePool
 
-from rcollate import logs
+from rcollate import logs, metrics
 from rcollate.config import settings
 from rcollate.models import Job
 
 JOB_KEY_LENGTH = 20
 
-os.makedirs(os.path.dirname(settings['db_file']), exist_ok=True)
-engine = create_engine('sqlite:///{}'.format(settings['db_file']), echo=True)
-metadata = MetaData()
-Session = sessionmaker(bind=engine)
+# Jobs loaded per query by iter_jobs
+JOB_BATCH_SIZE = 500
+
+# Values per IN (...) query, kept under SQLite's limit of 999 parameters
+IN_QUERY_BATCH_SIZE = 500
+
+# Job claims inserted per statement, at 4 parameters each
+CLAIM_BATCH_SIZE = 200
+
+JOB_KEY_CHARS = string.ascii_lowercase + string.ascii_uppercase + string.digits
+
+# Connections kept open by the pool, and extra ones allowed under load
+DB_POOL_SIZE = 5
+DB_MAX_OVERFLOW = 10
+
+# PRAGMAs run on every new SQLite connection. WAL lets readers run
+# alongside the single writer, and the busy timeout (in milliseconds)
+# makes writers wait for the lock rather than fail with "database is
+# locked".
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'busy_timeout': 5000,
+    'mmap_size': 64 * 1024 * 1024,
+}
 
 logger = logs.get_logger()
 
+query_seconds = metrics.histogram(
+    'rcollate_db_query_seconds', "Time taken by database queries",
+)
+
+def _create_engine():
+    """Create the engine for the db_url setting, or SQLite at db_file"""
+    db_url = settings.get('db_url')
+    if db_url is None:
+        os.makedirs(os.path.dirname(settings['db_file']), exist_ok=True)
+        db_url = 'sqlite:///{}'.format(settings['db_file'])
+
+    url = make_url(db_url)
+    engine_kwargs = {
+        'echo': settings.get('sql_echo', False),
+        'pool_size': settings.get('db_pool_size', DB_POOL_SIZE),
+        'max_overflow': settings.get('db_max_overflow', DB_MAX_OVERFLOW),
+    }
+
+    is_sqlite = url.get_backend_name() == 'sqlite'
+    if is_sqlite:
+        if url.database in (None, '', ':memory:'):
+            # Every connection to an in-memory database is a new database
+            new_engine = create_engine(url, echo=engine_kwargs['echo'])
+            _time_queries(new_engine)
+            return new_engine
+
+        # Pooled connections are shared between request and scheduler threads
+        engine_kwargs['poolclass'] = QueuePool
+        engine_kwargs['connect_args'] = {'check_same_thread': False}
+
+    new_engine = create_engine(url, **engine_kwargs)
+
+    if is_sqlite:
+        event.listen(new_engine, 'connect', set_sqlite_pragmas)
+
+    _time_queries(new_engine)
+
+    return new_engine
+
+def _time_queries(engine):
+    event.listen(engine, 'before_cursor_execute', _before_query)
+    event.listen(engine, 'after_cursor_execute', _after_query)
+
+def _before_query(conn, cursor, statement, parameters, context, executemany):
+    context._rcollate_metrics_start = time.monotonic()
+
+def _after_query(conn, cursor, statement, parameters, context, executemany):
+    query_seconds.observe(time.monotonic() - context._rcollate_metrics_start)
+
+def _sqlite_pragmas():
+    pragmas = dict(SQLITE_PRAGMAS)
+    pragmas.update(settings.get('sqlite', {}))
+    return pragmas
+
+def set_sqlite_pragmas(dbapi_conn, connection_record):
+    """Connect event listener applying the PRAGMAs to SQLite connections"""
+    cursor = dbapi_conn.cursor()
+    for name, value in sorted(_sqlite_pragmas().items()):
+        cursor.execute('PRAGMA {} = {}'.format(name, value))
+    cursor.close()
+
+# Created on first use by get_engine
+engine = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    global engine
+
+    if engine is None:
+        with _engine_lock:
+            if engine is None:
+                engine = _create_engine()
+
+    return engine
+
+metadata = MetaData()
+Session = sessionmaker()
+
 jobs_table = Table('jobs', metadata,
    Column('subreddit', String, nullable=False),
    Column('target_email', String, nullable=False),
-   Column('cron_trigger', PickleType, nullable=False),
+   Column('hour', Integer, nullable=False),
+   Column('minute', Integer, nullable=False),
+   # Three letter day name, or NULL to run every day
+   Column('day_of_week', String, nullable=True),
    Column('thread_limit', Integer, nullable=False),
    Column('time_filter', String, nullable=False),
    Column('job_id', Integer, primary_key=True),
    Column('job_key', String, nullable=False),
+   # See models.DIGEST_MODES
+   Column('digest_mode', String, nullable=False, server_default='always'),
+   # JSON list of the thread ids, and the content hash, of the last email
+   Column('last_thread_ids', Text, nullable=True),
+   Column('last_content_hash', String, nullable=True),
+   Index('ix_jobs_schedule', 'hour', 'minute', 'day_of_week'),
+   Index('ix_jobs_job_key', 'job_key', unique=True),
+   # For filtering the admin job index
+   Index('ix_jobs_subreddit', 'subreddit'),
+   Index('ix_jobs_target_email', 'target_email'),
+)
+mapper(Job, jobs_table, properties={
+    '_last_thread_ids': jobs_table.c.last_thread_ids,
+})
+
+# One row per scheduled run of a job, so that when several processes
+# share the database only the first to claim a run sends it
+job_claims_table = Table('job_claims', metadata,
+   Column('job_key', String, primary_key=True),
+   # Epoch seconds of the minute the job was due
+   Column('fire_time', Integer, primary_key=True),
+   Column('claimed_by', String, nullable=False),
+   Column('claimed_at', Float, nullable=False),
+)
+
+# Rendered emails waiting to be sent, see rcollate.outbox
+outbox_table = Table('outbox', metadata,
+   Column('message_id', Integer, primary_key=True),
+   # Identifies the job run an email is for, so it is only queued once
+   Column('idempotency_key', String, nullable=False),
+   Column('target_email', String, nullable=False),
+   Column('subreddit', String, nullable=False),
+   Column('subject', String, nullable=False),
+   Column('html', Text, nullable=False),
+   # pending, sent or dead
+   Column('status', String, nullable=False),
+   Column('attempts', Integer, nullable=False),
+   Column('next_attempt_at', Float, nullable=False),
+   Column('last_error', String, nullable=True),
+   Column('created_at', Float, nullable=False),
+   Column('sent_at', Float, nullable=True),
+   Index('ix_outbox_idempotency_key', 'idempotency_key', unique=True),
+   Index('ix_outbox_due', 'status', 'next_attempt_at'),
+)
+
+# One row per job per run, with how long each stage of the run took
+job_runs_table = Table('job_runs', metadata,
+   Column('run_id', Integer, primary_key=True),
+   Column('job_key', String, nullable=False),
+   Column('subreddit', String, nullable=False),
+   Column('fire_time', Integer, nullable=False),
+   Column('started_at', Float, nullable=False),
+   # Seconds from the scheduled time to the fetch, NULL for manual runs
+   Column('lag_seconds', Float, nullable=True),
+   # NULL for stages the run didn't reach
+   Column('fetch_seconds', Float, nullable=True),
+   Column('render_seconds', Float, nullable=True),
+   Column('send_seconds', Float, nullable=True),
+   Column('thread_count', Integer, nullable=True),
+   Column('message_size', Integer, nullable=True),
+   # sent, queued (to the outbox), skipped (by a digest mode) or failed
+   Column('outcome', String, nullable=False),
+   Column('error', String, nullable=True),
+   Index('ix_job_runs_started_at', 'started_at'),
+)
+
+# Timed stages of a job run, each with a <stage>_seconds job_runs column
+JOB_RUN_STAGES = ('lag', 'fetch', 'render', 'send')
+
+JOB_COPY_COLUMNS = (
+    'subreddit',
+    'target_email',
+    'thread_limit',
+    'time_filter',
+    'job_id',
+    'job_key',
 )
-mapper(Job, jobs_table)
 
 def open_conn():
-    return Session()
+    return Session(bind=get_engine())
 
 def close_conn(db_conn):
     db_conn.close()
 
 def init():
-    metadata.create_all(bind=engine)
+    _migrate_pickled_cron_triggers()
+    metadata.create_all(bind=get_engine())
+    _add_missing_columns()
+    _create_missing_indexes()
+
+def _add_missing_columns():
+    """Add jobs columns introduced after a database's tables were created"""
+    column_names = set(
+        column['name'] for column in inspect(get_engine()).get_columns('jobs')
+    )
+
+    for column in jobs_table.columns:
+        if column.name not in column_names:
+            logger.info("Adding column jobs.{}".format(column.name))
+            get_engine().execute('ALTER TABLE jobs ADD COLUMN {}'.format(
+                CreateColumn(column).compile(dialect=get_engine().dialect)
+            ))
+
+def _create_missing_indexes():
+    """Add indexes introduced after a database's tables were created"""
+    index_names = set(
+        index['name'] for index in inspect(get_engine()).get_indexes('jobs')
+    )
+
+    for index in jobs_table.indexes:
+        if index.name not in index_names:
+            logger.info("Creating index {}".format(index.name))
+            index.create(bind=get_engine())
+
+def _migrate_pickled_cron_triggers():
+    """Move jobs stored with a pickled cron_trigger onto schedule columns"""
+    inspector = inspect(get_engine())
+    if 'jobs' not in inspector.get_table_names():
+        return
+
+    columns = [column['name'] for column in inspector.get_columns('jobs')]
+    if 'cron_trigger' not in columns:
+        return
+
+    logger.info("Migrating jobs table to schedule columns")
+
+    with get_engine().begin() as conn:
+        conn.execute('ALTER TABLE jobs RENAME TO jobs_pickled')
+        jobs_table.create(bind=conn)
+
+        rows = conn.execute(
+            'SELECT {}, cron_trigger FROM jobs_pickled'.format(
+                ', '.join(JOB_COPY_COLUMNS)
+            )
+        ).fetchall()
+
+        for row in rows:
+            cron_trigger = pickle.loads(row['cron_trigger'])
+            values = {column: row[column] for column in JOB_COPY_COLUMNS}
+            values.update(
+                hour=cron_trigger['hour'],
+                minute=cron_trigger.get('minute', 0),
+                day_of_week=cron_trigger.get('day_of_week'),
+            )
+            conn.execute(jobs_table.insert(), values)
+
+        conn.execute('DROP TABLE jobs_pickled')
+
+    logger.info("Migrated {} jobs".format(len(rows)))
 
 def get_job(db_conn, job_key):
     job = db_conn.query(Job).filter_by(job_key=job_key).one()
     return job
 
+def find_job(db_conn, job_key):
+    """Return the job with job_key, or None if there is none"""
+    return db_conn.query(Job).filter_by(job_key=job_key).one_or_none()
+
 def get_jobs(db_conn):
     jobs = db_conn.query(Job).all()
     return {
         job.job_key: job for job in jobs
     }
 
+def _filter_jobs(query, subreddit=None, target_email=None, minute=None):
+    if subreddit is not None:
+        query = query.filter(Job.subreddit == subreddit)
+    if target_email is not None:
+        query = query.filter(Job.target_email == target_email)
+    if minute is not None:
+        query = query.filter(Job.minute == minute)
+    return query
+
+def get_jobs_page(db_conn, after_job_id=None, limit=JOB_BATCH_SIZE, **filters):
+    """Return up to limit jobs in job_id order, starting after after_job_id.
+
+    Pages are found by job_id rather than by offset, so later pages cost
+    no more than the first. filters are subreddit, target_email and minute.
+    """
+    query = _filter_jobs(db_conn.query(Job), **filters)
+
+    if after_job_id is not None:
+        query = query.filter(Job.job_id > after_job_id)
+
+    return query.order_by(Job.job_id).limit(limit).all()
+
+def iter_jobs(db_conn, batch_size=JOB_BATCH_SIZE, **filters):
+    """Yield every job matching filters, loading batch_size at a time"""
+    after_job_id = None
+
+    while True:
+        jobs = get_jobs_page(db_conn, after_job_id, batch_size, **filters)
+
+        for job in jobs:
+            yield job
+
+        if len(jobs) < batch_size:
+            return
+
+        after_job_id = jobs[-1].job_id
+        # Don't hold on to jobs already yielded
+        db_conn.expunge_all()
+
+def get_jobs_by_job_keys(db_conn, job_keys):
+    jobs = []
+
+    # Batched to stay under the database's limit on bound parameters
+    for batch in _batches(job_keys):
+        jobs.extend(db_conn.query(Job).filter(Job.job_key.in_(batch)).all())
+
+    return jobs
+
+def get_due_jobs(db_conn, hour, minute, day_of_week=None):
+    """Return the jobs scheduled at hour:minute.
+
+    If day_of_week is given, jobs restricted to other days are left out.
+    """
+    query = db_conn.query(Job).filter_by(hour=hour, minute=minute)
+
+    if day_of_week is not None:
+        query = query.filter(or_(
+            Job.day_of_week.is_(None),
+            Job.day_of_week == day_of_week,
+        ))
+
+    return query.all()
+
+def get_subreddit_job_counts(db_conn):
+    return dict(
+        db_conn.query(Job.subreddit, func.count(Job.job_id)).\
+            group_by(Job.subreddit).all()
+    )
+
+def _batches(items, batch_size=None):
+    """Split items into lists of batch_size, IN_QUERY_BATCH_SIZE by default"""
+    if batch_size is None:
+        batch_size = IN_QUERY_BATCH_SIZE
+
+    items = list(items)
+    for i in range(0, len(items), batch_size):
+        yield items[i:i + batch_size]
+
+def _insert_ignoring_duplicates(table):
+    """An INSERT that skips rows whose primary key is already taken"""
+    if get_engine().dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert(table).on_conflict_do_nothing()
+
+    return table.insert().\
+        prefix_with('OR IGNORE', dialect='sqlite').\
+        prefix_with('IGNORE', dialect='mysql')
+
+def claim_job_keys(db_conn, job_keys, fire_time, claimed_by):
+    """Claim the runs of jobs due at fire_time, returning the keys claimed.
+
+    Keys whose run was already claimed, by this or any other process, are
+    left out. The claims are inserted and committed together, then the
+    rows this call won are read back.
+    """
+    job_keys = list(job_keys)
+    if not job_keys:
+        return []
+
+    claimed_at = time.time()
+
+    for batch in _batches(job_keys, CLAIM_BATCH_SIZE):
+        db_conn.execute(_insert_ignoring_duplicates(job_claims_table).values([
+            {
+                'job_key': job_key,
+                'fire_time': fire_time,
+                'claimed_by': claimed_by,
+                'claimed_at': claimed_at,
+            }
+            for job_key in batch
+        ]))
+    db_conn.commit()
+
+    query = select([job_claims_table.c.job_key]).where(and_(
+        job_claims_table.c.fire_time == fire_time,
+        job_claims_table.c.claimed_by == claimed_by,
+        job_claims_table.c.claimed_at == claimed_at,
+        job_claims_table.c.job_key.in_(bindparam('job_keys', expanding=True)),
+    ))
+
+    won = set()
+    for batch in _batches(job_keys):
+        won.update(
+            job_key for job_key, in
+            db_conn.execute(query, {'job_keys': batch})
+        )
+
+    return [job_key for job_key in job_keys if job_key in won]
+
+def purge_job_claims(db_conn, before):
+    db_conn.execute(
+        job_claims_table.delete().where(job_claims_table.c.fire_time < before)
+    )
+    db_conn.commit()
+
+def enqueue_outbox_message(
+    db_conn, idempotency_key, target_email, subreddit, subject, html,
+):
+    """Add an email to the outbox, returning False if it is already there"""
+    now = time.time()
+
+    try:
+        db_conn.execute(outbox_table.insert(), {
+            'idempotency_key': idempotency_key,
+            'target_email': target_email,
+            'subreddit': subreddit,
+            'subject': subject,
+            'html': html,
+            'status': 'pending',
+            'attempts': 0,
+            'next_attempt_at': now,
+            'created_at': now,
+        })
+        db_conn.commit()
+    except IntegrityError:
+        db_conn.rollback()
+        return False
+
+    return True
+
+def claim_outbox_messages(db_conn, now, limit, lease_seconds):
+    """Claim up to limit pending emails that are due to be sent.
+
+    Each claimed email has its attempts counted and is not due again for
+    lease_seconds, so it is only retried by others if its sender dies.
+    """
+    due_message_ids = [
+        row.message_id for row in db_conn.execute(
+            outbox_table.select().
+                with_only_columns([outbox_table.c.message_id]).
+                where(outbox_table.c.status == 'pending').
+                where(outbox_table.c.next_attempt_at <= now).
+                order_by(outbox_table.c.next_attempt_at).
+                limit(limit)
+        )
+    ]
+
+    claimed_message_ids = []
+    for message_id in due_message_ids:
+        result = db_conn.execute(
+            outbox_table.update().
+                where(outbox_table.c.message_id == message_id).
+                where(outbox_table.c.status == 'pending').
+                where(outbox_table.c.next_attempt_at <= now).
+                values(
+                    attempts=outbox_table.c.attempts + 1,
+                    next_attempt_at=now + lease_seconds,
+                )
+        )
+        if result.rowcount == 1:
+            claimed_message_ids.append(message_id)
+    db_conn.commit()
+
+    if not claimed_message_ids:
+        return []
+
+    return [
+        dict(row) for row in db_conn.execute(
+            outbox_table.select().
+                where(outbox_table.c.message_id.in_(claimed_message_ids)).
+                order_by(outbox_table.c.message_id)
+        )
+    ]
+
+def mark_outbox_message_sent(db_conn, message_id):
+    db_conn.execute(
+        outbox_table.update().
+            where(outbox_table.c.message_id == message_id).
+            values(status='sent', sent_at=time.time(), last_error=None)
+    )
+    db_conn.commit()
+
+def mark_outbox_message_failed(db_conn, message_id, error, next_attempt_at=None):
+    """Record a failed send, to retry at next_attempt_at or never if None"""
+    if next_attempt_at is None:
+        values = {'status': 'dead', 'last_error': error}
+    else:
+        values = {'next_attempt_at': next_attempt_at, 'last_error': error}
+
+    db_conn.execute(
+        outbox_table.update().
+            where(outbox_table.c.message_id == message_id).
+            values(**values)
+    )
+    db_conn.commit()
+
+def purge_outbox_messages(db_conn, before):
+    """Delete emails sent before the given time"""
+    db_conn.execute(
+        outbox_table.delete().
+            where(outbox_table.c.status == 'sent').
+            where(outbox_table.c.sent_at < before)
+    )
+    db_conn.commit()
+
+def get_outbox_counts(db_conn):
+    return dict(
+        db_conn.execute(
+            outbox_table.select().
+                with_only_columns([outbox_table.c.status, func.count()]).
+                group_by(outbox_table.c.status)
+        ).fetchall()
+    )
+
+def insert_job_runs(db_conn, job_runs):
+    """Insert job_runs, dicts of job_runs_table columns"""
+    db_conn.execute(job_runs_table.insert(), job_runs)
+    db_conn.commit()
+
+def purge_job_runs(db_conn, before):
+    """Delete the history of runs started before the epoch time before"""
+    db_conn.execute(
+        job_runs_table.delete().where(job_runs_table.c.started_at < before)
+    )
+    db_conn.commit()
+
+def get_job_run_percentiles(db_conn, since, percentiles=(50, 95, 99)):
+    """Return {stage: {'count': runs, percentile: seconds}} since since.
+
+    Percentiles are nearest-rank, with each one picked out by SQLite
+    rather than by loading every run.
+    """
+    results = OrderedDict()
+
+    for stage in JOB_RUN_STAGES:
+        column = job_runs_table.c['{}_seconds'.format(stage)]
+        condition = and_(
+            job_runs_table.c.started_at >= since, column.isnot(None)
+        )
+
+        count = db_conn.execute(
+            select([func.count()]).where(condition)
+        ).scalar()
+        results[stage] = {'count': count}
+
+        for percentile in percentiles:
+            if count == 0:
+                results[stage][percentile] = None
+                continue
+
+            rank = max(int(math.ceil(percentile / 100.0 * count)) - 1, 0)
+            results[stage][percentile] = db_conn.execute(
+                select([column]).where(condition).
+                    order_by(column).limit(1).offset(rank)
+            ).scalar()
+
+    return results
+
+def get_slowest_subreddits(db_conn, since, limit=10):
+    """Return the subreddits whose runs since since took longest on average"""
+    total_seconds = (
+        func.coalesce(job_runs_table.c.fetch_seconds, 0) +
+        func.coalesce(job_runs_table.c.render_seconds, 0) +
+        func.coalesce(job_runs_table.c.send_seconds, 0)
+    )
+    mean_seconds = func.avg(total_seconds).label('mean_seconds')
+
+    return [
+        dict(row) for row in db_conn.execute(
+            select([
+                job_runs_table.c.subreddit,
+                func.count().label('runs'),
+                func.avg(job_runs_table.c.fetch_seconds).label('fetch_seconds'),
+                func.avg(job_runs_table.c.render_seconds).label('render_seconds'),
+                func.avg(job_runs_table.c.send_seconds).label('send_seconds'),
+                mean_seconds,
+                func.max(total_seconds).label('max_seconds'),
+            ]).
+                where(job_runs_table.c.started_at >= since).
+                group_by(job_runs_table.c.subreddit).
+                order_by(mean_seconds.desc()).
+                limit(limit)
+        )
+    ]
+
+def get_job_run_outcomes(db_conn, since):
+    return dict(db_conn.execute(
+        select([job_runs_table.c.outcome, func.count()]).
+            where(job_runs_table.c.started_at >= since).
+            group_by(job_runs_table.c.outcome)
+    ).fetchall())
+
 def insert_job(db_conn, job):
     if job.job_key is None:
         job.job_key = get_new_job_key(db_conn)
@@ -65,27 +649,122 @@ def insert_job(db_conn, job):
 
     return job
 
+def insert_jobs(db_conn, jobs):
+    """Insert many jobs in one transaction, giving them new keys as needed.
+
+    Returns the jobs, which are not loaded into db_conn, so their job_id
+    is left unset.
+    """
+    new_job_keys = get_new_job_keys(
+        db_conn, sum(1 for job in jobs if job.job_key is None)
+    )
+    for job in jobs:
+        if job.job_key is None:
+            job.job_key = new_job_keys.pop()
+
+    attribute_names = {
+        column.name: inspect(Job).get_property_by_column(column).key
+        for column in jobs_table.columns
+        if column.name != 'job_id'
+    }
+    rows = [
+        {
+            column_name: getattr(job, attribute_name)
+            for column_name, attribute_name in attribute_names.items()
+        }
+        for job in jobs
+    ]
+
+    if rows:
+        db_conn.execute(jobs_table.insert(), rows)
+    db_conn.commit()
+
+    return jobs
+
+def update_job_digests(db_conn, job_digests):
+    """Save the (job_key, thread_ids, content_hash) of jobs' last emails"""
+    if not job_digests:
+        return
+
+    db_conn.execute(
+        jobs_table.update().
+            where(jobs_table.c.job_key == bindparam('digest_job_key')).
+            values(
+                last_thread_ids=bindparam('digest_thread_ids'),
+                last_content_hash=bindparam('digest_content_hash'),
+            ),
+        [
+            {
+                'digest_job_key': job_key,
+                'digest_thread_ids': json.dumps(thread_ids),
+                'digest_content_hash': content_hash,
+            }
+            for job_key, thread_ids, content_hash in job_digests
+        ],
+    )
+    db_conn.commit()
+
 def update_job(db_conn, job):
     db_conn.commit()
     return job
 
 def delete_job(db_conn, job_key):
-    job = db_conn.query(Job).filter_by(job_key=job_key).one()
-    db_conn.delete(job)
+    db_conn.query(Job).filter_by(job_key=job_key).delete()
     db_conn.commit()
 
 def is_valid_job_key(db_conn, job_key):
     return db_conn.query(Job.job_id).\
         filter_by(job_key=job_key).count() == 1
 
-def get_new_job_key(db_conn):
-    while True:
-        random_key = ''.join(
-            random.SystemRandom().choice(
-                string.ascii_lowercase + string.ascii_uppercase + string.digits
-            )
-            for _ in range(JOB_KEY_LENGTH)
+def find_existing_job_keys(db_conn, job_keys):
+    """Return the subset of job_keys already used by jobs"""
+    existing = set()
+
+    # Expanded when run, so the query isn't compiled with a parameter per key
+    query = select([jobs_table.c.job_key]).where(
+        jobs_table.c.job_key.in_(bindparam('job_keys', expanding=True))
+    )
+
+    for batch in _batches(job_keys):
+        existing.update(
+            job_key for job_key, in
+            db_conn.execute(query, {'job_keys': batch})
         )
 
-        if not is_valid_job_key(db_conn, random_key):
-            return random_key
+    return existing
+
+# Random bytes below this map evenly onto JOB_KEY_CHARS
+_JOB_KEY_BYTE_LIMIT = 256 - 256 % len(JOB_KEY_CHARS)
+
+def _random_job_key():
+    # One os.urandom call per key is much faster than SystemRandom.choice
+    # per character
+    key = ''
+    while len(key) < JOB_KEY_LENGTH:
+        key += ''.join(
+            JOB_KEY_CHARS[byte % len(JOB_KEY_CHARS)]
+            for byte in os.urandom(JOB_KEY_LENGTH * 2)
+            if byte < _JOB_KEY_BYTE_LIMIT
+        )
+    return key[:JOB_KEY_LENGTH]
+
+def get_new_job_keys(db_conn, count):
+    """Return count distinct unused job keys.
+
+    Keys are generated together and checked for collisions in batches,
+    rather than with a query per key.
+    """
+    job_keys = set()
+
+    while len(job_keys) < count:
+        candidates = set()
+        while len(candidates) < count - len(job_keys):
+            candidates.add(_random_job_key())
+        candidates -= job_keys
+
+        job_keys |= candidates - find_existing_job_keys(db_conn, candidates)
+
+    return job_keys
+
+def get_new_job_key(db_conn):
+    return get_new_job_keys(db_conn, 1).pop()
@@ -1,13 +1,21 @@
 import re
 
 from flask_wtf import FlaskForm
-from wtforms import DateTimeField, StringField
+from wtforms import DateTimeField, SelectField, StringField
 from wtforms.validators import DataRequired, Regexp, ValidationError
 
+from rcollate.models import (
+    DIGEST_MODE_ALWAYS,
+    DIGEST_MODE_DESCRIPTIONS,
+    DIGEST_MODES,
+)
 import rcollate.reddit as reddit
 
 EMAIL_REGEX = re.compile(r'^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$')
 
+# Reddit's subreddit names: up to 21 letters, digits and underscores
+SUBREDDIT_REGEX = re.compile(r'^[a-zA-Z0-9][a-zA-Z0-9_]{1,20}$')
+
 class JobForm(FlaskForm):
     subreddit = StringField(
         'Subreddit',
@@ -15,6 +23,10 @@ class JobForm(FlaskForm):
             DataRequired(
                 message="Please enter a subreddit",
             ),
+            Regexp(
+                SUBREDDIT_REGEX,
+                message="Please enter a valid subreddit",
+            ),
         ]
     )
 
@@ -41,6 +53,15 @@ class JobForm(FlaskForm):
         ]
     )
 
+    digest_mode = SelectField(
+        'Repeats',
+        choices=[
+            (digest_mode, DIGEST_MODE_DESCRIPTIONS[digest_mode])
+            for digest_mode in DIGEST_MODES
+        ],
+        default=DIGEST_MODE_ALWAYS,
+    )
+
     @property
     def email_time_cron_trigger(self):
         return {
@@ -0,0 +1,86 @@
+import argparse
+import os
+import sys
+
+from rcollate import jobs_io
+import rcollate.db as db
+import rcollate.rcollate as rcollate
+
+def _format(args):
+    if args.format is not None:
+        return args.format
+
+    extension = os.path.splitext(args.file)[1][1:]
+    return extension if extension in jobs_io.FORMATS else 'csv'
+
+def import_command(args):
+    app = rcollate.create_app(schedule=False, deliver=False)
+
+    with open(args.file, newline='') as f, app.app_context():
+        jobs, errors = rcollate.import_jobs(
+            jobs_io.read_rows(f, _format(args))
+        )
+
+    for line_number, error in errors:
+        print("{}:{}: {}".format(args.file, line_number, error), file=sys.stderr)
+
+    if errors:
+        print("Nothing imported", file=sys.stderr)
+        return 1
+
+    print("Imported {} jobs".format(len(jobs)))
+    return 0
+
+def export_command(args):
+    rcollate.create_app(schedule=False, deliver=False)
+
+    filters = {
+        'subreddit': args.subreddit,
+        'target_email': args.email,
+        'minute': args.minute,
+    }
+
+    db_conn = db.open_conn()
+    try:
+        jobs = db.iter_jobs(db_conn, **{
+            name: value for name, value in filters.items() if value is not None
+        })
+
+        if args.file == '-':
+            sys.stdout.writelines(jobs_io.export_jobs(jobs, args.format or 'csv'))
+        else:
+            with open(args.file, 'w', newline='') as f:
+                f.writelines(jobs_io.export_jobs(jobs, _format(args)))
+    finally:
+        db.close_conn(db_conn)
+
+    return 0
+
+def main(argv=None):
+    """Entry point of rcollate-jobs, which imports and exports jobs in bulk.
+
+    Imported jobs are picked up by dispatcher mode schedulers straight
+    away, and by per_job schedulers when they next start.
+    """
+    parser = argparse.ArgumentParser(prog='rcollate-jobs')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    import_parser = subparsers.add_parser('import', help="Create jobs from a file")
+    import_parser.add_argument('file')
+    import_parser.add_argument('--format', choices=jobs_io.FORMATS)
+    import_parser.set_defaults(command_fn=import_command)
+
+    export_parser = subparsers.add_parser('export', help="Write jobs to a file")
+    export_parser.add_argument('file', nargs='?', default='-')
+    export_parser.add_argument('--format', choices=jobs_io.FORMATS)
+    export_parser.add_argument('--subreddit')
+    export_parser.add_argument('--email')
+    export_parser.add_argument('--minute', type=int)
+    export_parser.set_defaults(command_fn=export_command)
+
+    args = parser.parse_args(argv)
+    return args.command_fn(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
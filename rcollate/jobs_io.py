@@ -0,0 +1,190 @@
+import csv
+import io
+import json
+
+from rcollate.forms import EMAIL_REGEX, SUBREDDIT_REGEX
+from rcollate.models import DIGEST_MODE_ALWAYS, DIGEST_MODES, Job
+from rcollate.scheduler import DAYS_OF_WEEK
+import rcollate.db as db
+import rcollate.reddit as reddit
+
+FORMATS = ('csv', 'jsonl')
+
+# Columns of exported jobs, and the fields read from imported ones
+JOB_COLUMNS = (
+    'job_key',
+    'subreddit',
+    'target_email',
+    'hour',
+    'minute',
+    'day_of_week',
+    'thread_limit',
+    'time_filter',
+    'digest_mode',
+)
+
+TIME_FILTERS = ('hour', 'day', 'week', 'month', 'year', 'all')
+
+DEFAULT_THREAD_LIMIT = 10
+DEFAULT_TIME_FILTER = 'day'
+
+def read_rows(lines, format):
+    """Yield (line_number, row) for each job in lines of CSV or JSONL"""
+    if format == 'csv':
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield reader.line_num, row
+    elif format == 'jsonl':
+        for line_number, line in enumerate(lines, 1):
+            if line.strip():
+                try:
+                    yield line_number, json.loads(line)
+                except ValueError as e:
+                    yield line_number, e
+    else:
+        raise ValueError("Unknown job format {}".format(format))
+
+def _blank(value):
+    return value is None or value == ''
+
+def _str_field(row, name):
+    """Return the string value of row[name], or None if blank"""
+    value = row.get(name)
+    if _blank(value):
+        return None
+    if not isinstance(value, str):
+        raise ValueError("{} must be a string".format(name))
+    return value
+
+def _choice_field(row, name, choices, default):
+    value = _str_field(row, name)
+    if value is None:
+        return default
+    if value not in choices:
+        raise ValueError("{} must be one of {}".format(name, ', '.join(choices)))
+    return value
+
+def _int_field(row, name, default, minimum, maximum):
+    value = row.get(name)
+    if _blank(value):
+        if default is None:
+            raise ValueError("{} is required".format(name))
+        return default
+
+    # bools are ints, and int() would truncate floats and accept ' 7 '
+    if isinstance(value, str) and value.isdigit():
+        value = int(value)
+    elif isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError("{} must be a number".format(name))
+
+    if not minimum <= value <= maximum:
+        raise ValueError("{} must be between {} and {}".format(
+            name, minimum, maximum
+        ))
+    return value
+
+def parse_job(row):
+    """Build a Job from an imported row, raising ValueError if invalid"""
+    if not isinstance(row, dict):
+        raise ValueError("Invalid row: {}".format(row))
+
+    subreddit = _str_field(row, 'subreddit')
+    if subreddit is None:
+        raise ValueError("subreddit is required")
+    if not SUBREDDIT_REGEX.match(subreddit):
+        raise ValueError("subreddit {} is not a valid name".format(subreddit))
+
+    target_email = _str_field(row, 'target_email')
+    if target_email is None or not EMAIL_REGEX.match(target_email):
+        raise ValueError("target_email must be an email address")
+
+    cron_trigger = {
+        'hour': _int_field(row, 'hour', None, 0, 23),
+        'minute': _int_field(row, 'minute', 0, 0, 59),
+    }
+
+    day_of_week = _choice_field(row, 'day_of_week', DAYS_OF_WEEK, None)
+    if day_of_week is not None:
+        cron_trigger['day_of_week'] = day_of_week
+
+    return Job(
+        subreddit=subreddit,
+        target_email=target_email,
+        cron_trigger=cron_trigger,
+        thread_limit=_int_field(row, 'thread_limit', DEFAULT_THREAD_LIMIT, 1, 100),
+        time_filter=_choice_field(
+            row, 'time_filter', TIME_FILTERS, DEFAULT_TIME_FILTER
+        ),
+        job_key=_str_field(row, 'job_key'),
+        digest_mode=_choice_field(
+            row, 'digest_mode', DIGEST_MODES, DIGEST_MODE_ALWAYS
+        ),
+    )
+
+def import_jobs(db_conn, rows):
+    """Validate and insert the jobs in rows of (line_number, row).
+
+    Returns (jobs, errors), where errors is a list of (line_number,
+    message). Jobs are only inserted, all in one transaction, if there are
+    no errors. Subreddits are checked in batches and job keys are
+    generated and checked for collisions together, so large imports make
+    few requests and queries.
+    """
+    jobs = []
+    line_numbers = []
+    errors = []
+
+    for line_number, row in rows:
+        try:
+            if isinstance(row, Exception):
+                raise ValueError("Invalid JSON: {}".format(row))
+            jobs.append(parse_job(row))
+            line_numbers.append(line_number)
+        except ValueError as e:
+            errors.append((line_number, str(e)))
+
+    subreddits_exist = reddit.subreddits_exist(
+        set(job.subreddit for job in jobs)
+    )
+
+    job_keys = [job.job_key for job in jobs if job.job_key is not None]
+    existing_job_keys = db.find_existing_job_keys(db_conn, job_keys)
+    seen_job_keys = set()
+
+    for line_number, job in zip(line_numbers, jobs):
+        if not subreddits_exist[job.subreddit]:
+            errors.append((line_number, "Subreddit {} not found".format(
+                job.subreddit
+            )))
+
+        if job.job_key is not None:
+            if job.job_key in existing_job_keys or job.job_key in seen_job_keys:
+                errors.append((line_number, "Job key {} already used".format(
+                    job.job_key
+                )))
+            seen_job_keys.add(job.job_key)
+
+    if errors:
+        return [], sorted(errors)
+
+    return db.insert_jobs(db_conn, jobs), []
+
+def _csv_line(values):
+    line = io.StringIO()
+    csv.writer(line).writerow(values)
+    return line.getvalue()
+
+def export_jobs(jobs, format):
+    """Yield lines of CSV or JSONL for jobs"""
+    if format not in FORMATS:
+        raise ValueError("Unknown job format {}".format(format))
+
+    if format == 'csv':
+        yield _csv_line(JOB_COLUMNS)
+
+    for job in jobs:
+        values = [getattr(job, column) for column in JOB_COLUMNS]
+        if format == 'csv':
+            yield _csv_line(values)
+        else:
+            yield json.dumps(dict(zip(JOB_COLUMNS, values))) + '\n'
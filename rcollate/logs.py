@@ -22,8 +22,8 @@ def get_logger():
     ch.setFormatter(formatter)
     logger.addHandler(ch)
 
-    # Log file handler
-    fh = logging.FileHandler(LOG_FILE_NAME)
+    # Log file handler, which only creates the file once something is logged
+    fh = logging.FileHandler(LOG_FILE_NAME, delay=True)
     fh.setLevel(logging.DEBUG)
     fh.setFormatter(formatter)
     logger.addHandler(fh)
@@ -1,46 +1,213 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import threading
+
 import emails
 from jinja2 import Environment, FileSystemLoader
 
-from rcollate import logs
+from rcollate import logs, metrics
+from rcollate.smtp_pool import SMTPConnectionPool
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+HTML_EMAIL_TEMPLATE = 'email_body.html'
+HTML_DIGEST_EMAIL_TEMPLATE = 'email_digest_body.html'
 
-TEMPLATES = Environment(loader=FileSystemLoader('rcollate/templates'))
-HTML_EMAIL_TEMPLATE = TEMPLATES.get_template('email_body.html')
+_templates = None
 
 logger = logs.get_logger()
 
+SMTP_POOL_SIZE = 4
+SMTP_POOL_MAX_MESSAGES = 100
+
+RENDER_CACHE_SIZE = 128
+
+# Rendered in place of the job view url so cached bodies can be shared
+JOB_VIEW_URL_PLACEHOLDER = '__rcollate_job_view_url__'
+
+render_seconds = metrics.histogram(
+    'rcollate_render_seconds', "Time taken to render an email", labels=['kind'],
+)
+smtp_send_seconds = metrics.histogram(
+    'rcollate_smtp_send_seconds', "Time taken to send an email over SMTP",
+)
+emails_sent = metrics.counter('rcollate_emails_sent_total', "Emails sent")
+email_failures = metrics.counter(
+    'rcollate_email_failures_total', "Emails that failed to send",
+)
+
+def get_template(name):
+    """Load an email template, creating the template environment on first use"""
+    global _templates
+
+    if _templates is None:
+        _templates = Environment(loader=FileSystemLoader(TEMPLATES_DIR))
+
+    return _templates.get_template(name)
+
 class Mailer(object):
-    def __init__(self, smtp_host, smtp_timeout, sender_name, sender_email):
+    def __init__(
+        self,
+        smtp_host,
+        smtp_timeout,
+        sender_name,
+        sender_email,
+        smtp_port=25,
+        smtp_tls=False,
+        smtp_username=None,
+        smtp_password=None,
+        smtp_pool_size=0,
+        smtp_pool_max_messages=SMTP_POOL_MAX_MESSAGES,
+        render_cache_size=RENDER_CACHE_SIZE,
+    ):
         self.smtp_host = smtp_host
         self.smtp_timeout = smtp_timeout
         self.sender_name = sender_name
         self.sender_email = sender_email
+        self.smtp_port = smtp_port
+        self.smtp_tls = smtp_tls
+        self.smtp_username = smtp_username
+        self.smtp_password = smtp_password
+
+        if smtp_pool_size > 0:
+            self.smtp_pool = SMTPConnectionPool(
+                host=smtp_host,
+                port=smtp_port,
+                timeout=smtp_timeout,
+                use_tls=smtp_tls,
+                username=smtp_username,
+                password=smtp_password,
+                max_connections=smtp_pool_size,
+                max_messages_per_connection=smtp_pool_max_messages,
+            )
+        else:
+            self.smtp_pool = None
+
+        self.render_cache_size = render_cache_size
+        self.render_cache_hits = 0
+        self.render_cache_misses = 0
+        self._render_cache = OrderedDict()
+        self._render_cache_lock = threading.Lock()
+
+    @property
+    def smtp(self):
+        if self.smtp_pool is not None:
+            return self.smtp_pool
+
+        return {
+            'host': self.smtp_host,
+            'port': self.smtp_port,
+            'timeout': self.smtp_timeout,
+            'tls': self.smtp_tls,
+            'user': self.smtp_username,
+            'password': self.smtp_password,
+        }
 
     def send_threads(self, r_threads, target_email, subreddit, job_view_url):
-        logger.info("Send /r/{} threads to {}".format(subreddit, target_email))
+        return self.send_message(
+            self.render_threads(r_threads, subreddit, job_view_url),
+            target_email=target_email,
+            subreddit=subreddit,
+        )
 
-        message = emails.html(
-            html=HTML_EMAIL_TEMPLATE.render(
-                r_threads=r_threads,
-                job_view_url=job_view_url,
-            ),
-            subject="Top threads in /r/{}".format(subreddit),
-            mail_from=(self.sender_name, self.sender_email)
+    def render_threads(self, r_threads, subreddit, job_view_url):
+        with render_seconds.time('threads'):
+            return emails.html(
+                html=self._render_threads_html(r_threads).replace(
+                    JOB_VIEW_URL_PLACEHOLDER, job_view_url
+                ),
+                subject="Top threads in /r/{}".format(subreddit),
+                mail_from=(self.sender_name, self.sender_email)
+            )
+
+    def _render_threads_html(self, r_threads):
+        """Render the email body for r_threads, once per distinct content.
+
+        Jobs for the same listing get identical bodies apart from the job
+        view url, so the body is rendered with a placeholder url and cached
+        by a hash of the threads.
+        """
+        r_threads = list(r_threads)
+        content_hash = hashlib.sha1(
+            json.dumps(r_threads).encode('utf-8')
+        ).hexdigest()
+
+        with self._render_cache_lock:
+            html = self._render_cache.get(content_hash)
+            if html is not None:
+                self._render_cache.move_to_end(content_hash)
+                self.render_cache_hits += 1
+                return html
+
+        html = get_template(HTML_EMAIL_TEMPLATE).render(
+            r_threads=r_threads,
+            job_view_url=JOB_VIEW_URL_PLACEHOLDER,
         )
 
-        r = message.send(
-            to=target_email,
-            smtp={'host': self.smtp_host, 'timeout': self.smtp_timeout}
+        with self._render_cache_lock:
+            self.render_cache_misses += 1
+            self._render_cache[content_hash] = html
+            while len(self._render_cache) > self.render_cache_size:
+                self._render_cache.popitem(last=False)
+
+        return html
+
+    def render_digest(self, sections):
+        """Render several subreddits' threads into a single email.
+
+        Each section is a dict with subreddit, r_threads and job_view_url.
+        """
+        subreddits = ['/r/{}'.format(section['subreddit']) for section in sections]
+
+        with render_seconds.time('digest'):
+            return emails.html(
+                html=get_template(HTML_DIGEST_EMAIL_TEMPLATE).render(
+                    sections=sections,
+                ),
+                subject="Top threads in {} and {}".format(
+                    ', '.join(subreddits[:-1]), subreddits[-1]
+                ),
+                mail_from=(self.sender_name, self.sender_email)
+            )
+
+    def build_message(self, subject, html):
+        """Rebuild a message from its subject and rendered html"""
+        return emails.html(
+            html=html,
+            subject=subject,
+            mail_from=(self.sender_name, self.sender_email)
         )
 
-        success = (r.status_code == 250)
+    def send_message(self, message, target_email, subreddit):
+        success, _ = self.deliver(message, target_email, subreddit)
+        return success
+
+    def deliver(self, message, target_email, subreddit):
+        """Send message, returning whether it was sent and any error"""
+        logger.info("Send /r/{} threads to {}".format(subreddit, target_email))
+
+        try:
+            with smtp_send_seconds.time():
+                r = message.send(
+                    to=target_email,
+                    smtp=self.smtp,
+                )
+        except Exception:
+            email_failures.inc()
+            raise
 
-        if success:
+        if r.status_code == 250:
             logger.info("Sent /r/{} email to {}".format(
                 subreddit, target_email
             ))
-        else:
-            logger.error("Error sending /r/{} email to {}: status_code={}, err={}".format(
-                subreddit, target_email, r.status_code, r.error
-            ))
+            emails_sent.inc()
+            return True, None
 
-        return success
+        error = "status_code={}, err={}".format(r.status_code, r.error)
+        logger.error("Error sending /r/{} email to {}: {}".format(
+            subreddit, target_email, error
+        ))
+
+        email_failures.inc()
+        return False, error
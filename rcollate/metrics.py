@@ -0,0 +1,225 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+import time
+from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+from rcollate import logs
+
+# Upper bounds, in seconds, of the buckets latencies are counted in
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+logger = logs.get_logger()
+
+_metrics = OrderedDict()
+_metrics_lock = threading.Lock()
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'),
+        )
+        for name, value in pairs
+    ))
+
+class Metric(object):
+    """A named metric, with a value per combination of label values"""
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _check_labels(self, label_values):
+        if len(label_values) != len(self.labels):
+            raise ValueError("{} takes labels {}".format(self.name, self.labels))
+
+    def samples(self):
+        """Return a list of (suffix, label_values, extra_labels, value)"""
+        raise NotImplementedError
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.help),
+            '# TYPE {} {}'.format(self.name, self.kind),
+        ]
+        for suffix, label_values, extra, value in self.samples():
+            lines.append('{}{}{} {}'.format(
+                self.name, suffix,
+                _format_labels(self.labels, label_values, extra),
+                _format_value(value),
+            ))
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        self._check_labels(label_values)
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            return [
+                ('', label_values, (), value)
+                for label_values, value in sorted(self._values.items())
+            ]
+
+class Histogram(Metric):
+    """Counts observations, e.g. latencies, into cumulative buckets"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(
+            float(bucket) for bucket in sorted(buckets)
+        ) + (float('inf'),)
+
+    def observe(self, value, *label_values):
+        self._check_labels(label_values)
+        with self._lock:
+            if label_values not in self._values:
+                self._values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            bucket_counts, _, _ = entry = self._values[label_values]
+
+            for i, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    bucket_counts[i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        """Observe the seconds taken by the body of a with statement"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, *label_values)
+
+    def count(self, *label_values):
+        entry = self._values.get(label_values)
+        return entry[2] if entry is not None else 0
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for label_values, (bucket_counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bucket, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative += bucket_count
+                    samples.append((
+                        '_bucket', label_values,
+                        (('le', _format_value(bucket)),), cumulative,
+                    ))
+                samples.append(('_sum', label_values, (), total))
+                samples.append(('_count', label_values, (), count))
+        return samples
+
+class Callback(Metric):
+    """A metric read when rendered, from a count kept elsewhere.
+
+    fn returns the value, or {label_values: value} if the metric has
+    labels, and may return None when there is nothing to report yet.
+    """
+
+    def __init__(self, name, help, kind, fn, labels=()):
+        super().__init__(name, help, labels)
+        self.kind = kind
+        self.fn = fn
+
+    def samples(self):
+        values = self.fn()
+        if values is None:
+            return []
+        if not self.labels:
+            values = {(): values}
+        return [
+            ('', tuple(label_values), (), value)
+            for label_values, value in sorted(values.items())
+        ]
+
+def _register(metric):
+    with _metrics_lock:
+        if metric.name in _metrics:
+            raise ValueError("Metric {} already registered".format(metric.name))
+        _metrics[metric.name] = metric
+    return metric
+
+def counter(name, help, labels=()):
+    return _register(Counter(name, help, labels))
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram(name, help, labels, buckets))
+
+def callback(name, help, kind, fn, labels=()):
+    """Register a counter or gauge whose values come from fn"""
+    return _register(Callback(name, help, kind, fn, labels))
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    with _metrics_lock:
+        metrics = list(_metrics.values())
+
+    rendered = []
+    for metric in metrics:
+        try:
+            rendered.append(metric.render())
+        except Exception:
+            # A failing callback shouldn't hide every other metric
+            logger.exception("Error rendering metric {}".format(metric.name))
+
+    return '\n'.join(rendered) + '\n'
+
+class _QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def _metrics_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', CONTENT_TYPE)])
+    return [render().encode('utf-8')]
+
+def serve(port, host=''):
+    """Serve render() over HTTP from a background thread.
+
+    For processes without the web app, e.g. rcollate-worker. Returns the
+    server, to be stopped with shutdown().
+    """
+    server = make_server(
+        host, port, _metrics_app, handler_class=_QuietRequestHandler
+    )
+    threading.Thread(
+        target=server.serve_forever, name='metrics', daemon=True
+    ).start()
+    return server
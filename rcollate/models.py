@@ -1,4 +1,32 @@
 from datetime import datetime
+import hashlib
+import json
+
+# What a scheduled run sends when the top threads match the last email's
+DIGEST_MODE_ALWAYS = 'always'
+DIGEST_MODE_SKIP_UNCHANGED = 'skip_unchanged'
+DIGEST_MODE_NEW_ONLY = 'new_only'
+DIGEST_MODES = (
+    DIGEST_MODE_ALWAYS,
+    DIGEST_MODE_SKIP_UNCHANGED,
+    DIGEST_MODE_NEW_ONLY,
+)
+DIGEST_MODE_DESCRIPTIONS = {
+    DIGEST_MODE_ALWAYS: "Always send the top threads",
+    DIGEST_MODE_SKIP_UNCHANGED: "Skip the email if nothing changed",
+    DIGEST_MODE_NEW_ONLY: "Only send threads not sent before",
+}
+
+def thread_ids(r_threads):
+    """Identify threads by permalink, which is unique to each thread"""
+    return [r_thread.permalink for r_thread in r_threads]
+
+def threads_content_hash(r_threads):
+    """Hash the threads' content, ignoring votes, which change all the time"""
+    return hashlib.sha1(json.dumps([
+        [r_thread.permalink, r_thread.title, r_thread.url, r_thread.selftext]
+        for r_thread in r_threads
+    ]).encode('utf-8')).hexdigest()
 
 class Job(object):
     def __init__(
@@ -10,6 +38,7 @@ class Job(object):
         time_filter='day',
         job_id=None,
         job_key=None,
+        digest_mode=DIGEST_MODE_ALWAYS,
     ):
         self.subreddit = subreddit
         self.target_email = target_email
@@ -18,17 +47,64 @@ class Job(object):
         self.time_filter = time_filter
         self.job_id = job_id
         self.job_key = job_key
+        self.digest_mode = digest_mode
+        self.last_thread_ids = None
+        self.last_content_hash = None
+
+    @property
+    def last_thread_ids(self):
+        """Ids of the threads fetched for the last email sent"""
+        if self._last_thread_ids is None:
+            return None
+        return json.loads(self._last_thread_ids)
+
+    @last_thread_ids.setter
+    def last_thread_ids(self, last_thread_ids):
+        self._last_thread_ids = (
+            None if last_thread_ids is None else json.dumps(last_thread_ids)
+        )
+
+    def digest_threads(self, r_threads):
+        """Return the threads to email given the job's digest mode.
+
+        An empty list means the email should be skipped.
+        """
+        if self.digest_mode == DIGEST_MODE_SKIP_UNCHANGED:
+            if threads_content_hash(r_threads) == self.last_content_hash:
+                return []
+        elif self.digest_mode == DIGEST_MODE_NEW_ONLY:
+            seen_thread_ids = set(self.last_thread_ids or [])
+            return [
+                r_thread for r_thread in r_threads
+                if r_thread.permalink not in seen_thread_ids
+            ]
+
+        return list(r_threads)
+
+    @property
+    def cron_trigger(self):
+        cron_trigger = {'hour': self.hour, 'minute': self.minute}
+        if self.day_of_week is not None:
+            cron_trigger['day_of_week'] = self.day_of_week
+        return cron_trigger
+
+    @cron_trigger.setter
+    def cron_trigger(self, cron_trigger):
+        self.hour = cron_trigger['hour']
+        self.minute = cron_trigger.get('minute', 0)
+        self.day_of_week = cron_trigger.get('day_of_week')
 
     @property
     def cron_trigger_datetime(self):
         return datetime.strptime(
-            '{}:{}'.format(
-                self.cron_trigger['hour'],
-                self.cron_trigger.get('minute', 0),
-            ),
+            '{}:{}'.format(self.hour, self.minute),
             '%H:%M'
         )
 
+    @property
+    def digest_mode_str(self):
+        return DIGEST_MODE_DESCRIPTIONS[self.digest_mode]
+
     @property
     def cron_trigger_str(self):
         return self.cron_trigger_datetime.strftime(
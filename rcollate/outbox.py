@@ -0,0 +1,180 @@
+import threading
+import time
+
+from rcollate import logs
+import rcollate.db as db
+
+# Sends are given up on (and the email left dead) after this many attempts
+MAX_ATTEMPTS = 8
+
+# Retries wait BACKOFF_SECONDS, then twice that, and so on up to the max
+BACKOFF_SECONDS = 30
+MAX_BACKOFF_SECONDS = 60 * 60
+
+# A claimed email is retried by another sender if not finished in time
+CLAIM_LEASE_SECONDS = 5 * 60
+
+# Emails claimed by a worker at once
+BATCH_SIZE = 20
+
+# How often workers check for due emails when not woken by enqueue
+POLL_INTERVAL = 5
+
+# How long sent emails are kept in the outbox
+SENT_RETENTION = 7 * 24 * 60 * 60
+
+logger = logs.get_logger()
+
+def backoff_seconds(attempts):
+    """Seconds to wait before retrying an email that failed attempts times"""
+    return min(BACKOFF_SECONDS * 2 ** (attempts - 1), MAX_BACKOFF_SECONDS)
+
+def enqueue(idempotency_key, target_email, subreddit, message):
+    """Write a rendered message to the outbox.
+
+    Returns False if a message with the same idempotency key was already
+    queued, in which case nothing is written.
+    """
+    db_conn = db.open_conn()
+    try:
+        return db.enqueue_outbox_message(
+            db_conn,
+            idempotency_key=idempotency_key,
+            target_email=target_email,
+            subreddit=subreddit,
+            subject=message.subject,
+            html=message.html_body,
+        )
+    finally:
+        db.close_conn(db_conn)
+
+class OutboxDelivery(object):
+    """Worker threads sending the emails queued in the outbox table.
+
+    Failed sends are retried with exponential back off until MAX_ATTEMPTS,
+    after which they are marked dead. Emails are claimed before sending,
+    so several processes can drain the same outbox, and emails left
+    pending by a restart are picked up again once their claim expires.
+    """
+
+    def __init__(
+        self,
+        mailer,
+        workers=1,
+        batch_size=BATCH_SIZE,
+        poll_interval=POLL_INTERVAL,
+        max_attempts=MAX_ATTEMPTS,
+    ):
+        self.mailer = mailer
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+
+        self.sent = 0
+        self.retried = 0
+        self.dead = 0
+
+        self._threads = []
+        self._stopping = threading.Event()
+        self._wake = threading.Event()
+        self._stats_lock = threading.Lock()
+
+    @property
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'retried': self.retried,
+            'dead': self.dead,
+        }
+
+    def start(self):
+        self._stopping.clear()
+
+        for worker_index in range(self.workers):
+            thread = threading.Thread(
+                target=self._work,
+                name='outbox-{}'.format(worker_index),
+                daemon=True,
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def wake(self):
+        """Check for due emails now rather than at the next poll"""
+        self._wake.set()
+
+    def deliver_due(self):
+        """Send a batch of due emails, returning how many were attempted"""
+        db_conn = db.open_conn()
+        try:
+            messages = db.claim_outbox_messages(
+                db_conn, time.time(), self.batch_size, CLAIM_LEASE_SECONDS
+            )
+
+            for message in messages:
+                self._deliver(db_conn, message)
+        finally:
+            db.close_conn(db_conn)
+
+        return len(messages)
+
+    def purge_sent(self):
+        db_conn = db.open_conn()
+        try:
+            db.purge_outbox_messages(db_conn, time.time() - SENT_RETENTION)
+        finally:
+            db.close_conn(db_conn)
+
+    def _deliver(self, db_conn, message):
+        try:
+            success, error = self.mailer.deliver(
+                self.mailer.build_message(message['subject'], message['html']),
+                target_email=message['target_email'],
+                subreddit=message['subreddit'],
+            )
+        except Exception as e:
+            logger.exception("Error sending outbox message {}".format(
+                message['message_id']
+            ))
+            success, error = False, str(e)
+
+        if success:
+            db.mark_outbox_message_sent(db_conn, message['message_id'])
+            counter = 'sent'
+        elif message['attempts'] >= self.max_attempts:
+            logger.error("Giving up on outbox message {} after {} attempts".format(
+                message['message_id'], message['attempts']
+            ))
+            db.mark_outbox_message_failed(db_conn, message['message_id'], error)
+            counter = 'dead'
+        else:
+            db.mark_outbox_message_failed(
+                db_conn, message['message_id'], error,
+                next_attempt_at=time.time() + backoff_seconds(message['attempts']),
+            )
+            counter = 'retried'
+
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _work(self):
+        while not self._stopping.is_set():
+            try:
+                attempted = self.deliver_due()
+            except Exception:
+                logger.exception("Error delivering outbox messages")
+                attempted = 0
+
+            # Keep going while there is a backlog, otherwise wait
+            if attempted < self.batch_size:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
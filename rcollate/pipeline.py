@@ -0,0 +1,168 @@
+import queue
+import threading
+import time
+
+from rcollate import logs
+
+logger = logs.get_logger()
+
+_STOP = object()
+
+class Stage(object):
+    """A named step of a Pipeline with its own worker pool and input queue.
+
+    fn is called with one input item and may return None (nothing to pass
+    on), a list (each element is passed on separately) or a single item.
+    """
+
+    def __init__(self, name, fn, workers=1, queue_size=0):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+
+        self.processed = 0
+        self.failed = 0
+        self.in_progress = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+        self._stats_lock = threading.Lock()
+        self._threads = []
+
+    @property
+    def stats(self):
+        with self._stats_lock:
+            completed = self.processed + self.failed
+            return {
+                'workers': self.workers,
+                'queue_depth': self.queue.qsize(),
+                'queue_size': self.queue.maxsize,
+                'in_progress': self.in_progress,
+                'processed': self.processed,
+                'failed': self.failed,
+                'mean_seconds': (
+                    self.total_seconds / completed if completed else 0.0
+                ),
+                'max_seconds': self.max_seconds,
+            }
+
+    def process(self, item):
+        """Run fn on item, recording timings, and return its outputs as a list"""
+        with self._stats_lock:
+            self.in_progress += 1
+
+        start_time = time.perf_counter()
+        failed = True
+
+        try:
+            result = self.fn(item)
+            failed = False
+        finally:
+            elapsed = time.perf_counter() - start_time
+
+            with self._stats_lock:
+                self.in_progress -= 1
+                self.total_seconds += elapsed
+                self.max_seconds = max(self.max_seconds, elapsed)
+                if failed:
+                    self.failed += 1
+                else:
+                    self.processed += 1
+
+        if result is None:
+            return []
+        elif isinstance(result, list):
+            return result
+        else:
+            return [result]
+
+class Pipeline(object):
+    """Chain of stages, run inline or by per-stage worker threads.
+
+    When threaded, stages are connected by bounded queues so a slow stage
+    applies back pressure to the stages in front of it instead of letting
+    work pile up in memory.
+    """
+
+    def __init__(self, stages, threaded=False):
+        self.stages = stages
+        self.threaded = threaded
+
+    @property
+    def stats(self):
+        return {
+            stage.name: stage.stats for stage in self.stages
+        }
+
+    def start(self):
+        if not self.threaded:
+            return
+
+        for i, stage in enumerate(self.stages):
+            for worker_index in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._work,
+                    args=(i,),
+                    name='pipeline-{}-{}'.format(stage.name, worker_index),
+                    daemon=True,
+                )
+                thread.start()
+                stage._threads.append(thread)
+
+    def stop(self):
+        for stage in self.stages:
+            for _ in stage._threads:
+                stage.queue.put(_STOP)
+            for thread in stage._threads:
+                thread.join()
+            stage._threads = []
+
+    def join(self):
+        """Block until every submitted item has left the pipeline"""
+        for stage in self.stages:
+            stage.queue.join()
+
+    def submit(self, item):
+        if self.threaded:
+            self.stages[0].queue.put(item)
+        else:
+            self._run_inline(0, item)
+
+    def _run_inline(self, i, item):
+        for result in self._process(i, item):
+            self._run_inline(i + 1, result)
+
+    def _process(self, i, item):
+        stage = self.stages[i]
+
+        try:
+            results = stage.process(item)
+        except Exception:
+            logger.exception("Error in {} stage processing {}".format(
+                stage.name, item
+            ))
+            return []
+
+        if i + 1 == len(self.stages):
+            return []
+
+        return results
+
+    def _work(self, i):
+        stage = self.stages[i]
+
+        while True:
+            item = stage.queue.get()
+
+            if item is _STOP:
+                stage.queue.task_done()
+                return
+
+            try:
+                for result in self._process(i, item):
+                    self.stages[i + 1].queue.put(result)
+            finally:
+                # Marked done only after results are queued downstream, so
+                # that join() cannot return while work is in flight.
+                stage.queue.task_done()
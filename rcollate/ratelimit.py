@@ -0,0 +1,159 @@
+import heapq
+import itertools
+import threading
+import time
+
+from rcollate import logs
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+# Upper bound on exponential back off after repeated 429 responses
+MAX_BACKOFF_SECONDS = 60
+
+logger = logs.get_logger()
+
+class RateLimiter(object):
+    """Token bucket shared by every caller of an API.
+
+    Callers block in acquire() until a token is available, and tokens are
+    handed out in priority order (lower values first, then arrival order).
+    The refill rate is capped by the server's own budget when it is
+    reported through update(), and back_off() pauses all callers after the
+    server starts rejecting requests.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+
+        self.requests = 0
+        self.throttled = 0
+        self.back_offs = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+        self._tokens = float(burst)
+        self._server_rate = None
+        self._blocked_until = 0.0
+        self._consecutive_back_offs = 0
+        self._updated_at = time.monotonic()
+
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    @property
+    def stats(self):
+        with self._condition:
+            return {
+                'requests': self.requests,
+                'throttled': self.throttled,
+                'back_offs': self.back_offs,
+                'waiting': len(self._waiters),
+                'mean_wait_seconds': (
+                    self.total_wait_seconds / self.requests
+                    if self.requests else 0.0
+                ),
+                'max_wait_seconds': self.max_wait_seconds,
+            }
+
+    def acquire(self, priority=PRIORITY_BACKGROUND):
+        start_time = time.monotonic()
+        ticket = (priority, next(self._sequence))
+        throttled = False
+
+        with self._condition:
+            heapq.heappush(self._waiters, ticket)
+
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+
+                    if self._waiters[0] != ticket:
+                        # Someone with a better place in the queue goes first
+                        throttled = True
+                        self._condition.wait()
+                        continue
+
+                    wait_seconds = max(
+                        self._blocked_until - now,
+                        (1 - self._tokens) / self._refill_rate(),
+                    )
+                    if wait_seconds <= 0:
+                        self._tokens -= 1
+                        break
+
+                    throttled = True
+                    self._condition.wait(wait_seconds)
+            finally:
+                self._waiters.remove(ticket)
+                heapq.heapify(self._waiters)
+                self._condition.notify_all()
+
+            wait_seconds = time.monotonic() - start_time
+            self.requests += 1
+            self.total_wait_seconds += wait_seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+            if throttled:
+                self.throttled += 1
+
+    def update(self, remaining, seconds_to_reset, rate_limited=False):
+        """Follow the server's budget of requests left in its current window.
+
+        rate_limited is set for the headers of a 429 response, which leave
+        the back off growing until a request gets through.
+        """
+        with self._condition:
+            now = time.monotonic()
+            self._refill(now)
+            if not rate_limited:
+                self._consecutive_back_offs = 0
+
+            self._tokens = min(self._tokens, remaining)
+
+            if remaining < 1:
+                self._server_rate = None
+                self._blocked_until = max(
+                    self._blocked_until, now + seconds_to_reset
+                )
+            else:
+                self._server_rate = remaining / max(seconds_to_reset, 1)
+
+            self._condition.notify_all()
+
+    def back_off(self, retry_after=None):
+        """Pause every caller after the server rejected a request with 429.
+
+        Returns the number of seconds callers are paused for.
+        """
+        with self._condition:
+            self._consecutive_back_offs += 1
+            self.back_offs += 1
+
+            if retry_after is None:
+                retry_after = min(
+                    2 ** self._consecutive_back_offs, MAX_BACKOFF_SECONDS
+                )
+
+            logger.warning("Rate limited, backing off for {}s".format(retry_after))
+
+            self._tokens = 0.0
+            self._blocked_until = max(
+                self._blocked_until, time.monotonic() + retry_after
+            )
+
+            return retry_after
+
+    def _refill_rate(self):
+        if self._server_rate is None:
+            return self.rate
+        return min(self.rate, self._server_rate)
+
+    def _refill(self, now):
+        self._tokens = min(
+            self.burst,
+            self._tokens + (now - self._updated_at) * self._refill_rate(),
+        )
+        self._updated_at = now
@@ -1,24 +1,52 @@
+from collections import Counter
 from functools import wraps
+import os
+import threading
+import time
 
 from flask import (
     Flask, Response,
-    flash, g, redirect, render_template, request, url_for,
+    flash, g, has_app_context, jsonify, redirect, render_template, request,
+    stream_with_context, url_for,
 )
-from flask_socketio import SocketIO, emit
-from jinja2 import Environment, FileSystemLoader
+from flask_socketio import SocketIO, emit, join_room
+from sqlalchemy import event
 
-from rcollate import scheduler
+from rcollate import jobs_io, logs, metrics, scheduler
 from rcollate.config import secrets, settings
-from rcollate.models import Job
+from rcollate.models import DIGEST_MODE_ALWAYS, Job
+from rcollate.subreddit_index import INDEX_FILE_NAME, SubredditIndex
 import rcollate.db as db
 import rcollate.reddit as reddit
 import rcollate.forms as forms
 
+JOB_KEY_PLACEHOLDER = '__job_key__'
+
+# Jobs listed per page of the admin job index
+JOBS_PAGE_SIZE = 100
+
+# Window of job run history shown by default, in hours
+JOB_RUNS_WINDOW_HOURS = 24
+
+# Subreddits listed as the slowest on the job runs page
+SLOWEST_SUBREDDITS_LIMIT = 10
+
 app = Flask('rcollate')
-app.config['SECRET_KEY'] = secrets['session_secret_key']
 
 socketio = SocketIO(app)
 
+_job_url_format = None
+
+# Count and time the queries run by each request, see enable_query_stats
+query_stats_enabled = False
+
+logger = logs.get_logger()
+
+# Set up by create_app
+subreddit_index = None
+delivery_started = False
+_create_app_lock = threading.Lock()
+
 def get_db_conn():
     if not hasattr(g, 'db_conn'):
         g.db_conn = db.open_conn()
@@ -29,6 +57,56 @@ def close_db_conn(exception):
     if hasattr(g, 'db_conn'):
         g.db_conn.close()
 
+def load_job(job_key):
+    """Return the job with job_key, or None, querying at most once per request"""
+    if not hasattr(g, 'jobs'):
+        g.jobs = {}
+    if job_key not in g.jobs:
+        g.jobs[job_key] = db.find_job(get_db_conn(), job_key)
+    return g.jobs[job_key]
+
+def enable_query_stats():
+    """Report the number and duration of each request's queries.
+
+    Totals are logged and returned in the X-Query-Count and X-Query-Time
+    response headers. Meant for debugging, as every query is timed.
+    """
+    global query_stats_enabled
+
+    if not event.contains(db.get_engine(), 'before_cursor_execute', _before_query):
+        event.listen(db.get_engine(), 'before_cursor_execute', _before_query)
+        event.listen(db.get_engine(), 'after_cursor_execute', _after_query)
+
+    query_stats_enabled = True
+
+def _before_query(conn, cursor, statement, parameters, context, executemany):
+    context._rcollate_query_start = time.monotonic()
+
+def _after_query(conn, cursor, statement, parameters, context, executemany):
+    # Queries made outside of a request, e.g. by the scheduler, are ignored
+    if not has_app_context() or not hasattr(g, 'query_count'):
+        return
+
+    g.query_count += 1
+    g.query_seconds += time.monotonic() - context._rcollate_query_start
+
+@app.before_request
+def start_query_stats():
+    if query_stats_enabled:
+        g.query_count = 0
+        g.query_seconds = 0.0
+
+@app.after_request
+def finish_query_stats(response):
+    if query_stats_enabled and hasattr(g, 'query_count'):
+        logger.debug("{} {} ran {} queries in {:.1f}ms".format(
+            request.method, request.path,
+            g.query_count, g.query_seconds * 1000,
+        ))
+        response.headers['X-Query-Count'] = str(g.query_count)
+        response.headers['X-Query-Time'] = '{:.6f}'.format(g.query_seconds)
+    return response
+
 def check_auth(username, password):
     return username == secrets['admin_username'] and password == secrets['admin_password']
 
@@ -48,62 +126,207 @@ def requires_admin(f):
         return f(*args, **kwargs)
     return decorated
 
-def create_job(subreddit, target_email, cron_trigger):
+def create_job(
+    subreddit, target_email, cron_trigger, digest_mode=DIGEST_MODE_ALWAYS,
+):
     job = Job(
         subreddit=subreddit,
         target_email=target_email,
         cron_trigger=cron_trigger,
+        digest_mode=digest_mode,
     )
 
     db.insert_job(get_db_conn(), job)
     scheduler.schedule_job(job)
+    subreddit_index.add_job_subreddit(subreddit)
+    reddit.add_known_subreddits([subreddit])
 
     return job
 
-def update_job(job_key, subreddit, target_email, cron_trigger):
-    job = db.get_job(get_db_conn(), job_key)
+def update_job(
+    job_key, subreddit, target_email, cron_trigger, digest_mode=DIGEST_MODE_ALWAYS,
+):
+    job = load_job(job_key)
+    if job.subreddit.lower() != subreddit.lower():
+        subreddit_index.add_job_subreddit(subreddit)
+        reddit.add_known_subreddits([subreddit])
     job.subreddit = subreddit
     job.target_email = target_email
     job.cron_trigger = cron_trigger
+    job.digest_mode = digest_mode
 
     db.update_job(get_db_conn(), job)
     scheduler.reschedule_job(job)
 
+def import_jobs(rows):
+    """Create the jobs in rows of (line_number, row), see jobs_io.import_jobs"""
+    jobs, errors = jobs_io.import_jobs(get_db_conn(), rows)
+
+    if jobs:
+        scheduler.schedule_jobs(jobs)
+
+        subreddit_job_counts = Counter(job.subreddit for job in jobs)
+        for subreddit, job_count in subreddit_job_counts.items():
+            subreddit_index.add_job_subreddit(subreddit, job_count)
+        reddit.add_known_subreddits(subreddit_job_counts)
+
+    return jobs, errors
+
 def delete_job(job_key):
-    job = db.get_job(get_db_conn(), job_key)
+    job = load_job(job_key)
     scheduler.unschedule_job(job)
     db.delete_job(get_db_conn(), job_key)
+    g.jobs[job_key] = None
 
 def run_job(job_key):
-    job = db.get_job(get_db_conn(), job_key)
-    scheduler.run_job(job)
+    """Start running a job in the background, unless it is already running"""
+    job = load_job(job_key)
+    return scheduler.run_job_now(job)
+
+def get_job_filters():
+    """Read the job index filters from the query string"""
+    filters = {
+        'subreddit': request.args.get('subreddit') or None,
+        'target_email': request.args.get('email') or None,
+        'minute': request.args.get('minute', type=int),
+    }
+    return {name: value for name, value in filters.items() if value is not None}
+
+def _job_filter_args(filters):
+    args = dict(filters)
+    if 'target_email' in args:
+        args['email'] = args.pop('target_email')
+    return args
 
 @app.route("/jobs/")
 @requires_admin
 def jobs_index():
-    return render_template('jobs_index.html', jobs=db.get_jobs(get_db_conn()))
+    filters = get_job_filters()
+
+    # One extra job is loaded to tell whether there is a next page
+    jobs = db.get_jobs_page(
+        get_db_conn(),
+        after_job_id=request.args.get('after', type=int),
+        limit=JOBS_PAGE_SIZE + 1,
+        **filters
+    )
+
+    next_url = None
+    if len(jobs) > JOBS_PAGE_SIZE:
+        jobs = jobs[:JOBS_PAGE_SIZE]
+        next_url = url_for(
+            'jobs_index', after=jobs[-1].job_id, **_job_filter_args(filters)
+        )
+
+    return render_template(
+        'jobs_index.html',
+        jobs=jobs,
+        filter_args=_job_filter_args(filters),
+        next_url=next_url,
+        export_url=url_for(
+            'jobs_export', format='csv', **_job_filter_args(filters)
+        ),
+    )
+
+@app.route("/jobs/runs/")
+@requires_admin
+def job_runs_index():
+    """Stage latency percentiles and the slowest subreddits of recent runs"""
+    hours = request.args.get('hours', JOB_RUNS_WINDOW_HOURS, type=int)
+    since = time.time() - hours * 60 * 60
+
+    return render_template(
+        'job_runs_index.html',
+        hours=hours,
+        percentiles=db.get_job_run_percentiles(get_db_conn(), since),
+        outcomes=db.get_job_run_outcomes(get_db_conn(), since),
+        slowest_subreddits=db.get_slowest_subreddits(
+            get_db_conn(), since, SLOWEST_SUBREDDITS_LIMIT
+        ),
+    )
+
+@app.route("/jobs/export.<string:format>")
+@requires_admin
+def jobs_export(format):
+    """Stream the jobs matching the index filters as CSV or JSONL"""
+    if format not in jobs_io.FORMATS:
+        return "Unknown format %s" % format, 404
+
+    filters = get_job_filters()
+
+    def generate():
+        db_conn = db.open_conn()
+        try:
+            for line in jobs_io.export_jobs(
+                db.iter_jobs(db_conn, **filters), format
+            ):
+                yield line
+        finally:
+            db.close_conn(db_conn)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/csv' if format == 'csv' else 'application/x-ndjson',
+        headers={
+            'Content-Disposition': 'attachment; filename=jobs.{}'.format(format),
+        },
+    )
+
+@app.route("/jobs/import/", methods=['POST'])
+@requires_admin
+def jobs_import():
+    """Create jobs from an uploaded CSV or JSONL file.
+
+    The file is read from the file form field, or else the request body,
+    and its format from the format query argument or the file extension.
+    """
+    upload = request.files.get('file')
+    if upload is not None:
+        contents = upload.read().decode('utf-8')
+        file_name = upload.filename or ''
+    else:
+        contents = request.get_data(as_text=True)
+        file_name = ''
+
+    format = request.args.get('format') or os.path.splitext(file_name)[1][1:] or 'csv'
+    if format not in jobs_io.FORMATS:
+        return jsonify(errors=[{'line': None, 'error': "Unknown format"}]), 400
+
+    jobs, errors = import_jobs(
+        jobs_io.read_rows(contents.splitlines(), format)
+    )
+
+    if errors:
+        return jsonify(errors=[
+            {'line': line_number, 'error': error}
+            for line_number, error in errors
+        ]), 400
+
+    return jsonify(imported=len(jobs), job_keys=[job.job_key for job in jobs])
 
 @app.route('/jobs/<string:job_key>/')
 def jobs_show(job_key):
-    if not db.is_valid_job_key(get_db_conn(), job_key):
+    job = load_job(job_key)
+    if job is None:
         return "Job %s not found" % job_key, 404
 
-    return render_template('jobs_show.html', job=db.get_job(get_db_conn(), job_key))
+    return render_template('jobs_show.html', job=job)
 
 @app.route('/jobs/<string:job_key>/', methods=['POST'])
 @app.route('/jobs/<string:job_key>/edit/', methods=['GET', 'POST'])
 def jobs_edit(job_key):
-    if not db.is_valid_job_key(get_db_conn(), job_key):
+    job = load_job(job_key)
+    if job is None:
         return "Job %s not found" % job_key, 404
 
     if request.form:
         form = forms.JobForm(request.form)
     else:
-        job = db.get_job(get_db_conn(), job_key)
         form = forms.JobForm(
             subreddit=job.subreddit,
             target_email=job.target_email,
             email_time=job.cron_trigger_datetime,
+            digest_mode=job.digest_mode,
         )
 
     if request.method == 'POST':
@@ -113,6 +336,7 @@ def jobs_edit(job_key):
                 subreddit=form.subreddit.data,
                 target_email=form.target_email.data,
                 cron_trigger=form.email_time_cron_trigger,
+                digest_mode=form.digest_mode.data,
             )
 
             return redirect(url_for('jobs_show', job_key=job_key))
@@ -132,6 +356,7 @@ def jobs_new():
             subreddit=form.subreddit.data,
             target_email=form.target_email.data,
             cron_trigger=form.email_time_cron_trigger,
+            digest_mode=form.digest_mode.data,
         )
 
         return redirect(url_for('jobs_show', job_key=job.job_key))
@@ -140,7 +365,7 @@ def jobs_new():
 
 @app.route('/jobs/<string:job_key>/delete/', methods=['POST'])
 def jobs_delete(job_key):
-    if not db.is_valid_job_key(get_db_conn(), job_key):
+    if load_job(job_key) is None:
         return "Job %s not found" % job_key, 404
 
     delete_job(job_key)
@@ -149,49 +374,200 @@ def jobs_delete(job_key):
 
 @app.route('/jobs/<string:job_key>/run/', methods=['POST'])
 def jobs_run(job_key):
-    if not db.is_valid_job_key(get_db_conn(), job_key):
+    if load_job(job_key) is None:
         return "Job %s not found" % job_key, 404
 
-    run_job(job_key)
+    started = run_job(job_key)
+
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        # The page shows progress from the socket, so don't leave a flash
+        # message behind for the next page load
+        return jsonify(started=started)
+
+    if started:
+        flash("Sending test email")
+    else:
+        flash("A test email is already being sent")
 
     return redirect(url_for('jobs_show', job_key=job_key))
 
+@app.route("/metrics")
+@requires_admin
+def metrics_index():
+    """Metrics for Prometheus, which can scrape with basic auth"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 @socketio.on('subreddit_search_request')
 def subreddit_search(message):
     subreddit = message['subreddit']
 
-    matches = sorted([
-        r.display_name
-        for r in reddit.subreddit_search(subreddit)
-    ], key=len)
+    matches = subreddit_index.search(subreddit, _search_subreddit_names)
 
     emit('subreddit_search_response', {
         'subreddit': subreddit,
         'matches': matches,
     })
 
+@socketio.on('job_run_subscribe')
+def job_run_subscribe(message):
+    join_room(_job_room(message['job_key']))
+
+def _job_room(job_key):
+    return 'job:{}'.format(job_key)
+
+def _report_job_progress(job_key, status):
+    socketio.emit('job_run_progress', {
+        'job_key': job_key,
+        'status': status,
+    }, room=_job_room(job_key))
+
+def _search_subreddit_names(subreddit):
+    return [r.display_name for r in reddit.subreddit_search(subreddit)]
+
 def _get_job_by_job_key(job_key):
     db_conn = db.open_conn()
     job = db.get_job(db_conn, job_key)
     db.close_conn(db_conn)
     return job
 
+def _get_jobs_by_job_keys(job_keys):
+    db_conn = db.open_conn()
+    jobs = db.get_jobs_by_job_keys(db_conn, job_keys)
+    db.close_conn(db_conn)
+    return jobs
+
+def _get_due_jobs(hour, minute, day_of_week):
+    db_conn = db.open_conn()
+    jobs = db.get_due_jobs(db_conn, hour, minute, day_of_week)
+    db.close_conn(db_conn)
+    return jobs
+
+def _claim_job_keys(job_keys, fire_time):
+    db_conn = db.open_conn()
+    job_keys = db.claim_job_keys(
+        db_conn, job_keys, fire_time, scheduler.instance_id()
+    )
+    db.close_conn(db_conn)
+    return job_keys
+
+def _purge_job_claims(before):
+    db_conn = db.open_conn()
+    db.purge_job_claims(db_conn, before)
+    db.close_conn(db_conn)
+
+def _record_job_runs(job_runs):
+    db_conn = db.open_conn()
+    db.insert_job_runs(db_conn, job_runs)
+    db.close_conn(db_conn)
+
+def _purge_job_runs(before):
+    db_conn = db.open_conn()
+    db.purge_job_runs(db_conn, before)
+    db.close_conn(db_conn)
+
+def _update_job_digests(job_digests):
+    db_conn = db.open_conn()
+    db.update_job_digests(db_conn, job_digests)
+    db.close_conn(db_conn)
+
 def _get_job_url_by_job_key(job_key):
-    with app.test_request_context():
-        return '{}{}'.format(
-            settings['app_url'],
-            url_for(
-                'jobs_show',
-                job_key=job_key,
+    # Built once, as setting up a request context per url is expensive
+    global _job_url_format
+
+    if _job_url_format is None:
+        with app.test_request_context():
+            _job_url_format = '{}{}'.format(
+                settings['app_url'],
+                url_for(
+                    'jobs_show',
+                    job_key=JOB_KEY_PLACEHOLDER,
+                )
             )
-        )
 
-db.init()
+    return _job_url_format.replace(JOB_KEY_PLACEHOLDER, job_key)
 
-db_conn = db.open_conn()
-scheduler.start(
-    initial_jobs=db.get_jobs(db_conn).values(),
-    get_job_by_job_key_fn=_get_job_by_job_key,
-    get_job_url_by_job_key_fn=_get_job_url_by_job_key,
-)
-db.close_conn(db_conn)
+def _get_initial_jobs():
+    # The dispatcher loads jobs as they fall due instead
+    if scheduler.uses_dispatcher():
+        return []
+
+    db_conn = db.open_conn()
+    jobs = list(db.get_jobs(db_conn).values())
+    db.close_conn(db_conn)
+    return jobs
+
+def create_app(schedule=None, deliver=True):
+    """Set up the app and the resources it uses, and return it.
+
+    Nothing is set up on import, and only the first call does the work.
+    Jobs are scheduled in this process if schedule is True, or if it is
+    None and the embedded_scheduler setting is enabled; otherwise they are
+    left to rcollate-worker.
+
+    The delivery pipeline, outbox workers and SMTP pool are only started
+    if deliver or schedule is True, so tools that just read and write
+    jobs can pass deliver=False.
+    """
+    if schedule is None:
+        schedule = settings.get('embedded_scheduler', True)
+
+    with _create_app_lock:
+        if subreddit_index is None:
+            _init_app()
+
+        if (deliver or schedule) and not delivery_started:
+            _start_delivery()
+
+        if schedule:
+            scheduler.start_scheduling(_get_initial_jobs())
+
+    return app
+
+def subreddit_index_file():
+    """Path of the subreddit search index, kept next to settings['db_file']"""
+    return os.path.join(os.path.dirname(settings['db_file']), INDEX_FILE_NAME)
+
+def _init_app():
+    global subreddit_index
+
+    app.config['SECRET_KEY'] = secrets['session_secret_key']
+
+    db.init()
+
+    if settings.get('query_stats', False):
+        enable_query_stats()
+
+    db_conn = db.open_conn()
+    subreddit_job_counts = db.get_subreddit_job_counts(db_conn)
+    db.close_conn(db_conn)
+
+    index = SubredditIndex(subreddit_index_file())
+    index.load()
+    for subreddit, job_count in subreddit_job_counts.items():
+        index.add_job_subreddit(subreddit, job_count)
+    reddit.add_known_subreddits(subreddit_job_counts)
+
+    # Set last, as it marks the app as set up
+    subreddit_index = index
+
+def _start_delivery():
+    global delivery_started
+
+    job_run_history = settings.get('job_run_history', True)
+
+    scheduler.start(
+        initial_jobs=[],
+        get_job_by_job_key_fn=_get_job_by_job_key,
+        get_job_url_by_job_key_fn=_get_job_url_by_job_key,
+        get_jobs_by_job_keys_fn=_get_jobs_by_job_keys,
+        get_due_jobs_fn=_get_due_jobs,
+        claim_job_keys_fn=_claim_job_keys,
+        purge_job_claims_fn=_purge_job_claims,
+        job_progress_fn=_report_job_progress,
+        record_job_runs_fn=_record_job_runs if job_run_history else None,
+        purge_job_runs_fn=_purge_job_runs if job_run_history else None,
+        update_job_digests_fn=_update_job_digests,
+        schedule=False,
+    )
+
+    delivery_started = True
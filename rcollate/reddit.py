@@ -1,9 +1,37 @@
 from collections import namedtuple
+from contextlib import contextmanager
+import threading
+import time
 
-import praw
-from prawcore import NotFound
+from prawcore import NotFound, ResponseException
 
+from rcollate import cache, logs, metrics
 from rcollate.config import secrets, settings
+from rcollate.ratelimit import (
+    PRIORITY_BACKGROUND,
+    PRIORITY_INTERACTIVE,
+    RateLimiter,
+)
+
+# Overridden in settings to point at a fake Reddit, e.g. in benchmarks
+REDDIT_URL = 'https://www.reddit.com'
+OAUTH_URL = 'https://oauth.reddit.com'
+
+THREAD_CACHE_TTL = 600
+THREAD_CACHE_SIZE = 256
+
+# Subreddits rarely disappear, but missing ones may be created later
+SUBREDDIT_EXISTS_TTL = 24 * 60 * 60
+SUBREDDIT_MISSING_TTL = 60 * 60
+SUBREDDIT_EXISTS_CACHE_SIZE = 4096
+
+# Maximum subreddit names checked in one /api/info request
+SUBREDDIT_INFO_BATCH_SIZE = 100
+
+# Reddit allows OAuth clients 600 requests per 10 minute window
+RATE_LIMIT = 1.0
+RATE_LIMIT_BURST = 10
+RATE_LIMIT_RETRIES = 3
 
 Subreddit = namedtuple('Subreddit', [
     'display_name',
@@ -17,16 +45,341 @@ SubredditThread = namedtuple('SubredditThread', [
     'url',
 ])
 
-_reddit = praw.Reddit(
-    client_id=secrets['client_id'],
-    client_secret=secrets['client_secret'],
-    user_agent=settings['user_agent']
+# Clients and caches are created on first use by the _get_* functions
+_reddit = None
+_rate_limiter = None
+_thread_cache = None
+_subreddit_exists_cache = None
+_init_lock = threading.Lock()
+
+_async_backend = None
+_async_backend_lock = threading.Lock()
+
+# {listing cache key: [lock, threads using it]} of listings being fetched
+_listing_fetch_locks = {}
+_listing_fetch_locks_lock = threading.Lock()
+
+logger = logs.get_logger()
+
+# Subreddits of existing jobs, which are known to exist
+_known_subreddits = set()
+
+def _get_reddit():
+    global _reddit
+
+    if _reddit is None:
+        with _init_lock:
+            if _reddit is None:
+                # praw is slow to import, so only pay for it when used
+                import praw
+
+                _reddit = praw.Reddit(
+                    client_id=secrets['client_id'],
+                    client_secret=secrets['client_secret'],
+                    user_agent=settings['user_agent'],
+                    reddit_url=settings.get('reddit_url', REDDIT_URL),
+                    oauth_url=settings.get('reddit_oauth_url', OAUTH_URL),
+                )
+
+    return _reddit
+
+def _get_rate_limiter():
+    global _rate_limiter
+
+    if _rate_limiter is None:
+        with _init_lock:
+            if _rate_limiter is None:
+                _rate_limiter = RateLimiter(
+                    rate=settings.get('reddit_rate_limit', RATE_LIMIT),
+                    burst=settings.get(
+                        'reddit_rate_limit_burst', RATE_LIMIT_BURST
+                    ),
+                )
+
+    return _rate_limiter
+
+def _get_thread_cache():
+    global _thread_cache
+
+    if _thread_cache is None:
+        with _init_lock:
+            if _thread_cache is None:
+                _thread_cache = cache.TwoTierCache(
+                    namespace='top_subreddit_threads',
+                    ttl=settings.get('thread_cache_ttl', THREAD_CACHE_TTL),
+                    max_entries=settings.get(
+                        'thread_cache_size', THREAD_CACHE_SIZE
+                    ),
+                    db_file=cache.cache_db_file(),
+                )
+
+    return _thread_cache
+
+def _get_subreddit_exists_cache():
+    global _subreddit_exists_cache
+
+    if _subreddit_exists_cache is None:
+        with _init_lock:
+            if _subreddit_exists_cache is None:
+                _subreddit_exists_cache = cache.TwoTierCache(
+                    namespace='subreddit_exists',
+                    ttl=settings.get(
+                        'subreddit_exists_ttl', SUBREDDIT_EXISTS_TTL
+                    ),
+                    max_entries=SUBREDDIT_EXISTS_CACHE_SIZE,
+                    db_file=cache.cache_db_file(),
+                )
+
+    return _subreddit_exists_cache
+
+def _get_async_backend():
+    """Return the aiohttp backend if selected in settings, otherwise None"""
+    global _async_backend
+
+    if settings.get('reddit_backend', 'praw') != 'aiohttp':
+        return None
+
+    if _async_backend is None:
+        with _async_backend_lock:
+            if _async_backend is None:
+                from rcollate.reddit_async import AsyncRedditBackend
+
+                _async_backend = AsyncRedditBackend(
+                    client_id=secrets['client_id'],
+                    client_secret=secrets['client_secret'],
+                    user_agent=settings['user_agent'],
+                    oauth_url=settings.get('reddit_oauth_url', OAUTH_URL),
+                    token_url='{}/api/v1/access_token'.format(
+                        settings.get('reddit_url', REDDIT_URL)
+                    ),
+                    rate_limiter=_get_rate_limiter(),
+                )
+
+    return _async_backend
+
+def close():
+    """Close the aiohttp backend's session and event loop, if started"""
+    global _async_backend
+
+    with _async_backend_lock:
+        backend, _async_backend = _async_backend, None
+
+    if backend is not None:
+        backend.close()
+
+def _rate_limited(priority, fn, *args, **kwargs):
+    """Call fn through the shared rate limiter, backing off on 429s"""
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        _get_rate_limiter().acquire(priority)
+        rate_limited = False
+
+        try:
+            return fn(*args, **kwargs)
+        except ResponseException as e:
+            rate_limited = e.response.status_code == 429
+            if not rate_limited or attempt == RATE_LIMIT_RETRIES:
+                raise
+
+            retry_after = e.response.headers.get('retry-after')
+            _get_rate_limiter().back_off(
+                float(retry_after) if retry_after is not None else None
+            )
+        finally:
+            _sync_praw_rate_limit(rate_limited)
+
+def _sync_praw_rate_limit(rate_limited=False):
+    # praw tracks the X-Ratelimit headers of its last response
+    praw_rate_limiter = getattr(
+        getattr(_reddit, '_core', None), '_rate_limiter', None
+    )
+
+    if praw_rate_limiter is None or praw_rate_limiter.remaining is None:
+        return
+
+    _get_rate_limiter().update(
+        praw_rate_limiter.remaining,
+        praw_rate_limiter.reset_timestamp - time.time(),
+        rate_limited,
+    )
+
+def stats():
+    return {
+        'rate_limit': _get_rate_limiter().stats,
+        'thread_cache': _get_thread_cache().stats,
+        'subreddit_exists_cache': _get_subreddit_exists_cache().stats,
+    }
+
+def _cache_stats(stat):
+    caches = {
+        'thread_cache': _thread_cache,
+        'subreddit_exists_cache': _subreddit_exists_cache,
+    }
+    return {
+        (name,): getattr(named_cache, stat)
+        for name, named_cache in caches.items() if named_cache is not None
+    }
+
+def _cache_hit_stats():
+    stats = {}
+    for tier, stat in [('memory', 'hits'), ('persistent', 'persistent_hits')]:
+        for (name,), value in _cache_stats(stat).items():
+            stats[(name, tier)] = value
+    return stats
+
+fetch_seconds = metrics.histogram(
+    'rcollate_reddit_fetch_seconds',
+    "Time taken to fetch a subreddit's top threads from Reddit",
+)
+metrics.callback(
+    'rcollate_cache_hits_total', "Reddit cache hits", 'counter',
+    _cache_hit_stats, labels=['cache', 'tier'],
+)
+metrics.callback(
+    'rcollate_cache_misses_total', "Reddit cache misses", 'counter',
+    lambda: _cache_stats('misses'), labels=['cache'],
 )
 
 def top_subreddit_threads(subreddit, time_filter, thread_limit):
-    subreddit = _reddit.subreddit(subreddit)
+    r_threads = _get_cached_top_subreddit_threads(
+        subreddit, time_filter, thread_limit
+    )
+    if r_threads is not None:
+        return r_threads
+
+    # Concurrent misses for a listing, e.g. every job due at 07:00 for a
+    # subreddit, wait for one fetch instead of each making their own
+    with _listing_fetch_lock(subreddit, time_filter):
+        r_threads = _peek_cached_top_subreddit_threads(
+            subreddit, time_filter, thread_limit
+        )
+        if r_threads is not None:
+            return r_threads
+
+        with fetch_seconds.time():
+            r_threads = list(_fetch_top_subreddit_threads(
+                subreddit, time_filter, thread_limit
+            ))
+        _set_cached_top_subreddit_threads(
+            subreddit, time_filter, thread_limit, r_threads
+        )
+
+    return r_threads
+
+@contextmanager
+def _listing_fetch_lock(subreddit, time_filter):
+    key = _thread_cache_key(subreddit, time_filter)
+
+    with _listing_fetch_locks_lock:
+        entry = _listing_fetch_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
 
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _listing_fetch_locks_lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _listing_fetch_locks[key]
+
+def prefetch_top_subreddit_threads(listings):
+    """Fetch uncached (subreddit, time_filter, thread_limit) listings at once.
+
+    Only the aiohttp backend can fetch concurrently, so with praw this does
+    nothing and listings are fetched on demand instead.
+    """
+    backend = _get_async_backend()
+    if backend is None:
+        return
+
+    missing = [
+        listing for listing in listings
+        # Peeked, as the fetch that follows counts the hit or miss
+        if _peek_cached_top_subreddit_threads(*listing) is None
+    ]
+
+    results = backend.top_subreddit_threads_many(missing)
+
+    for (subreddit, time_filter, thread_limit), result in zip(missing, results):
+        if isinstance(result, Exception):
+            logger.error("Error prefetching /r/{} threads: {}".format(
+                subreddit, result
+            ))
+            continue
+
+        _set_cached_top_subreddit_threads(
+            subreddit, time_filter, thread_limit,
+            [SubredditThread(**r_thread) for r_thread in result],
+        )
+
+def _thread_cache_key(subreddit, time_filter):
+    return '{}:{}'.format(subreddit.lower(), time_filter)
+
+def _covers_thread_limit(cached, thread_limit):
+    # A cached listing can serve any smaller limit, and any limit at all
+    # if the subreddit had fewer threads than were asked for.
     return (
+        cached['thread_limit'] >= thread_limit or
+        len(cached['threads']) < cached['thread_limit']
+    )
+
+def _cached_threads(cached, thread_limit):
+    return [
+        SubredditThread(*r_thread)
+        for r_thread in cached['threads'][:thread_limit]
+    ]
+
+def _get_cached_top_subreddit_threads(subreddit, time_filter, thread_limit):
+    cached = _get_thread_cache().get(
+        _thread_cache_key(subreddit, time_filter),
+        accept=lambda cached: _covers_thread_limit(cached, thread_limit),
+    )
+    if cached is None:
+        return None
+
+    return _cached_threads(cached, thread_limit)
+
+def _peek_cached_top_subreddit_threads(subreddit, time_filter, thread_limit):
+    """Like _get_cached_top_subreddit_threads, but not counted in stats"""
+    cached = _get_thread_cache().peek(_thread_cache_key(subreddit, time_filter))
+    if cached is None or not _covers_thread_limit(cached, thread_limit):
+        return None
+
+    return _cached_threads(cached, thread_limit)
+
+def _set_cached_top_subreddit_threads(subreddit, time_filter, thread_limit, r_threads):
+    key = _thread_cache_key(subreddit, time_filter)
+
+    # Keep a longer listing cached by a concurrent fetch or another process
+    cached = _get_thread_cache().peek(key)
+    if cached is not None and cached['thread_limit'] > thread_limit:
+        return
+
+    _get_thread_cache().set(key, {
+        'thread_limit': thread_limit,
+        'threads': list(r_threads),
+    })
+
+def _fetch_top_subreddit_threads(subreddit, time_filter, thread_limit):
+    backend = _get_async_backend()
+    if backend is not None:
+        return [
+            SubredditThread(**r_thread)
+            for r_thread in backend.top_subreddit_threads(
+                subreddit, time_filter, thread_limit
+            )
+        ]
+
+    return _rate_limited(
+        PRIORITY_BACKGROUND,
+        _praw_top_subreddit_threads,
+        subreddit, time_filter, thread_limit,
+    )
+
+def _praw_top_subreddit_threads(subreddit, time_filter, thread_limit):
+    subreddit = _get_reddit().subreddit(subreddit)
+
+    return [
         SubredditThread(
             permalink=r.permalink,
             selftext=r.selftext,
@@ -35,11 +388,74 @@ def top_subreddit_threads(subreddit, time_filter, thread_limit):
             url=r.url,
         )
         for r in subreddit.top(time_filter, limit=thread_limit)
-    )
+    ]
+
+def add_known_subreddits(subreddits):
+    """Treat subreddits (e.g. those of existing jobs) as known to exist"""
+    _known_subreddits.update(subreddit.lower() for subreddit in subreddits)
 
 def subreddit_exists(subreddit):
+    exists = _get_cached_subreddit_exists(subreddit)
+
+    if exists is None:
+        exists = _fetch_subreddit_exists(subreddit)
+        _set_cached_subreddit_exists(subreddit, exists)
+
+    return exists
+
+def subreddits_exist(subreddits):
+    """Check many subreddits at once, returning {subreddit: exists}.
+
+    Subreddits not already known are checked in batches of
+    SUBREDDIT_INFO_BATCH_SIZE per Reddit request.
+    """
+    results = {}
+    unknown_subreddits = []
+
+    for subreddit in subreddits:
+        exists = _get_cached_subreddit_exists(subreddit)
+        if exists is None:
+            unknown_subreddits.append(subreddit)
+        else:
+            results[subreddit] = exists
+
+    for i in range(0, len(unknown_subreddits), SUBREDDIT_INFO_BATCH_SIZE):
+        batch = unknown_subreddits[i:i + SUBREDDIT_INFO_BATCH_SIZE]
+        existing = {
+            name.lower() for name in _fetch_existing_subreddits(batch)
+        }
+
+        for subreddit in batch:
+            results[subreddit] = subreddit.lower() in existing
+            _set_cached_subreddit_exists(subreddit, results[subreddit])
+
+    return results
+
+def _get_cached_subreddit_exists(subreddit):
+    if subreddit.lower() in _known_subreddits:
+        return True
+
+    return _get_subreddit_exists_cache().get(subreddit.lower())
+
+def _set_cached_subreddit_exists(subreddit, exists):
+    _get_subreddit_exists_cache().set(
+        subreddit.lower(),
+        exists,
+        ttl=None if exists else settings.get(
+            'subreddit_missing_ttl', SUBREDDIT_MISSING_TTL
+        ),
+    )
+
+def _fetch_subreddit_exists(subreddit):
+    backend = _get_async_backend()
+    if backend is not None:
+        return backend.subreddit_exists(subreddit)
+
     try:
-        r = _reddit.subreddits.search_by_name(subreddit, exact=True)
+        r = _rate_limited(
+            PRIORITY_INTERACTIVE,
+            _get_reddit().subreddits.search_by_name, subreddit, exact=True,
+        )
         # Note: sometimes an empty results list is returned
         # without a NotFound exception being raised, so handle
         # that case by checking len.
@@ -47,10 +463,32 @@ def subreddit_exists(subreddit):
     except NotFound:
         return False
 
+def _fetch_existing_subreddits(subreddits):
+    """Return the display names of those of subreddits that exist"""
+    backend = _get_async_backend()
+    if backend is not None:
+        return backend.existing_subreddits(subreddits)
+
+    listing = _rate_limited(
+        PRIORITY_BACKGROUND,
+        _get_reddit().get, '/api/info', params={'sr_name': ','.join(subreddits)},
+    )
+
+    return [r.display_name for r in getattr(listing, 'children', listing)]
+
 def subreddit_search(subreddit):
+    backend = _get_async_backend()
+    if backend is not None:
+        return [
+            Subreddit(**r) for r in backend.subreddit_search(subreddit)
+        ]
+
     return [
         Subreddit(
             display_name=r.display_name,
         )
-        for r in _reddit.subreddits.search_by_name(subreddit)
+        for r in _rate_limited(
+            PRIORITY_INTERACTIVE,
+            _get_reddit().subreddits.search_by_name, subreddit,
+        )
     ]
@@ -0,0 +1,294 @@
+import asyncio
+import threading
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from rcollate import logs
+from rcollate.ratelimit import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
+
+OAUTH_URL = 'https://oauth.reddit.com'
+TOKEN_URL = 'https://www.reddit.com/api/v1/access_token'
+
+# Reddit returns at most this many threads per listing request
+LISTING_PAGE_LIMIT = 100
+
+# Tokens are refreshed this many seconds before they expire
+TOKEN_REFRESH_MARGIN = 60
+
+RATE_LIMIT_RETRIES = 3
+
+logger = logs.get_logger()
+
+class RedditAPIError(Exception):
+    def __init__(self, status, path):
+        super().__init__("Reddit returned {} for {}".format(status, path))
+        self.status = status
+        self.path = path
+
+class AsyncRedditBackend(object):
+    """Reddit client running on its own asyncio event loop thread.
+
+    All requests share one keep-alive connection pool and an app-only
+    OAuth token that is refreshed shortly before it expires (or when a
+    request is rejected with 401). The blocking methods can be called from
+    any thread; top_subreddit_threads_many fetches many listings at once.
+    Results are plain dicts with the fields of the rcollate.reddit tuples.
+
+    If a rate_limiter is given, every request waits for a token from it,
+    reports the X-Ratelimit headers back to it and backs off on 429s.
+    """
+
+    def __init__(
+        self,
+        client_id,
+        client_secret,
+        user_agent,
+        max_connections=100,
+        timeout=30,
+        oauth_url=OAUTH_URL,
+        token_url=TOKEN_URL,
+        rate_limiter=None,
+    ):
+        if aiohttp is None:
+            raise RuntimeError(
+                "The aiohttp reddit backend requires aiohttp "
+                "(pip install rcollate[async])"
+            )
+
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.user_agent = user_agent
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.oauth_url = oauth_url
+        self.token_url = token_url
+        self.rate_limiter = rate_limiter
+
+        self.token_refreshes = 0
+
+        self._session = None
+        self._token = None
+        self._token_expires_at = 0
+
+        self._loop = asyncio.new_event_loop()
+        self._token_lock = None
+        self._thread = threading.Thread(
+            target=self._loop.run_forever,
+            name='reddit-async',
+            daemon=True,
+        )
+        self._thread.start()
+
+    def top_subreddit_threads(self, subreddit, time_filter, thread_limit):
+        return self._run(self._top_subreddit_threads(
+            subreddit, time_filter, thread_limit
+        ))
+
+    def top_subreddit_threads_many(self, listings):
+        """Fetch (subreddit, time_filter, thread_limit) listings concurrently.
+
+        Returns a result per listing, in order; a failed listing's result is
+        the exception raised while fetching it.
+        """
+        return self._run(self._top_subreddit_threads_many(listings))
+
+    def subreddit_exists(self, subreddit):
+        return len(self._run(self._search_reddit_names(subreddit, exact=True))) > 0
+
+    def existing_subreddits(self, subreddits):
+        """Return the display names of those of subreddits that exist"""
+        return self._run(self._existing_subreddits(subreddits))
+
+    def subreddit_search(self, subreddit):
+        return [
+            {'display_name': name}
+            for name in self._run(self._search_reddit_names(subreddit, exact=False))
+        ]
+
+    def close(self):
+        if self._session is not None:
+            self._run(self._session.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    async def _top_subreddit_threads_many(self, listings):
+        return await asyncio.gather(*[
+            self._top_subreddit_threads(*listing)
+            for listing in listings
+        ], return_exceptions=True)
+
+    async def _top_subreddit_threads(self, subreddit, time_filter, thread_limit):
+        r_threads = []
+        after = None
+
+        while len(r_threads) < thread_limit:
+            params = {
+                't': time_filter,
+                'limit': min(thread_limit - len(r_threads), LISTING_PAGE_LIMIT),
+                'raw_json': 1,
+            }
+            if after:
+                params['after'] = after
+
+            listing = await self._request(
+                'GET', '/r/{}/top'.format(subreddit), PRIORITY_BACKGROUND,
+                params=params,
+            )
+
+            children = listing['data']['children']
+            r_threads.extend(
+                {
+                    'permalink': child['data']['permalink'],
+                    'selftext': child['data']['selftext'],
+                    'title': child['data']['title'],
+                    'ups': child['data']['ups'],
+                    'url': child['data']['url'],
+                }
+                for child in children
+            )
+
+            after = listing['data'].get('after')
+            if not children or not after:
+                break
+
+        return r_threads[:thread_limit]
+
+    async def _existing_subreddits(self, subreddits):
+        listing = await self._request(
+            'GET', '/api/info', PRIORITY_BACKGROUND,
+            params={'sr_name': ','.join(subreddits)},
+        )
+
+        return [
+            child['data']['display_name']
+            for child in listing['data']['children']
+        ]
+
+    async def _search_reddit_names(self, query, exact):
+        try:
+            response = await self._request(
+                'POST', '/api/search_reddit_names', PRIORITY_INTERACTIVE, data={
+                    'query': query,
+                    'exact': str(exact).lower(),
+                    'include_over_18': 'true',
+                },
+            )
+        except RedditAPIError as e:
+            # An exact search for a missing subreddit is a 404
+            if e.status == 404:
+                return []
+            raise
+
+        return response.get('names', [])
+
+    async def _request(self, method, path, priority, **kwargs):
+        session = await self._get_session()
+
+        rejected_token = None
+        rate_limit_retries = 0
+
+        while True:
+            await self._acquire(priority)
+            token = await self._get_token(rejected_token)
+
+            async with session.request(
+                method,
+                self.oauth_url + path,
+                headers={'Authorization': 'bearer {}'.format(token)},
+                **kwargs
+            ) as response:
+                rate_limited = response.status == 429
+                retry = (
+                    rate_limited and
+                    self.rate_limiter is not None and
+                    rate_limit_retries < RATE_LIMIT_RETRIES
+                )
+
+                if retry:
+                    rate_limit_retries += 1
+                    retry_after = response.headers.get('Retry-After')
+                    self.rate_limiter.back_off(
+                        float(retry_after) if retry_after is not None else None
+                    )
+
+                self._update_rate_limit(response.headers, rate_limited)
+
+                if retry:
+                    continue
+
+                if response.status == 401 and rejected_token is None:
+                    rejected_token = token
+                    continue
+
+                if response.status >= 400:
+                    raise RedditAPIError(response.status, path)
+
+                return await response.json()
+
+    async def _acquire(self, priority):
+        if self.rate_limiter is not None:
+            # The limiter blocks, so wait for it off the event loop thread
+            await self._loop.run_in_executor(
+                None, self.rate_limiter.acquire, priority
+            )
+
+    def _update_rate_limit(self, headers, rate_limited=False):
+        if self.rate_limiter is None or 'X-Ratelimit-Remaining' not in headers:
+            return
+
+        self.rate_limiter.update(
+            float(headers['X-Ratelimit-Remaining']),
+            float(headers['X-Ratelimit-Reset']),
+            rate_limited,
+        )
+
+    async def _get_session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                headers={'User-Agent': self.user_agent},
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def _get_token(self, rejected_token=None):
+        if self._token_lock is None:
+            self._token_lock = asyncio.Lock()
+
+        # Concurrent requests rejected with the same token share one refresh
+        async with self._token_lock:
+            if (
+                self._token is None or
+                self._token == rejected_token or
+                time.time() > self._token_expires_at - TOKEN_REFRESH_MARGIN
+            ):
+                await self._refresh_token()
+
+            return self._token
+
+    async def _refresh_token(self):
+        session = await self._get_session()
+
+        async with session.post(
+            self.token_url,
+            auth=aiohttp.BasicAuth(self.client_id, self.client_secret),
+            data={'grant_type': 'client_credentials'},
+        ) as response:
+            if response.status != 200:
+                raise RedditAPIError(response.status, self.token_url)
+
+            token = await response.json()
+
+        self._token = token['access_token']
+        self._token_expires_at = time.time() + token['expires_in']
+        self.token_refreshes += 1
+
+        logger.info("Refreshed reddit access token")
@@ -1,80 +1,1067 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+import os
+import socket
+import threading
+import time
+import uuid
+import zlib
+
 from apscheduler.schedulers.background import BackgroundScheduler
 
-from rcollate import logs
-from rcollate.config import settings
-from rcollate.mailer import Mailer
+from rcollate import logs, metrics
+from rcollate.config import secrets, settings
+from rcollate.mailer import Mailer, SMTP_POOL_MAX_MESSAGES, SMTP_POOL_SIZE
+from rcollate.models import DIGEST_MODE_ALWAYS, thread_ids, threads_content_hash
+from rcollate.outbox import OutboxDelivery
+from rcollate.pipeline import Pipeline, Stage
+import rcollate.outbox as outbox
 import rcollate.reddit as reddit
 
+# Seconds past the minute at which jobs queued in batch mode are run
+BATCH_COLLECT_SECOND = 5
+
+# Default bound on the number of items waiting in front of each stage
+PIPELINE_QUEUE_SIZE = 100
+
+# Concurrent subreddit fetches used to build consolidated digests
+DIGEST_FETCH_WORKERS = 8
+
+# Scheduling modes: an APScheduler job per row, or a single tick that
+# queries the database for the jobs due each minute
+SCHEDULER_MODE_PER_JOB = 'per_job'
+SCHEDULER_MODE_DISPATCHER = 'dispatcher'
+
+# Seconds late the dispatcher tick may start, rather than being skipped
+DISPATCH_MISFIRE_GRACE_TIME = 30
+
+# Most minutes dispatched at once when catching up on missed ticks
+DISPATCH_CATCH_UP_MINUTES = 60
+
+# How long claims on past job runs are kept before being purged
+JOB_CLAIM_RETENTION = 24 * 60 * 60
+
+# How long the history of job runs is kept
+JOB_RUN_RETENTION = 30 * 24 * 60 * 60
+
+# Outcomes recorded in job run history
+OUTCOME_SENT = 'sent'
+OUTCOME_QUEUED = 'queued'
+OUTCOME_FAILED = 'failed'
+OUTCOME_SKIPPED = 'skipped'
+
+# Threads starting runs requested through run_job_now
+MANUAL_RUN_WORKERS = 2
+
+# Progress reported for runs started by run_job_now. The last four end a run.
+PROGRESS_QUEUED = 'queued'
+PROGRESS_FETCHED = 'fetched'
+PROGRESS_RENDERED = 'rendered'
+PROGRESS_SENT = 'sent'
+PROGRESS_QUEUED_FOR_DELIVERY = 'queued_for_delivery'
+PROGRESS_ALREADY_SENT = 'already_sent'
+PROGRESS_FAILED = 'failed'
+FINAL_PROGRESS = (
+    PROGRESS_SENT,
+    PROGRESS_QUEUED_FOR_DELIVERY,
+    PROGRESS_ALREADY_SENT,
+    PROGRESS_FAILED,
+)
+
+# Day names as stored in the day_of_week column, indexed by weekday()
+DAYS_OF_WEEK = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+# Buckets, in seconds, for how late scheduled jobs start
+LAG_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
 mailer = None
 scheduler = None
 job_schedules = None
 
+batch_execution = False
+consolidate_digests = False
+dispatcher = False
+job_claims = False
+partition_count = 1
+partition = 0
+digest_fetch_executor = ThreadPoolExecutor(max_workers=DIGEST_FETCH_WORKERS)
+# {job_key: fire_time} of jobs waiting for the batch collected this minute
+pending_job_keys = None
+pending_job_keys_lock = threading.Lock()
+
+# Runs the dispatcher's minutes one at a time, off the APScheduler thread
+dispatch_executor = ThreadPoolExecutor(max_workers=1)
+last_dispatched_fire_time = None
+dispatch_lock = threading.Lock()
+
+# Delivers emails written to the outbox, if the outbox is enabled
+outbox_delivery = None
+
+# Keys of jobs with a run_job_now run in progress
+manual_runs = set()
+manual_runs_lock = threading.Lock()
+manual_run_executor = ThreadPoolExecutor(max_workers=MANUAL_RUN_WORKERS)
+
 get_job_by_job_key = None
+get_jobs_by_job_keys = None
 get_job_url_by_job_key = None
+get_due_jobs = None
+claim_job_keys = None
+purge_job_claims = None
+job_progress = None
+record_job_runs = None
+purge_job_runs = None
+update_job_digests = None
 
 logger = logs.get_logger()
 
-def _run_job_by_job_key(job_key):
-    run_job(get_job_by_job_key(job_key))
+lag_seconds = metrics.histogram(
+    'rcollate_scheduler_lag_seconds',
+    "Time between a job's scheduled time and the start of its fetch",
+    buckets=LAG_BUCKETS,
+)
 
-def run_job(job):
-    mailer.send_threads(
-        r_threads=reddit.top_subreddit_threads(
-            job.subreddit,
-            job.time_filter,
-            job.thread_limit,
-        ),
-        target_email=job.target_email,
-        subreddit=job.subreddit,
-        job_view_url=get_job_url_by_job_key(job.job_key)
+def _stage_stats(stat):
+    return {
+        (stage.name,): stage.stats[stat] for stage in pipeline.stages
+    }
+
+def _outbox_stats():
+    if outbox_delivery is None:
+        return None
+    return {
+        (status,): count for status, count in outbox_delivery.stats.items()
+    }
+
+def _render_cache_stat(stat):
+    return getattr(mailer, stat) if mailer is not None else None
+
+metrics.callback(
+    'rcollate_pipeline_queue_depth', "Items waiting for a pipeline stage",
+    'gauge', lambda: _stage_stats('queue_depth'), labels=['stage'],
+)
+metrics.callback(
+    'rcollate_pipeline_in_progress', "Items being processed by a pipeline stage",
+    'gauge', lambda: _stage_stats('in_progress'), labels=['stage'],
+)
+metrics.callback(
+    'rcollate_pipeline_failures_total', "Items a pipeline stage failed on",
+    'counter', lambda: _stage_stats('failed'), labels=['stage'],
+)
+metrics.callback(
+    'rcollate_outbox_deliveries_total', "Outbox send attempts by outcome",
+    'counter', _outbox_stats, labels=['outcome'],
+)
+metrics.callback(
+    'rcollate_render_cache_hits_total', "Email body render cache hits",
+    'counter', lambda: _render_cache_stat('render_cache_hits'),
+)
+metrics.callback(
+    'rcollate_render_cache_misses_total', "Email body render cache misses",
+    'counter', lambda: _render_cache_stat('render_cache_misses'),
+)
+
+def instance_id():
+    """Identifies this process in job claims"""
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+def owns_job_key(job_key):
+    """Whether this instance's partition includes job_key"""
+    return zlib.crc32(job_key.encode('utf-8')) % partition_count == partition
+
+def _fire_time(now=None):
+    """Epoch seconds of the minute a job firing now was due"""
+    timestamp = now.timestamp() if now is not None else time.time()
+    return int(timestamp) // 60 * 60
+
+def _claim(job_keys, fire_time):
+    """Return the job keys this process should run at fire_time"""
+    if not job_claims:
+        return list(job_keys)
+    return claim_job_keys(job_keys, fire_time)
+
+def _purge_job_claims():
+    purge_job_claims(time.time() - JOB_CLAIM_RETENTION)
+
+def _purge_job_runs():
+    purge_job_runs(time.time() - JOB_RUN_RETENTION)
+
+def _scheduled_fire_time(hour=None, minute=None):
+    """Epoch seconds of the last time at or before now that hour:minute came.
+
+    Used instead of the current minute for jobs that fire late, so that
+    every process claims a run under the minute it was scheduled for.
+    """
+    if hour is None:
+        return _fire_time()
+
+    now = datetime.now(_timezone())
+    return int(_last_time_at(hour, minute, now).timestamp())
+
+def _run_job_by_job_key(job_key, hour=None, minute=None):
+    fire_time = _scheduled_fire_time(hour, minute)
+    if _claim([job_key], fire_time):
+        run_job(get_job_by_job_key(job_key), fire_time=fire_time)
+
+def _queue_job_by_job_key(job_key, hour=None, minute=None):
+    fire_time = _scheduled_fire_time(hour, minute)
+    if not _claim([job_key], fire_time):
+        return
+
+    with pending_job_keys_lock:
+        pending_job_keys[job_key] = fire_time
+
+def _run_pending_jobs():
+    with pending_job_keys_lock:
+        fire_times = dict(pending_job_keys)
+        pending_job_keys.clear()
+
+    job_keys_by_fire_time = OrderedDict()
+    for job_key, fire_time in sorted(fire_times.items(), key=lambda item: item[1]):
+        job_keys_by_fire_time.setdefault(fire_time, []).append(job_key)
+
+    for fire_time, job_keys in job_keys_by_fire_time.items():
+        run_jobs(get_jobs_by_job_keys(job_keys), fire_time=fire_time)
+
+def _dispatch_tick(now=None):
+    """Hand every minute since the last one dispatched to dispatch_executor.
+
+    Runs on the APScheduler thread, so it only works out which minutes are
+    due. Minutes whose tick started too late, or was skipped while an
+    earlier one ran, are dispatched by the next tick, up to
+    DISPATCH_CATCH_UP_MINUTES of them.
+    """
+    global last_dispatched_fire_time
+
+    fire_time = _fire_time(now)
+
+    with dispatch_lock:
+        if last_dispatched_fire_time is None:
+            first_fire_time = fire_time
+        else:
+            first_fire_time = last_dispatched_fire_time + 60
+
+        earliest_fire_time = fire_time - (DISPATCH_CATCH_UP_MINUTES - 1) * 60
+        if first_fire_time < earliest_fire_time:
+            logger.error("Not dispatching {} minutes of jobs, from {}".format(
+                (earliest_fire_time - first_fire_time) // 60,
+                datetime.fromtimestamp(first_fire_time, _timezone()),
+            ))
+            first_fire_time = earliest_fire_time
+
+        fire_times = list(range(first_fire_time, fire_time + 60, 60))
+        if fire_times:
+            last_dispatched_fire_time = fire_times[-1]
+
+    for missed_fire_time in fire_times[:-1]:
+        logger.warning("Catching up on jobs due at {}".format(
+            datetime.fromtimestamp(missed_fire_time, _timezone())
+        ))
+
+    for due_fire_time in fire_times:
+        dispatch_executor.submit(
+            _dispatch_due_jobs_logged,
+            datetime.fromtimestamp(due_fire_time, _timezone()),
+        )
+
+def _dispatch_due_jobs_logged(now):
+    try:
+        _dispatch_due_jobs(now)
+    except Exception:
+        logger.exception("Error dispatching jobs due at {}".format(now))
+
+def _dispatch_due_jobs(now=None):
+    """Run every job due in the minute of now"""
+    if now is None:
+        now = datetime.now(_timezone())
+
+    jobs = [
+        job for job in
+        get_due_jobs(now.hour, now.minute, DAYS_OF_WEEK[now.weekday()])
+        if owns_job_key(job.job_key)
+    ]
+
+    if jobs:
+        claimed_job_keys = set(_claim(
+            [job.job_key for job in jobs], _fire_time(now)
+        ))
+        jobs = [job for job in jobs if job.job_key in claimed_job_keys]
+
+    if jobs:
+        run_jobs(jobs, fire_time=_fire_time(now))
+
+def uses_dispatcher():
+    """Whether jobs are found by the dispatcher rather than scheduled per row"""
+    return (
+        settings.get('scheduler_mode', SCHEDULER_MODE_PER_JOB) ==
+        SCHEDULER_MODE_DISPATCHER
     )
 
+def run_job(job, fire_time=None, manual_run_id=None):
+    """Run job, due at fire_time.
+
+    Runs started by hand are given a manual_run_id, so that their emails
+    aren't mistaken in the outbox for the scheduled run of the same minute.
+    """
+    if fire_time is None:
+        fire_time = _fire_time()
+
+    pipeline.submit((_fetch_job_group, [job], fire_time, manual_run_id))
+
+def run_job_now(job):
+    """Run job in the background, reporting its progress to job_progress.
+
+    Returns False, without starting another run, if an earlier run of the
+    job started this way has not finished.
+    """
+    with manual_runs_lock:
+        if job.job_key in manual_runs:
+            return False
+        manual_runs.add(job.job_key)
+
+    _report_progress([job.job_key], PROGRESS_QUEUED)
+    manual_run_executor.submit(_run_job_now, job)
+
+    return True
+
+def _run_job_now(job):
+    try:
+        run_job(job, manual_run_id=uuid.uuid4().hex)
+    except Exception:
+        logger.exception("Error running {}".format(job))
+        _report_progress([job.job_key], PROGRESS_FAILED)
+
+def _report_progress(job_keys, status):
+    """Pass progress of run_job_now runs on to job_progress"""
+    with manual_runs_lock:
+        job_keys = [job_key for job_key in job_keys if job_key in manual_runs]
+        if status in FINAL_PROGRESS:
+            manual_runs.difference_update(job_keys)
+
+    if job_progress is not None:
+        for job_key in job_keys:
+            job_progress(job_key, status)
+
+def run_jobs(jobs, fire_time=None):
+    """Run jobs together, fetching each (subreddit, time_filter) only once.
+
+    If digests are consolidated, jobs sharing a target email are instead
+    sent as a single multi-section email. fire_time identifies the run in
+    the outbox and defaults to the current minute.
+    """
+    if fire_time is None:
+        fire_time = _fire_time()
+
+    listings = OrderedDict()
+    for job in jobs:
+        listing_key = (job.subreddit.lower(), job.time_filter)
+        listings[listing_key] = max(
+            listings.get(listing_key, 0), job.thread_limit
+        )
+
+    reddit.prefetch_top_subreddit_threads([
+        (subreddit, time_filter, thread_limit)
+        for (subreddit, time_filter), thread_limit in listings.items()
+    ])
+
+    if consolidate_digests:
+        jobs = _run_recipient_digests(jobs, fire_time)
+
+    job_groups = OrderedDict()
+    for job in jobs:
+        job_groups.setdefault(
+            (job.subreddit.lower(), job.time_filter), []
+        ).append(job)
+
+    logger.info("Run {} jobs in {} subreddit groups".format(
+        len(jobs), len(job_groups)
+    ))
+
+    for group_jobs in job_groups.values():
+        pipeline.submit((_fetch_job_group, group_jobs, fire_time, None))
+
+def _run_recipient_digests(jobs, fire_time):
+    """Submit a digest for each recipient with several jobs.
+
+    Returns the jobs that are the only job for their recipient.
+    """
+    recipient_jobs = OrderedDict()
+    for job in jobs:
+        recipient_jobs.setdefault(job.target_email.lower(), []).append(job)
+
+    single_jobs = []
+    digest_count = 0
+
+    for target_jobs in recipient_jobs.values():
+        if len(target_jobs) == 1:
+            single_jobs.extend(target_jobs)
+        else:
+            pipeline.submit((_fetch_recipient_jobs, target_jobs, fire_time, None))
+            digest_count += 1
+
+    logger.info("Run {} jobs in {} digests".format(
+        len(jobs) - len(single_jobs), digest_count
+    ))
+
+    return single_jobs
+
+class JobRun(object):
+    """One email's worth of work as it moves through the pipeline.
+
+    Each section pairs a job with the threads fetched for it. A run has
+    one section, or several when it is a digest for a single recipient.
+    fire_time is the minute the run's jobs were due.
+    """
+
+    def __init__(self, sections, fire_time=None):
+        self.sections = sections
+        self.fire_time = fire_time
+        self.message = None
+        self.success = None
+
+        # Set for runs started by hand, see run_job
+        self.manual_run_id = None
+
+        # (job_key, thread_ids, content_hash) saved once the email is sent
+        self.digests = []
+
+        # Recorded in the job run history
+        self.started_at = None
+        self.lag_seconds = None
+        self.fetch_seconds = None
+        self.render_seconds = None
+        self.send_seconds = None
+        self.outcome = None
+        self.error = None
+
+    @property
+    def jobs(self):
+        return [job for job, _ in self.sections]
+
+    @property
+    def target_email(self):
+        return self.jobs[0].target_email
+
+    @property
+    def subreddit(self):
+        return '+'.join(job.subreddit for job in self.jobs)
+
+    @property
+    def message_size(self):
+        if self.message is None:
+            return None
+        return len(self.message.html_body.encode('utf-8'))
+
+    def history(self):
+        """Rows for the job run history, one per job"""
+        return [
+            {
+                'job_key': job.job_key,
+                'subreddit': job.subreddit,
+                'fire_time': self.fire_time,
+                'started_at': self.started_at,
+                'lag_seconds': self.lag_seconds,
+                'fetch_seconds': self.fetch_seconds,
+                'render_seconds': self.render_seconds,
+                'send_seconds': self.send_seconds,
+                'thread_count': len(r_threads),
+                'message_size': self.message_size,
+                'outcome': self.outcome,
+                'error': self.error,
+            }
+            for job, r_threads in self.sections
+        ]
+
+    @property
+    def idempotency_key(self):
+        """Identifies this run's email, which is only sent once"""
+        job_keys = '+'.join(sorted(job.job_key for job in self.jobs))
+
+        if self.manual_run_id is not None:
+            return 'manual:{}@{}'.format(job_keys, self.manual_run_id)
+
+        return '{}@{}'.format(job_keys, self.fire_time)
+
+    def __repr__(self):
+        return "<JobRun(job_keys=%s, subreddit=%s)>" % (
+            ','.join(job.job_key for job in self.jobs),
+            self.subreddit,
+        )
+
+def _timezone():
+    return scheduler.timezone if scheduler is not None else timezone.utc
+
+def _last_time_at(hour, minute, now):
+    """The last time at or before now that the clock read hour:minute"""
+    scheduled = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if scheduled > now:
+        scheduled -= timedelta(days=1)
+    return scheduled
+
+def _scheduled_time(job, now):
+    """The last time at or before now that job's cron trigger fired"""
+    return _last_time_at(job.hour, job.minute, now)
+
+def _observe_lag(jobs):
+    """Record how late scheduled jobs are starting to be fetched.
+
+    Returns {job_key: lag seconds}, leaving out runs started by hand.
+    """
+    with manual_runs_lock:
+        jobs = [job for job in jobs if job.job_key not in manual_runs]
+
+    now = datetime.now(_timezone())
+    lags = {}
+    for job in jobs:
+        lags[job.job_key] = (now - _scheduled_time(job, now)).total_seconds()
+        lag_seconds.observe(lags[job.job_key])
+
+    return lags
+
+def _fetch(fetch_request):
+    fetch_fn, jobs, fire_time, manual_run_id = fetch_request
+    job_keys = [job.job_key for job in jobs]
+
+    lags = _observe_lag(jobs)
+    started_at = time.time()
+    start = time.monotonic()
+
+    try:
+        result = fetch_fn(jobs, fire_time)
+    except Exception as e:
+        _report_progress(job_keys, PROGRESS_FAILED)
+        _record_failed_fetch(
+            jobs, fire_time, started_at, time.monotonic() - start, lags, str(e)
+        )
+        raise
+
+    fetch_seconds = time.monotonic() - start
+    job_runs = [
+        job_run for job_run in
+        (result if isinstance(result, list) else [result])
+        if job_run is not None
+    ]
+    for job_run in job_runs:
+        job_run.manual_run_id = manual_run_id
+        job_run.started_at = started_at
+        job_run.fetch_seconds = fetch_seconds
+        job_run.lag_seconds = lags.get(job_run.jobs[0].job_key)
+
+    fetched_job_keys = set(
+        job.job_key for job_run in job_runs for job in job_run.jobs
+    )
+    _report_progress(
+        [job_key for job_key in job_keys if job_key in fetched_job_keys],
+        PROGRESS_FETCHED,
+    )
+    _report_progress(
+        [job_key for job_key in job_keys if job_key not in fetched_job_keys],
+        PROGRESS_FAILED,
+    )
+    _record_failed_fetch(
+        [job for job in jobs if job.job_key not in fetched_job_keys],
+        fire_time, started_at, fetch_seconds, lags, "Fetch failed",
+    )
+
+    return [
+        job_run for job_run in job_runs if _apply_digest_modes(job_run)
+    ]
+
+def _apply_digest_modes(job_run):
+    """Cut a run's sections down to the threads their digest modes send.
+
+    Sections left with nothing to send are recorded as skipped and
+    dropped. Returns whether anything is left to send. Runs started by
+    hand always send everything, and don't change what later runs skip.
+    """
+    with manual_runs_lock:
+        manual = set(job.job_key for job in job_run.jobs) & manual_runs
+
+    sections = []
+    for job, r_threads in job_run.sections:
+        if job.job_key in manual or job.digest_mode == DIGEST_MODE_ALWAYS:
+            sections.append((job, r_threads))
+            continue
+
+        digest_threads = job.digest_threads(r_threads)
+        if digest_threads:
+            sections.append((job, digest_threads))
+            job_run.digests.append((
+                job.job_key,
+                thread_ids(r_threads),
+                threads_content_hash(r_threads),
+            ))
+        else:
+            _record_skipped(job_run, job, r_threads)
+
+    job_run.sections = sections
+    return bool(sections)
+
+def _record_skipped(job_run, job, r_threads):
+    logger.info("Skipped {}, as its top threads haven't changed".format(job))
+
+    skipped_run = JobRun([(job, r_threads)], job_run.fire_time)
+    skipped_run.started_at = job_run.started_at
+    skipped_run.lag_seconds = job_run.lag_seconds
+    skipped_run.fetch_seconds = job_run.fetch_seconds
+    skipped_run.outcome = OUTCOME_SKIPPED
+    _record_job_run(skipped_run)
+
+def _save_digests(job_run):
+    """Remember what a sent run's jobs emailed, for their digest modes"""
+    if not job_run.digests or update_job_digests is None:
+        return
+
+    try:
+        update_job_digests(job_run.digests)
+    except Exception:
+        logger.exception("Error saving digests of {}".format(job_run))
+
+def _record_failed_fetch(jobs, fire_time, started_at, fetch_seconds, lags, error):
+    for job in jobs:
+        job_run = JobRun([(job, [])], fire_time)
+        job_run.started_at = started_at
+        job_run.fetch_seconds = fetch_seconds
+        job_run.lag_seconds = lags.get(job.job_key)
+        job_run.outcome = OUTCOME_FAILED
+        job_run.error = error
+        _record_job_run(job_run)
+
+def _record_job_run(job_run):
+    """Write a finished run to the job run history, if it is kept"""
+    if record_job_runs is None:
+        return
+
+    try:
+        record_job_runs(job_run.history())
+    except Exception:
+        # Losing history is better than failing the run
+        logger.exception("Error recording {}".format(job_run))
+
+def _fetch_job_group(jobs, fire_time=None):
+    """Fetch jobs sharing a (subreddit, time_filter) with a single fetch"""
+    r_threads = list(reddit.top_subreddit_threads(
+        jobs[0].subreddit,
+        jobs[0].time_filter,
+        max(job.thread_limit for job in jobs),
+    ))
+
+    return [
+        JobRun([(job, r_threads[:job.thread_limit])], fire_time)
+        for job in jobs
+    ]
+
+def _fetch_recipient_jobs(jobs, fire_time=None):
+    """Fetch each of a recipient's jobs concurrently into one digest run"""
+    def fetch_job(job):
+        try:
+            return list(reddit.top_subreddit_threads(
+                job.subreddit,
+                job.time_filter,
+                job.thread_limit,
+            ))
+        except Exception:
+            logger.exception("Error fetching /r/{} threads".format(job.subreddit))
+            return None
+
+    sections = [
+        (job, r_threads)
+        for job, r_threads in zip(jobs, digest_fetch_executor.map(fetch_job, jobs))
+        if r_threads is not None
+    ]
+
+    if sections:
+        return JobRun(sections, fire_time)
+
+def _job_run_stage(fn):
+    """Report a run as failed if a stage raises while processing it"""
+    @wraps(fn)
+    def stage_fn(job_run):
+        try:
+            return fn(job_run)
+        except Exception as e:
+            _report_progress(
+                [job.job_key for job in job_run.jobs], PROGRESS_FAILED
+            )
+            job_run.outcome = OUTCOME_FAILED
+            job_run.error = str(e)
+            _record_job_run(job_run)
+            raise
+    return stage_fn
+
+@_job_run_stage
+def _render_job_run(job_run):
+    start = time.monotonic()
+
+    if len(job_run.sections) == 1:
+        job, r_threads = job_run.sections[0]
+        job_run.message = mailer.render_threads(
+            r_threads=r_threads,
+            subreddit=job.subreddit,
+            job_view_url=get_job_url_by_job_key(job.job_key),
+        )
+    else:
+        job_run.message = mailer.render_digest([
+            {
+                'subreddit': job.subreddit,
+                'r_threads': r_threads,
+                'job_view_url': get_job_url_by_job_key(job.job_key),
+            }
+            for job, r_threads in job_run.sections
+        ])
+
+    job_run.render_seconds = time.monotonic() - start
+
+    _report_progress(
+        [job.job_key for job in job_run.jobs], PROGRESS_RENDERED
+    )
+
+    return job_run
+
+@_job_run_stage
+def _send_job_run(job_run):
+    job_keys = [job.job_key for job in job_run.jobs]
+    start = time.monotonic()
+
+    if outbox_delivery is not None:
+        queued = _enqueue_job_run(job_run)
+        job_run.send_seconds = time.monotonic() - start
+        if queued:
+            job_run.outcome = OUTCOME_QUEUED
+            _save_digests(job_run)
+        else:
+            job_run.outcome = OUTCOME_SKIPPED
+            job_run.error = "Already sent"
+        _record_job_run(job_run)
+        _report_progress(
+            job_keys,
+            PROGRESS_QUEUED_FOR_DELIVERY if queued else PROGRESS_ALREADY_SENT,
+        )
+        return
+
+    job_run.success = mailer.send_message(
+        job_run.message,
+        target_email=job_run.target_email,
+        subreddit=job_run.subreddit,
+    )
+    job_run.send_seconds = time.monotonic() - start
+    if job_run.success:
+        job_run.outcome = OUTCOME_SENT
+        _save_digests(job_run)
+    else:
+        job_run.outcome = OUTCOME_FAILED
+        job_run.error = "Send failed"
+    _record_job_run(job_run)
+
+    _report_progress(
+        job_keys, PROGRESS_SENT if job_run.success else PROGRESS_FAILED
+    )
+
+def _enqueue_job_run(job_run):
+    queued = outbox.enqueue(
+        job_run.idempotency_key,
+        target_email=job_run.target_email,
+        subreddit=job_run.subreddit,
+        message=job_run.message,
+    )
+
+    if queued:
+        outbox_delivery.wake()
+    else:
+        logger.info("Skipped {}, as its email was already queued".format(job_run))
+
+    return queued
+
+def _build_pipeline(pipeline_settings=None):
+    """Build the fetch/render/send pipeline.
+
+    Stages run inline in the calling thread unless pipeline settings are
+    given, in which case each stage gets its own pool of worker threads.
+    """
+    threaded = pipeline_settings is not None
+    pipeline_settings = pipeline_settings or {}
+    queue_size = pipeline_settings.get('queue_size', PIPELINE_QUEUE_SIZE)
+
+    return Pipeline([
+        Stage(
+            'fetch', _fetch,
+            pipeline_settings.get('fetch_workers', 1), queue_size,
+        ),
+        Stage(
+            'render', _render_job_run,
+            pipeline_settings.get('render_workers', 1), queue_size,
+        ),
+        Stage(
+            'send', _send_job_run,
+            pipeline_settings.get('send_workers', 1), queue_size,
+        ),
+    ], threaded=threaded)
+
+pipeline = _build_pipeline()
+
+def _schedules_jobs():
+    """Whether jobs are scheduled individually in this process"""
+    return scheduler is not None and not dispatcher
+
 def schedule_job(job):
+    if not _schedules_jobs() or not owns_job_key(job.job_key):
+        return
+
     job_key = job.job_key
     job_schedules[job_key] = {
         '_handle': scheduler.add_job(
-           _run_job_by_job_key, 'cron', [job_key], **job.cron_trigger
+           _queue_job_by_job_key if batch_execution else _run_job_by_job_key,
+           'cron', _schedule_args(job), **job.cron_trigger
         )
     }
 
+def _schedule_args(job):
+    # The schedule is passed along so late runs know which minute they're for
+    return [job.job_key, job.hour, job.minute]
+
+def schedule_jobs(jobs):
+    if not _schedules_jobs():
+        return
+
+    for job in jobs:
+        schedule_job(job)
+
 def unschedule_job(job):
+    if not _schedules_jobs():
+        return
+
     job_key = job.job_key
-    job_schedule = job_schedules[job_key]
+    job_schedule = job_schedules.get(job_key)
+    if job_schedule is None:
+        # Scheduled by another partition
+        return
+
     job_schedule['_handle'].remove()
     del job_schedules[job_key]
 
 def reschedule_job(job):
+    if not _schedules_jobs():
+        return
+
     job_key = job.job_key
-    job_schedule = job_schedules[job_key]
+    job_schedule = job_schedules.get(job_key)
+    if job_schedule is None:
+        return
+
+    job_schedule['_handle'].modify(args=_schedule_args(job))
     job_schedule['_handle'].reschedule('cron', **job.cron_trigger)
 
 def start(
     initial_jobs,
     get_job_by_job_key_fn,
     get_job_url_by_job_key_fn,
+    get_jobs_by_job_keys_fn=None,
+    get_due_jobs_fn=None,
+    claim_job_keys_fn=None,
+    purge_job_claims_fn=None,
+    job_progress_fn=None,
+    record_job_runs_fn=None,
+    purge_job_runs_fn=None,
+    update_job_digests_fn=None,
+    schedule=True,
 ):
+    """Start delivering jobs, and scheduling them unless schedule is False.
+
+    A process that does not schedule jobs only runs those passed to
+    run_job or run_jobs, leaving scheduled runs to a worker process.
+
+    In dispatcher mode initial_jobs is ignored, and get_due_jobs_fn(hour,
+    minute, day_of_week) is called once a minute to find the jobs to run.
+
+    If job claims are enabled, a run is only started after
+    claim_job_keys_fn(job_keys, fire_time) returns its job key, and
+    purge_job_claims_fn(before) is called hourly to drop old claims.
+
+    job_progress_fn(job_key, status) is told how runs started by
+    run_job_now progress.
+
+    If given, record_job_runs_fn(rows) is passed the job run history rows
+    of each finished run, and purge_job_runs_fn(before) is called hourly
+    to drop old history.
+
+    update_job_digests_fn(job_digests) is passed the (job_key, thread_ids,
+    content_hash) of each sent email whose job has a digest mode.
+    """
     global mailer
     global scheduler
     global job_schedules
+    global pipeline
+    global outbox_delivery
+
+    global batch_execution
+    global consolidate_digests
+    global dispatcher
+    global job_claims
+    global partition_count
+    global partition
+    global digest_fetch_executor
+    global pending_job_keys
+    global dispatch_executor
+    global last_dispatched_fire_time
 
     global get_job_by_job_key
+    global get_jobs_by_job_keys
     global get_job_url_by_job_key
+    global get_due_jobs
+    global claim_job_keys
+    global purge_job_claims
+    global job_progress
+    global record_job_runs
+    global purge_job_runs
+    global update_job_digests
+
+    _check_settings()
 
     mailer = Mailer(
         smtp_host=settings['smtp_host'],
         smtp_timeout=settings['smtp_timeout'],
         sender_name=settings['sender_name'],
         sender_email=settings['sender_email'],
+        smtp_port=settings.get('smtp_port', 25),
+        smtp_tls=settings.get('smtp_tls', False),
+        smtp_username=secrets.get('smtp_username'),
+        smtp_password=secrets.get('smtp_password'),
+        smtp_pool_size=settings.get('smtp_pool_size', SMTP_POOL_SIZE),
+        smtp_pool_max_messages=settings.get(
+            'smtp_pool_max_messages', SMTP_POOL_MAX_MESSAGES
+        ),
     )
 
-    scheduler = BackgroundScheduler()
+    pipeline = _build_pipeline(settings.get('pipeline'))
+    pipeline.start()
 
+    if settings.get('outbox', False):
+        outbox_delivery = OutboxDelivery(
+            mailer, workers=settings.get('outbox_workers', 1),
+        )
+        outbox_delivery.start()
+    else:
+        outbox_delivery = None
+
+    scheduler = None
     job_schedules = {}
+    dispatcher = uses_dispatcher()
+    job_claims = settings.get('job_claims', False)
+    partition_count = settings.get('scheduler_partition_count', 1)
+    partition = settings.get('scheduler_partition', 0)
+
+    # Digests can only be consolidated across jobs collected together
+    consolidate_digests = settings.get('consolidate_digests', False)
+    batch_execution = (
+        settings.get('batch_execution', False) or consolidate_digests
+    )
+    digest_fetch_executor = ThreadPoolExecutor(
+        max_workers=settings.get('digest_fetch_workers', DIGEST_FETCH_WORKERS)
+    )
+    pending_job_keys = {}
+    dispatch_executor = ThreadPoolExecutor(max_workers=1)
+    last_dispatched_fire_time = None
 
     get_job_by_job_key = get_job_by_job_key_fn
+    get_jobs_by_job_keys = get_jobs_by_job_keys_fn
     get_job_url_by_job_key = get_job_url_by_job_key_fn
+    get_due_jobs = get_due_jobs_fn
+    claim_job_keys = claim_job_keys_fn
+    purge_job_claims = purge_job_claims_fn
+    job_progress = job_progress_fn
+    record_job_runs = record_job_runs_fn
+    purge_job_runs = purge_job_runs_fn
+    update_job_digests = update_job_digests_fn
 
-    for job in initial_jobs:
-        schedule_job(job)
+    if schedule:
+        start_scheduling(initial_jobs)
+
+def _check_settings():
+    """Raise ValueError if the scheduler settings can't run jobs safely"""
+    if (
+        settings.get('job_claims', False) or
+        settings.get('scheduler_partition_count', 1) > 1
+    ) and not uses_dispatcher():
+        # Per job schedules are copied into each process, and edits in one
+        # process never reach the others, so a stale copy could win a claim
+        raise ValueError(
+            "job_claims and scheduler_partition_count need scheduler_mode "
+            "to be {}".format(SCHEDULER_MODE_DISPATCHER)
+        )
+
+    partition_count = settings.get('scheduler_partition_count', 1)
+    partition = settings.get('scheduler_partition', 0)
+    if not 0 <= partition < partition_count:
+        # Otherwise this process would silently own no jobs
+        raise ValueError(
+            "scheduler_partition {} is outside the {} partitions".format(
+                partition, partition_count
+            )
+        )
+
+def start_scheduling(initial_jobs):
+    """Start firing scheduled jobs in this process, if not already started"""
+    global scheduler
+
+    if scheduler is not None:
+        return
+
+    scheduler = BackgroundScheduler()
+
+    if dispatcher:
+        # Due jobs are dispatched together, so nothing is queued. A late
+        # tick still runs, and the tick catches up on any minutes missed.
+        scheduler.add_job(
+            _dispatch_tick, 'cron', second=0,
+            misfire_grace_time=DISPATCH_MISFIRE_GRACE_TIME,
+            coalesce=True,
+            max_instances=1,
+        )
+    else:
+        schedule_jobs(initial_jobs)
+
+    if job_claims:
+        scheduler.add_job(_purge_job_claims, 'interval', hours=1)
+
+    if purge_job_runs is not None:
+        scheduler.add_job(_purge_job_runs, 'interval', hours=1)
+
+    if outbox_delivery is not None:
+        scheduler.add_job(outbox_delivery.purge_sent, 'interval', hours=1)
+
+    if mailer.smtp_pool is not None:
+        scheduler.add_job(
+            mailer.smtp_pool.keepalive, 'interval',
+            seconds=mailer.smtp_pool.keepalive_interval,
+        )
+
+    if batch_execution and not dispatcher:
+        # Jobs fire at second 0 and only queue themselves; everything
+        # queued in the same minute is then run together.
+        scheduler.add_job(
+            _run_pending_jobs, 'cron', second=BATCH_COLLECT_SECOND
+        )
 
     scheduler.start()
+
+def stop():
+    """Stop scheduling jobs and wait for runs in progress to be sent"""
+    global scheduler
+
+    if scheduler is not None:
+        scheduler.shutdown()
+        scheduler = None
+
+    dispatch_executor.shutdown()
+    pipeline.join()
+    pipeline.stop()
+
+    if outbox_delivery is not None:
+        outbox_delivery.stop()
+
+    if mailer is not None and mailer.smtp_pool is not None:
+        mailer.smtp_pool.close()
+
+    reddit.close()
@@ -0,0 +1,213 @@
+from collections import deque
+import smtplib
+import threading
+import time
+
+from rcollate import logs
+
+logger = logs.get_logger()
+
+class SMTPResponse(object):
+    """Result of a pooled send, shaped like the emails library's response"""
+
+    def __init__(self, status_code, error=None):
+        self.status_code = status_code
+        self.error = error
+
+class _PooledConnection(object):
+    def __init__(self, client):
+        self.client = client
+        self.messages_sent = 0
+        self.last_used = time.time()
+
+    def close(self):
+        try:
+            self.client.quit()
+        except (smtplib.SMTPException, OSError):
+            self.client.close()
+
+class SMTPConnectionPool(object):
+    """Reuses authenticated SMTP sessions across sends.
+
+    Can be passed as message.send(smtp=pool) since it implements the
+    sendmail interface the emails library expects. At most max_connections
+    sessions are open at once, and each is retired after
+    max_messages_per_connection sends. Sessions idle for longer than
+    keepalive_interval are checked with NOOP before reuse, and a send that
+    fails because the session was dropped is retried once on a new one.
+    """
+
+    def __init__(
+        self,
+        host,
+        port=25,
+        timeout=5,
+        use_tls=False,
+        username=None,
+        password=None,
+        max_connections=4,
+        max_messages_per_connection=100,
+        keepalive_interval=30,
+        max_idle_seconds=300,
+    ):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.use_tls = use_tls
+        self.username = username
+        self.password = password
+        self.max_connections = max_connections
+        self.max_messages_per_connection = max_messages_per_connection
+        self.keepalive_interval = keepalive_interval
+        self.max_idle_seconds = max_idle_seconds
+
+        self.connections_opened = 0
+        self.reconnects = 0
+
+        self._idle = deque()
+        self._idle_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_connections)
+
+    def sendmail(self, from_addr, to_addrs, msg, mail_options=None, rcpt_options=None):
+        if hasattr(msg, 'as_string'):
+            msg = msg.as_string()
+
+        with self._slots:
+            last_error = None
+
+            for _ in range(2):
+                try:
+                    conn = self._checkout()
+                except (smtplib.SMTPException, OSError) as e:
+                    logger.error("Error connecting to SMTP server {}:{}: {}".format(
+                        self.host, self.port, e
+                    ))
+                    return SMTPResponse(0, error=e)
+
+                try:
+                    refused = conn.client.sendmail(
+                        from_addr, to_addrs, msg,
+                        mail_options or [], rcpt_options or [],
+                    )
+                except smtplib.SMTPServerDisconnected as e:
+                    # Session went away underneath us; retry on a fresh one
+                    conn.close()
+                    self.reconnects += 1
+                    last_error = e
+                    continue
+                except smtplib.SMTPRecipientsRefused as e:
+                    # The server answered, so the session is still usable
+                    self._checkin(conn)
+                    code = min(code for code, _ in e.recipients.values())
+                    return SMTPResponse(code, error=e.recipients)
+                except smtplib.SMTPResponseException as e:
+                    # Includes SMTPSenderRefused and SMTPDataError
+                    self._checkin(conn)
+                    return SMTPResponse(e.smtp_code, error=e.smtp_error)
+                except smtplib.SMTPException as e:
+                    self._checkin(conn)
+                    return SMTPResponse(0, error=e)
+                except OSError as e:
+                    # SMTPException is an OSError, so this is only reached
+                    # by socket errors, which mean the session is gone too
+                    conn.close()
+                    self.reconnects += 1
+                    last_error = e
+                    continue
+
+                conn.messages_sent += 1
+                self._checkin(conn)
+
+                if refused:
+                    return SMTPResponse(0, error=refused)
+
+                return SMTPResponse(250)
+
+            return SMTPResponse(0, error=last_error)
+
+    def keepalive(self):
+        """NOOP idle sessions so they survive between bursts of sends.
+
+        Sessions that fail the NOOP, or have been idle for longer than
+        max_idle_seconds, are closed.
+        """
+        with self._idle_lock:
+            idle = list(self._idle)
+            self._idle.clear()
+
+        now = time.time()
+        alive = []
+
+        for conn in idle:
+            if now - conn.last_used > self.max_idle_seconds:
+                conn.close()
+            elif self._noop(conn):
+                alive.append(conn)
+
+        with self._idle_lock:
+            self._idle.extend(alive)
+
+    def close(self):
+        with self._idle_lock:
+            idle = list(self._idle)
+            self._idle.clear()
+
+        for conn in idle:
+            conn.close()
+
+    def _checkout(self):
+        while True:
+            with self._idle_lock:
+                conn = self._idle.popleft() if self._idle else None
+
+            if conn is None:
+                return self._connect()
+
+            if time.time() - conn.last_used < self.keepalive_interval:
+                return conn
+
+            if self._noop(conn):
+                return conn
+
+            self.reconnects += 1
+
+    def _checkin(self, conn):
+        if conn.messages_sent >= self.max_messages_per_connection:
+            conn.close()
+            return
+
+        conn.last_used = time.time()
+
+        with self._idle_lock:
+            self._idle.append(conn)
+
+    def _connect(self):
+        client = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+
+        try:
+            client.ehlo()
+            if self.use_tls:
+                client.starttls()
+                client.ehlo()
+            if self.username:
+                client.login(self.username, self.password)
+        except (smtplib.SMTPException, OSError):
+            client.close()
+            raise
+
+        self.connections_opened += 1
+
+        return _PooledConnection(client)
+
+    def _noop(self, conn):
+        try:
+            status, _ = conn.client.noop()
+        except (smtplib.SMTPException, OSError):
+            status = None
+
+        if status != 250:
+            conn.client.close()
+            return False
+
+        conn.last_used = time.time()
+        return True
@@ -0,0 +1,38 @@
+var RUN_PROGRESS_MESSAGES = {
+  queued: "Test email queued",
+  fetched: "Fetched top threads",
+  rendered: "Rendered test email",
+  sent: "Test email sent",
+  queued_for_delivery: "Test email queued for delivery",
+  already_sent: "Test email already sent",
+  failed: "Test email could not be sent"
+};
+
+$(document).ready(function() {
+  var socket = io.connect();
+
+  var $runStatus = $('#job-run-status');
+  var jobKey = $runStatus.data('job-key');
+
+  socket.on('connect', function() {
+    socket.emit('job_run_subscribe', {
+      job_key: jobKey
+    });
+  });
+
+  socket.on('job_run_progress', function(msg) {
+    if (msg.job_key != jobKey)
+      return;
+
+    $runStatus.text(RUN_PROGRESS_MESSAGES[msg.status] || msg.status);
+  });
+
+  // run without leaving the page, progress arrives over the socket
+  $('#job-run-form').on('submit', function(event) {
+    event.preventDefault();
+    $.post($(this).attr('action'), function(response) {
+      if (!response.started)
+        $runStatus.text("A test email is already being sent");
+    });
+  });
+});
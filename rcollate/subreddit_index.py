@@ -0,0 +1,183 @@
+import bisect
+import json
+import os
+import threading
+import time
+
+from rcollate import logs, resources
+
+INDEX_FILE_NAME = 'subreddit_index.json'
+
+# Number of matches returned for a prefix
+MATCH_LIMIT = 10
+
+# Reddit's name search returns at most this many names, so a search that
+# returned fewer holds every known subreddit starting with its query
+SEARCH_RESULT_LIMIT = 10
+
+# How long a remote search is trusted before Reddit is asked again
+SEARCHED_PREFIX_TTL = 24 * 60 * 60
+
+# Popularity added for each job subscribed to a subreddit
+JOB_WEIGHT = 10
+
+# Minimum seconds between saves of the index to disk
+SAVE_INTERVAL = 60
+
+logger = logs.get_logger()
+
+class SubredditIndex(object):
+    """In-memory prefix index of known subreddit names.
+
+    Names are kept in a sorted list so all names starting with a prefix
+    are found with two bisections, and are ranked by a popularity score
+    fed by Reddit search results and by the subreddits of existing jobs.
+    Reddit is only searched for prefixes the index cannot answer.
+    """
+
+    def __init__(self, path=None, match_limit=MATCH_LIMIT):
+        self.path = path
+        self.match_limit = match_limit
+
+        self.hits = 0
+        self.misses = 0
+
+        self._keys = []
+        self._names = {}
+        self._search_scores = {}
+        self._job_scores = {}
+        self._searched_prefixes = {}
+        self._saved_at = 0
+        self._lock = threading.RLock()
+
+    @property
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._keys),
+        }
+
+    def add(self, name, weight=1):
+        """Add popularity to a subreddit seen in search results"""
+        self._add(self._search_scores, name, weight)
+
+    def add_job_subreddit(self, name, job_count=1):
+        """Add popularity to a subreddit for its subscribed jobs.
+
+        Job popularity is rebuilt from the database on startup rather than
+        saved with the index.
+        """
+        self._add(self._job_scores, name, job_count * JOB_WEIGHT)
+
+    def _add(self, scores, name, weight):
+        key = name.lower()
+
+        with self._lock:
+            if key not in self._names:
+                bisect.insort(self._keys, key)
+
+            self._names[key] = name
+            scores[key] = scores.get(key, 0) + weight
+
+    def _score(self, key):
+        return self._search_scores.get(key, 0) + self._job_scores.get(key, 0)
+
+    def matches(self, prefix):
+        key = prefix.lower()
+
+        with self._lock:
+            start = bisect.bisect_left(self._keys, key)
+            end = bisect.bisect_left(self._keys, key + '\uffff')
+
+            ranked = sorted(
+                self._keys[start:end],
+                key=lambda match: (-self._score(match), len(match), match),
+            )
+
+            return [self._names[match] for match in ranked[:self.match_limit]]
+
+    def search(self, prefix, search_fn):
+        """Return the best matches for prefix, searching remotely on a miss.
+
+        search_fn(prefix) is only called when the index has fewer than
+        match_limit matches and no earlier complete search covers prefix.
+        """
+        if not prefix:
+            return []
+
+        matches = self.matches(prefix)
+
+        if len(matches) >= self.match_limit or self._is_covered(prefix):
+            self.hits += 1
+            return matches
+
+        self.misses += 1
+
+        names = search_fn(prefix)
+
+        with self._lock:
+            # Reddit lists more popular subreddits first
+            for rank, name in enumerate(names):
+                self.add(name, 1.0 / (rank + 1))
+
+            self._searched_prefixes[prefix.lower()] = {
+                'searched_at': time.time(),
+                'complete': len(names) < SEARCH_RESULT_LIMIT,
+            }
+
+        self.save(force=False)
+
+        return self.matches(prefix)
+
+    def load(self):
+        if self.path is None:
+            return
+
+        contents = resources.read_json_file(self.path, required=False, default={})
+
+        with self._lock:
+            for name, score in contents.get('scores', {}).items():
+                self.add(name, score)
+            self._searched_prefixes.update(contents.get('searched_prefixes', {}))
+
+        logger.info("Loaded {} subreddits into index".format(len(self._keys)))
+
+    def save(self, force=True):
+        if self.path is None:
+            return
+
+        with self._lock:
+            if not force and time.time() - self._saved_at < SAVE_INTERVAL:
+                return
+
+            self._saved_at = time.time()
+            contents = {
+                'scores': {
+                    self._names[key]: score
+                    for key, score in self._search_scores.items()
+                },
+                'searched_prefixes': self._searched_prefixes,
+            }
+
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'w') as f:
+            json.dump(contents, f)
+        os.replace(tmp_path, self.path)
+
+    def _is_covered(self, prefix):
+        key = prefix.lower()
+        now = time.time()
+
+        with self._lock:
+            for i in range(len(key), 0, -1):
+                searched = self._searched_prefixes.get(key[:i])
+                if searched is None:
+                    continue
+                if now - searched['searched_at'] > SEARCHED_PREFIX_TTL:
+                    continue
+                # An incomplete search only answers its own prefix
+                if i == len(key) or searched['complete']:
+                    return True
+
+        return False
@@ -0,0 +1,72 @@
+import signal
+import sys
+import threading
+
+from rcollate import logs, metrics, scheduler
+from rcollate.config import settings
+import rcollate.rcollate as rcollate
+
+logger = logs.get_logger()
+
+def check_settings():
+    """Return why the worker can't run with the current settings, or None.
+
+    Web processes only stop scheduling jobs once embedded_scheduler is
+    turned off, and only dispatcher mode sees jobs created, edited or
+    deleted by other processes.
+    """
+    if settings.get('embedded_scheduler', True):
+        return (
+            "embedded_scheduler must be false when running rcollate-worker, "
+            "or web processes will send every email again"
+        )
+    if not scheduler.uses_dispatcher():
+        return (
+            "scheduler_mode must be dispatcher when running rcollate-worker, "
+            "or it won't see jobs changed through the web app"
+        )
+    return None
+
+def run(stopping):
+    """Schedule and deliver jobs until stopping is set.
+
+    Returns False without starting if check_settings finds a problem.
+    """
+    error = check_settings()
+    if error is not None:
+        logger.error("Not starting worker: {}".format(error))
+        return False
+
+    rcollate.create_app(schedule=True)
+
+    metrics_server = None
+    if settings.get('worker_metrics_port') is not None:
+        metrics_server = metrics.serve(settings['worker_metrics_port'])
+
+    logger.info("Worker started")
+
+    while not stopping.is_set():
+        stopping.wait(60)
+
+    logger.info("Worker stopping")
+    if metrics_server is not None:
+        metrics_server.shutdown()
+        metrics_server.server_close()
+    scheduler.stop()
+
+    return True
+
+def main():
+    """Entry point of rcollate-worker, which runs jobs without the web app"""
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        stopping.set()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    return 0 if run(stopping) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,6 @@
+from rcollate import create_app, socketio
+
+app = create_app()
+
+if __name__ == '__main__':
+    socketio.run(app)
@@ -16,4 +16,13 @@ setup(
         'praw==4.5.1',
         'sqlalchemy',
     ],
+    extras_require={
+        'async': ['aiohttp'],
+    },
+    entry_points={
+        'console_scripts': [
+            'rcollate-worker = rcollate.worker:main',
+            'rcollate-jobs = rcollate.jobs_cli:main',
+        ],
+    },
 )
@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from sqlalchemy.exc import OperationalError
+
+from rcollate import cache
+
+class TwoTierCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.tmp_dir, 'cache.db')
+        self.cache = self.new_cache()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def new_cache(self, ttl=60, max_entries=2):
+        return cache.TwoTierCache(
+            namespace='test',
+            ttl=ttl,
+            max_entries=max_entries,
+            db_file=self.db_file,
+        )
+
+    def test_miss(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.stats['misses'], 1)
+
+    def test_memory_hit(self):
+        self.cache.set('a', [1, 2])
+        self.assertEqual(self.cache.get('a'), [1, 2])
+        self.assertEqual(self.cache.stats['hits'], 1)
+
+    def test_persistent_hit(self):
+        self.cache.set('a', {'b': 1})
+
+        other_process_cache = self.new_cache()
+        self.assertEqual(other_process_cache.get('a'), {'b': 1})
+        self.assertEqual(other_process_cache.stats['persistent_hits'], 1)
+
+        # Promoted into the memory tier
+        other_process_cache.get('a')
+        self.assertEqual(other_process_cache.stats['hits'], 1)
+
+    def test_lru_eviction(self):
+        memory_only_cache = cache.TwoTierCache('test', 60, 2)
+        memory_only_cache.set('a', 1)
+        memory_only_cache.set('b', 2)
+        memory_only_cache.get('a')
+        memory_only_cache.set('c', 3)
+
+        self.assertEqual(memory_only_cache.get('a'), 1)
+        self.assertIsNone(memory_only_cache.get('b'))
+        self.assertEqual(memory_only_cache.get('c'), 3)
+
+    def test_expiry(self):
+        self.cache.set('a', 1)
+
+        with patch('rcollate.cache.time.time', return_value=2**40):
+            self.assertIsNone(self.cache.get('a'))
+
+    def test_accept(self):
+        self.cache.set('a', 1)
+        self.assertIsNone(self.cache.get('a', accept=lambda value: value > 1))
+        self.assertEqual(self.cache.stats['misses'], 1)
+
+    def test_peek(self):
+        self.assertIsNone(self.cache.peek('a'))
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.peek('a'), 1)
+        self.assertEqual(self.cache.stats['hits'], 0)
+        self.assertEqual(self.cache.stats['misses'], 0)
+
+    def test_sqlite_pragmas(self):
+        self.cache.set('a', 1)
+        engine = self.cache._get_engine()
+
+        self.assertEqual(engine.execute('PRAGMA journal_mode').scalar(), 'wal')
+        self.assertEqual(engine.execute('PRAGMA busy_timeout').scalar(), 5000)
+
+    def test_corrupt_database(self):
+        with open(self.db_file, 'w') as f:
+            f.write('not a database')
+
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.cache.clear()
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_purge_failure(self):
+        self.cache.set('a', 1)
+
+        with patch.object(
+            self.cache._get_engine(), 'execute',
+            side_effect=OperationalError('DELETE', {}, 'database is locked'),
+        ):
+            self.cache.purge_expired()
+            self.cache.clear()
+
+    def test_disabled(self):
+        disabled_cache = self.new_cache(ttl=0)
+        disabled_cache.set('a', 1)
+        self.assertIsNone(disabled_cache.get('a'))
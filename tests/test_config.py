@@ -1,4 +1,6 @@
+import os
 import unittest
+from unittest.mock import patch
 
 from rcollate import config
 
@@ -9,3 +11,19 @@ class ConfigTest(unittest.TestCase):
                 'config/tests_config/settings_invalid.json',
                 config.SETTINGS_SCHEMA
             )
+
+    @patch.dict(os.environ, {'CONFIG_DIR': 'config/tests_config'})
+    def test_lazy_config(self):
+        settings = config.LazyConfig('settings.json', config.SETTINGS_SCHEMA)
+        self.assertIsNone(settings._contents)
+
+        self.assertEqual(settings['smtp_host'], 'localhost')
+        self.assertEqual(settings.get('smtp_port', 25), 25)
+        self.assertIn('db_file', settings)
+
+    @patch.dict(os.environ, {'CONFIG_DIR': 'config/missing_config'})
+    def test_lazy_config_missing(self):
+        settings = config.LazyConfig('settings.json', config.SETTINGS_SCHEMA)
+
+        with self.assertRaises(SystemExit):
+            settings['smtp_host']
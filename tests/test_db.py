@@ -0,0 +1,341 @@
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from sqlalchemy import create_engine
+
+from rcollate import cache, db
+from rcollate.models import Job
+from rcollate.subreddit_index import INDEX_FILE_NAME
+
+class TempDataDir(object):
+    """Keeps the files rcollate puts next to db_file in a temporary directory.
+
+    For the setUpModule and tearDownModule of test modules using the
+    persistent caches or the app's subreddit index.
+    """
+
+    def __init__(self):
+        self.path = None
+        self._patchers = []
+
+    def start(self):
+        self.path = tempfile.mkdtemp()
+        self._patchers = [
+            patch(
+                'rcollate.cache.cache_db_file',
+                return_value=os.path.join(self.path, cache.CACHE_FILE_NAME),
+            ),
+            patch(
+                'rcollate.rcollate.subreddit_index_file',
+                return_value=os.path.join(self.path, INDEX_FILE_NAME),
+            ),
+        ]
+        for patcher in self._patchers:
+            patcher.start()
+
+    def stop(self):
+        for patcher in self._patchers:
+            patcher.stop()
+        shutil.rmtree(self.path)
+
+class DBTestCase(unittest.TestCase):
+    def setUp(self):
+        db.init()
+        self.db_conn = db.open_conn()
+
+    def tearDown(self):
+        for job in db.get_jobs(self.db_conn).values():
+            db.delete_job(self.db_conn, job.job_key)
+        db.close_conn(self.db_conn)
+
+    def insert_job(self, subreddit, cron_trigger):
+        return db.insert_job(self.db_conn, Job(
+            subreddit=subreddit,
+            target_email='test@test.com',
+            cron_trigger=cron_trigger,
+        ))
+
+class GetDueJobsTest(DBTestCase):
+    def test_get_due_jobs(self):
+        self.insert_job('a', {'hour': 7, 'minute': 15})
+        self.insert_job('b', {'hour': 7, 'minute': 15, 'day_of_week': 'mon'})
+        self.insert_job('c', {'hour': 7, 'minute': 30})
+        self.insert_job('d', {'hour': 8, 'minute': 15})
+
+        self.assertEqual(
+            sorted(job.subreddit for job in db.get_due_jobs(self.db_conn, 7, 15)),
+            ['a', 'b'],
+        )
+        self.assertEqual(
+            [job.subreddit for job in db.get_due_jobs(self.db_conn, 7, 15, 'tue')],
+            ['a'],
+        )
+
+    def test_cron_trigger_round_trip(self):
+        job_key = self.insert_job('a', {'hour': 7, 'minute': 15}).job_key
+        self.db_conn.expire_all()
+
+        self.assertEqual(
+            db.get_job(self.db_conn, job_key).cron_trigger,
+            {'hour': 7, 'minute': 15},
+        )
+
+    @patch('rcollate.db.IN_QUERY_BATCH_SIZE', 2)
+    def test_get_jobs_by_job_keys_batched(self):
+        job_keys = [
+            self.insert_job(subreddit, {'hour': 7}).job_key
+            for subreddit in 'abcde'
+        ]
+
+        self.assertEqual(
+            sorted(job.subreddit for job in db.get_jobs_by_job_keys(
+                self.db_conn, job_keys[:4] + ['missing']
+            )),
+            ['a', 'b', 'c', 'd'],
+        )
+
+class GetJobsPageTest(DBTestCase):
+    def test_get_jobs_page(self):
+        for subreddit in 'abcde':
+            self.insert_job(subreddit, {'hour': 7})
+
+        first_page = db.get_jobs_page(self.db_conn, limit=2)
+        self.assertEqual([job.subreddit for job in first_page], ['a', 'b'])
+
+        second_page = db.get_jobs_page(
+            self.db_conn, after_job_id=first_page[-1].job_id, limit=2
+        )
+        self.assertEqual([job.subreddit for job in second_page], ['c', 'd'])
+
+    def test_get_jobs_page_filtered(self):
+        self.insert_job('hello', {'hour': 7, 'minute': 15})
+        self.insert_job('hello', {'hour': 7, 'minute': 30})
+        self.insert_job('world', {'hour': 7, 'minute': 15})
+
+        self.assertEqual(
+            [job.minute for job in db.get_jobs_page(self.db_conn, subreddit='hello')],
+            [15, 30],
+        )
+        self.assertEqual(
+            [job.subreddit for job in db.get_jobs_page(self.db_conn, minute=15)],
+            ['hello', 'world'],
+        )
+        self.assertEqual(
+            len(db.get_jobs_page(self.db_conn, target_email='test@test.com')), 3
+        )
+
+    def test_iter_jobs(self):
+        for subreddit in 'abcde':
+            self.insert_job(subreddit, {'hour': 7})
+
+        self.assertEqual(
+            [job.subreddit for job in db.iter_jobs(self.db_conn, batch_size=2)],
+            list('abcde'),
+        )
+
+class InsertJobsTest(DBTestCase):
+    def test_get_new_job_keys(self):
+        existing_job_key = self.insert_job('a', {'hour': 7}).job_key
+        random_job_keys = [existing_job_key, 'b' * 20, 'c' * 20]
+
+        with patch('rcollate.db._random_job_key', lambda: random_job_keys.pop(0)):
+            self.assertEqual(
+                db.get_new_job_keys(self.db_conn, 2), {'b' * 20, 'c' * 20}
+            )
+
+    def test_insert_jobs(self):
+        jobs = db.insert_jobs(self.db_conn, [
+            Job('a', 'test@test.com', {'hour': 7}, job_key='k' * 20),
+            Job('b', 'test@test.com', {'hour': 8, 'day_of_week': 'mon'}),
+        ])
+
+        self.assertEqual(jobs[0].job_key, 'k' * 20)
+        self.assertEqual(len(jobs[1].job_key), db.JOB_KEY_LENGTH)
+        self.assertEqual(
+            db.get_job(self.db_conn, jobs[1].job_key).cron_trigger,
+            {'hour': 8, 'minute': 0, 'day_of_week': 'mon'},
+        )
+
+    def test_update_job_digests(self):
+        job = db.insert_jobs(self.db_conn, [
+            Job('a', 'test@test.com', {'hour': 7}, digest_mode='new_only'),
+        ])[0]
+
+        db.update_job_digests(self.db_conn, [(job.job_key, ['/a', '/b'], 'hash')])
+
+        job = db.get_job(self.db_conn, job.job_key)
+        self.assertEqual(job.digest_mode, 'new_only')
+        self.assertEqual(job.last_thread_ids, ['/a', '/b'])
+        self.assertEqual(job.last_content_hash, 'hash')
+
+class JobRunsTest(DBTestCase):
+    def setUp(self):
+        super().setUp()
+        db.purge_job_runs(self.db_conn, float('inf'))
+
+    def tearDown(self):
+        db.purge_job_runs(self.db_conn, float('inf'))
+        super().tearDown()
+
+    def insert_job_run(self, subreddit, started_at, fetch_seconds, outcome='sent'):
+        db.insert_job_runs(self.db_conn, [{
+            'job_key': 'a',
+            'subreddit': subreddit,
+            'fire_time': 60,
+            'started_at': started_at,
+            'lag_seconds': None,
+            'fetch_seconds': fetch_seconds,
+            'render_seconds': 0.1,
+            'send_seconds': None if outcome == 'failed' else 0.2,
+            'thread_count': 10,
+            'message_size': 1000,
+            'outcome': outcome,
+            'error': None,
+        }])
+
+    def test_get_job_run_percentiles(self):
+        for i in range(1, 101):
+            self.insert_job_run('hello', 100, float(i))
+        self.insert_job_run('hello', 10, 1000.0)
+
+        percentiles = db.get_job_run_percentiles(self.db_conn, since=100)
+
+        self.assertEqual(list(percentiles), list(db.JOB_RUN_STAGES))
+        self.assertEqual(
+            percentiles['fetch'], {'count': 100, 50: 50.0, 95: 95.0, 99: 99.0}
+        )
+        self.assertEqual(percentiles['lag'], {'count': 0, 50: None, 95: None, 99: None})
+
+    def test_get_slowest_subreddits(self):
+        self.insert_job_run('fast', 100, 1.0)
+        self.insert_job_run('slow', 100, 3.0)
+        self.insert_job_run('slow', 100, 5.0, outcome='failed')
+
+        slowest = db.get_slowest_subreddits(self.db_conn, since=100)
+
+        self.assertEqual([row['subreddit'] for row in slowest], ['slow', 'fast'])
+        self.assertEqual(slowest[0]['runs'], 2)
+        self.assertAlmostEqual(slowest[0]['max_seconds'], 5.1)
+        self.assertEqual(
+            db.get_job_run_outcomes(self.db_conn, since=100),
+            {'sent': 2, 'failed': 1},
+        )
+
+    def test_purge_job_runs(self):
+        self.insert_job_run('hello', 100, 1.0)
+        self.insert_job_run('hello', 200, 1.0)
+
+        db.purge_job_runs(self.db_conn, 150)
+
+        self.assertEqual(db.get_job_run_outcomes(self.db_conn, since=0), {'sent': 1})
+
+class MigrationTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.db_file = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.engine = create_engine('sqlite:///{}'.format(self.db_file))
+
+    def tearDown(self):
+        self.engine.dispose()
+        os.remove(self.db_file)
+
+    def test_migrate_pickled_cron_triggers(self):
+        self.engine.execute(
+            'CREATE TABLE jobs (subreddit VARCHAR NOT NULL, '
+            'target_email VARCHAR NOT NULL, cron_trigger BLOB NOT NULL, '
+            'thread_limit INTEGER NOT NULL, time_filter VARCHAR NOT NULL, '
+            'job_id INTEGER NOT NULL PRIMARY KEY, job_key VARCHAR NOT NULL)'
+        )
+        self.engine.execute(
+            'INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?)',
+            ('hello', 'test@test.com', pickle.dumps({'hour': 6}),
+             10, 'day', 1, 'key1'),
+        )
+        self.engine.execute(
+            'INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?)',
+            ('world', 'test@test.com', pickle.dumps({'hour': 7, 'minute': 30}),
+             5, 'week', 2, 'key2'),
+        )
+
+        with patch('rcollate.db.engine', self.engine):
+            db.init()
+            # Running again is a no-op
+            db.init()
+
+        rows = self.engine.execute(
+            'SELECT job_key, hour, minute, day_of_week, thread_limit '
+            'FROM jobs ORDER BY job_id'
+        ).fetchall()
+
+        self.assertEqual([tuple(row) for row in rows], [
+            ('key1', 6, 0, None, 10),
+            ('key2', 7, 30, None, 5),
+        ])
+
+class EngineTest(unittest.TestCase):
+    def test_sqlite_pragmas(self):
+        with db.get_engine().connect() as conn:
+            self.assertEqual(conn.execute('PRAGMA journal_mode').scalar(), 'wal')
+            self.assertEqual(conn.execute('PRAGMA synchronous').scalar(), 1)
+            self.assertEqual(conn.execute('PRAGMA busy_timeout').scalar(), 5000)
+
+    @patch.dict('rcollate.config.settings', {'sqlite': {'busy_timeout': 100}})
+    def test_sqlite_pragma_settings(self):
+        self.assertEqual(db._sqlite_pragmas()['busy_timeout'], 100)
+        self.assertEqual(db._sqlite_pragmas()['journal_mode'], 'wal')
+
+    @patch.dict('rcollate.config.settings', {'db_url': 'sqlite://'})
+    def test_db_url(self):
+        engine = db._create_engine()
+
+        self.assertEqual(engine.url.database, None)
+        self.assertEqual(engine.execute('SELECT 1').scalar(), 1)
+
+class JobClaimsTest(DBTestCase):
+    def tearDown(self):
+        db.purge_job_claims(self.db_conn, float('inf'))
+
+        super().tearDown()
+
+    def test_claim_job_keys(self):
+        self.assertEqual(
+            db.claim_job_keys(self.db_conn, ['a', 'b'], 60, 'host1'),
+            ['a', 'b'],
+        )
+
+        other_conn = db.open_conn()
+        try:
+            self.assertEqual(
+                db.claim_job_keys(other_conn, ['a', 'b', 'c'], 60, 'host2'),
+                ['c'],
+            )
+            # Later runs of the same job can be claimed again
+            self.assertEqual(
+                db.claim_job_keys(other_conn, ['a'], 120, 'host2'),
+                ['a'],
+            )
+        finally:
+            db.close_conn(other_conn)
+
+    @patch('rcollate.db.CLAIM_BATCH_SIZE', 2)
+    @patch('rcollate.db.IN_QUERY_BATCH_SIZE', 2)
+    def test_claim_job_keys_batched(self):
+        job_keys = ['key{}'.format(i) for i in range(5)]
+        db.claim_job_keys(self.db_conn, job_keys[:2], 180, 'host1')
+
+        self.assertEqual(
+            db.claim_job_keys(self.db_conn, job_keys, 180, 'host1'), job_keys[2:],
+        )
+
+    def test_purge_job_claims(self):
+        db.claim_job_keys(self.db_conn, ['a'], 60, 'host1')
+        db.purge_job_claims(self.db_conn, 120)
+
+        self.assertEqual(
+            db.claim_job_keys(self.db_conn, ['a'], 60, 'host1'),
+            ['a'],
+        )
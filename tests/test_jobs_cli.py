@@ -0,0 +1,56 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from rcollate import jobs_cli
+import rcollate
+from test_db import TempDataDir
+
+def mock_subreddits_exist(subreddits):
+    return {subreddit: True for subreddit in subreddits}
+
+temp_data_dir = TempDataDir()
+
+def setUpModule():
+    temp_data_dir.start()
+
+def tearDownModule():
+    temp_data_dir.stop()
+
+@patch('rcollate.reddit.subreddits_exist', mock_subreddits_exist)
+class JobsCliTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        with rcollate.app.app_context():
+            db_conn = rcollate.rcollate.get_db_conn()
+            for job in rcollate.db.get_jobs(db_conn).values():
+                rcollate.db.delete_job(db_conn, job.job_key)
+
+        self.dir.cleanup()
+
+    @patch('rcollate.rcollate.delivery_started', False)
+    @patch('rcollate.scheduler.start')
+    def test_import_export(self, mock_scheduler_start):
+        import_file = os.path.join(self.dir.name, 'import.csv')
+        with open(import_file, 'w') as f:
+            f.write('subreddit,target_email,hour,minute\n')
+            f.write('hello,a@test.com,7,15\n')
+            f.write('world,b@test.com,8,0\n')
+
+        self.assertEqual(jobs_cli.main(['import', import_file]), 0)
+
+        export_file = os.path.join(self.dir.name, 'export.jsonl')
+        self.assertEqual(
+            jobs_cli.main(['export', export_file, '--subreddit', 'hello']), 0
+        )
+
+        with open(export_file) as f:
+            lines = f.readlines()
+        self.assertEqual(len(lines), 1)
+        self.assertIn('"minute": 15', lines[0])
+
+        # Reading and writing jobs doesn't start delivering emails
+        self.assertEqual(mock_scheduler_start.call_count, 0)
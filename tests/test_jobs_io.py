@@ -0,0 +1,127 @@
+import unittest
+from unittest.mock import patch
+
+from rcollate import jobs_io
+from rcollate.models import Job
+
+def mock_subreddits_exist(subreddits):
+    return {subreddit: subreddit != 'missing' for subreddit in subreddits}
+
+class ParseJobTest(unittest.TestCase):
+    def test_parse_job(self):
+        job = jobs_io.parse_job({
+            'subreddit': 'hello',
+            'target_email': 'test@test.com',
+            'hour': '7',
+            'minute': '',
+            'day_of_week': 'mon',
+        })
+
+        self.assertEqual(job.cron_trigger, {'hour': 7, 'minute': 0, 'day_of_week': 'mon'})
+        self.assertEqual(job.thread_limit, jobs_io.DEFAULT_THREAD_LIMIT)
+        self.assertEqual(job.time_filter, jobs_io.DEFAULT_TIME_FILTER)
+        self.assertIsNone(job.job_key)
+
+    def test_parse_invalid_job(self):
+        valid_row = {'subreddit': 'hello', 'target_email': 'test@test.com', 'hour': 7}
+
+        for changes in [
+            {'subreddit': ''},
+            {'target_email': 'test'},
+            {'hour': None},
+            {'hour': 24},
+            {'minute': 'x'},
+            {'day_of_week': 'monday'},
+            {'time_filter': 'decade'},
+            {'subreddit': 'not a subreddit'},
+            {'subreddit': '/r/hello'},
+        ]:
+            row = dict(valid_row)
+            row.update(changes)
+            with self.assertRaises(ValueError):
+                jobs_io.parse_job(row)
+
+    def test_parse_wrong_types(self):
+        valid_row = {'subreddit': 'hello', 'target_email': 'test@test.com', 'hour': 7}
+
+        for changes in [
+            {'subreddit': 5},
+            {'subreddit': ['hello']},
+            {'target_email': 5},
+            {'hour': 7.5},
+            {'hour': True},
+            {'hour': [7]},
+            {'minute': {}},
+            {'day_of_week': 1},
+            {'thread_limit': '10.0'},
+            {'time_filter': ['day']},
+            {'digest_mode': 1},
+            {'job_key': 123},
+        ]:
+            row = dict(valid_row)
+            row.update(changes)
+            with self.assertRaises(ValueError):
+                jobs_io.parse_job(row)
+
+class ReadRowsTest(unittest.TestCase):
+    def test_read_csv(self):
+        rows = list(jobs_io.read_rows(
+            ['subreddit,hour\n', 'hello,7\n', 'world,8\n'], 'csv'
+        ))
+        self.assertEqual(rows, [
+            (2, {'subreddit': 'hello', 'hour': '7'}),
+            (3, {'subreddit': 'world', 'hour': '8'}),
+        ])
+
+    def test_read_jsonl(self):
+        rows = list(jobs_io.read_rows(['{"hour": 7}\n', '\n', '{\n'], 'jsonl'))
+        self.assertEqual(rows[0], (1, {'hour': 7}))
+        self.assertEqual(rows[1][0], 3)
+        self.assertIsInstance(rows[1][1], ValueError)
+
+@patch('rcollate.reddit.subreddits_exist', mock_subreddits_exist)
+class ImportJobsTest(unittest.TestCase):
+    @patch('rcollate.db.insert_jobs')
+    @patch('rcollate.db.find_existing_job_keys')
+    def test_import_jobs(self, mock_find_existing_job_keys, mock_insert_jobs):
+        mock_find_existing_job_keys.return_value = set()
+        mock_insert_jobs.side_effect = lambda db_conn, jobs: jobs
+
+        jobs, errors = jobs_io.import_jobs(None, [
+            (1, {'subreddit': 'hello', 'target_email': 'a@test.com', 'hour': 7}),
+            (2, {'subreddit': 'world', 'target_email': 'b@test.com', 'hour': 8}),
+        ])
+
+        self.assertEqual(errors, [])
+        self.assertEqual([job.subreddit for job in jobs], ['hello', 'world'])
+        self.assertEqual(mock_insert_jobs.call_count, 1)
+
+    @patch('rcollate.db.insert_jobs')
+    @patch('rcollate.db.find_existing_job_keys')
+    def test_import_invalid_jobs(self, mock_find_existing_job_keys, mock_insert_jobs):
+        mock_find_existing_job_keys.return_value = {'used'}
+
+        jobs, errors = jobs_io.import_jobs(None, [
+            (1, {'subreddit': 'missing', 'target_email': 'a@test.com', 'hour': 7}),
+            (2, {'subreddit': 'hello', 'target_email': 'a@test.com', 'hour': 7, 'job_key': 'used'}),
+            (3, {'subreddit': 'hello', 'target_email': 'a@test.com', 'hour': 7, 'job_key': 'new'}),
+            (4, {'subreddit': 'hello', 'target_email': 'a@test.com', 'hour': 7, 'job_key': 'new'}),
+            (5, {'subreddit': 'hello', 'target_email': 'a@test.com'}),
+            (6, ValueError('Expecting value')),
+        ])
+
+        self.assertEqual(jobs, [])
+        self.assertEqual([line_number for line_number, _ in errors], [1, 2, 4, 5, 6])
+        self.assertEqual(mock_insert_jobs.call_count, 0)
+
+class ExportJobsTest(unittest.TestCase):
+    def test_export_round_trip(self):
+        job = Job('hello', 'a@test.com', {'hour': 7, 'minute': 30}, job_key='a')
+
+        for format in jobs_io.FORMATS:
+            lines = list(jobs_io.export_jobs([job], format))
+            (_, row), = jobs_io.read_rows(lines, format)
+            imported_job = jobs_io.parse_job(row)
+
+            self.assertEqual(imported_job.job_key, 'a')
+            self.assertEqual(imported_job.cron_trigger, job.cron_trigger)
@@ -2,6 +2,8 @@ import unittest
 from unittest.mock import patch
 
 from rcollate.mailer import Mailer
+from rcollate.reddit import SubredditThread
+from rcollate.smtp_pool import SMTPConnectionPool
 
 class ResponseMock(object):
     def __init__(self, status_code):
@@ -20,6 +22,12 @@ class InvalidMessageMock(MessageMock):
     def send(self, *args, **kwargs):
         return ResponseMock(0)
 
+class PoolCheckingMessageMock(MessageMock):
+    def send(self, *args, **kwargs):
+        if isinstance(kwargs['smtp'], SMTPConnectionPool):
+            return ResponseMock(250)
+        return ResponseMock(0)
+
 class MailerTest(unittest.TestCase):
     def setUp(self):
         self.mailer = Mailer(
@@ -50,3 +58,58 @@ class MailerTest(unittest.TestCase):
         )
 
         self.assertFalse(success)
+
+    @patch('rcollate.mailer.emails.html', InvalidMessageMock)
+    def test_deliver_error(self):
+        message = self.mailer.build_message('subject', '<p>html</p>')
+
+        success, error = self.mailer.deliver(message, 'test2@test.com', 'test')
+
+        self.assertFalse(success)
+        self.assertIn('status_code=', error)
+
+    @patch('rcollate.mailer.emails.html', PoolCheckingMessageMock)
+    def test_pooled_send(self):
+        mailer = Mailer(
+            smtp_host='localhost',
+            smtp_timeout=5,
+            sender_name='TEST',
+            sender_email='test@test.com',
+            smtp_pool_size=2,
+        )
+
+        success = mailer.send_threads(
+            r_threads=[],
+            target_email='test2@test.com',
+            subreddit='test',
+            job_view_url='test',
+        )
+
+        self.assertTrue(success)
+
+    @patch('rcollate.mailer.emails.html')
+    def test_render_digest(self, mock_html):
+        self.mailer.render_digest([
+            {'subreddit': 'a', 'r_threads': [], 'job_view_url': 'url_a'},
+            {'subreddit': 'b', 'r_threads': [], 'job_view_url': 'url_b'},
+            {'subreddit': 'c', 'r_threads': [], 'job_view_url': 'url_c'},
+        ])
+
+        kwargs = mock_html.call_args[1]
+        self.assertEqual(kwargs['subject'], 'Top threads in /r/a, /r/b and /r/c')
+        self.assertIn('url_b', kwargs['html'])
+
+    @patch('rcollate.mailer.emails.html')
+    def test_render_threads_cached(self, mock_html):
+        r_threads = [SubredditThread('/r/test/1', '', 'Thread', 1, '')]
+
+        self.mailer.render_threads(r_threads, 'test', 'url_a')
+        self.mailer.render_threads(r_threads, 'test', 'url_b')
+
+        self.assertEqual(self.mailer.render_cache_misses, 1)
+        self.assertEqual(self.mailer.render_cache_hits, 1)
+
+        html_a = mock_html.call_args_list[0][1]['html']
+        html_b = mock_html.call_args_list[1][1]['html']
+        self.assertIn('url_a', html_a)
+        self.assertEqual(html_a.replace('url_a', 'url_b'), html_b)
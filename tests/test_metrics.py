@@ -0,0 +1,84 @@
+import unittest
+from urllib.request import urlopen
+
+from rcollate import metrics
+
+class CounterTest(unittest.TestCase):
+    def test_render(self):
+        counter = metrics.Counter('test_total', "Test counter", labels=['kind'])
+        counter.inc('a')
+        counter.inc('a', amount=2)
+        counter.inc('b"')
+
+        self.assertEqual(counter.render(), '\n'.join([
+            '# HELP test_total Test counter',
+            '# TYPE test_total counter',
+            'test_total{kind="a"} 3',
+            'test_total{kind="b\\""} 1',
+        ]))
+
+    def test_wrong_labels(self):
+        counter = metrics.Counter('test_total', "Test counter", labels=['kind'])
+        with self.assertRaises(ValueError):
+            counter.inc()
+
+class HistogramTest(unittest.TestCase):
+    def test_render(self):
+        histogram = metrics.Histogram('test_seconds', "Test", buckets=[1, 5])
+        for value in [0.5, 1, 3, 10]:
+            histogram.observe(value)
+
+        self.assertEqual(histogram.render().splitlines()[2:], [
+            'test_seconds_bucket{le="1.0"} 2',
+            'test_seconds_bucket{le="5.0"} 3',
+            'test_seconds_bucket{le="+Inf"} 4',
+            'test_seconds_sum 14.5',
+            'test_seconds_count 4',
+        ])
+
+    def test_time(self):
+        histogram = metrics.Histogram('test_seconds', "Test", labels=['stage'])
+        with histogram.time('fetch'):
+            pass
+
+        self.assertEqual(histogram.count('fetch'), 1)
+        self.assertEqual(histogram.count('render'), 0)
+
+class CallbackTest(unittest.TestCase):
+    def test_render(self):
+        values = {('fetch',): 2}
+        gauge = metrics.Callback(
+            'test_depth', "Test", 'gauge', lambda: values, labels=['stage']
+        )
+        self.assertEqual(gauge.render().splitlines()[2:], [
+            'test_depth{stage="fetch"} 2',
+        ])
+
+        values = None
+        self.assertEqual(len(gauge.render().splitlines()), 2)
+
+class RenderTest(unittest.TestCase):
+    def test_render_registered(self):
+        rendered = metrics.render()
+
+        for name in [
+            'rcollate_reddit_fetch_seconds',
+            'rcollate_render_seconds',
+            'rcollate_smtp_send_seconds',
+            'rcollate_db_query_seconds',
+            'rcollate_scheduler_lag_seconds',
+            'rcollate_pipeline_queue_depth',
+            'rcollate_emails_sent_total',
+            'rcollate_email_failures_total',
+            'rcollate_cache_hits_total',
+        ]:
+            self.assertIn('# TYPE {} '.format(name), rendered)
+
+    def test_serve(self):
+        server = metrics.serve(0, host='127.0.0.1')
+        try:
+            response = urlopen('http://127.0.0.1:{}/'.format(server.server_port))
+            self.assertIn(b'# TYPE', response.read())
+        finally:
+            server.shutdown()
+            server.server_close()
@@ -1,6 +1,7 @@
 import unittest
 
 from rcollate import models
+from rcollate.reddit import SubredditThread
 
 class ModelsTest(unittest.TestCase):
     def test_job_model_create_no_key(self):
@@ -14,3 +15,53 @@ class ModelsTest(unittest.TestCase):
             str(job),
             '<Job(job_key=None, subreddit=hello)>'
         )
+
+    def test_job_model_cron_trigger(self):
+        job = models.Job(
+            subreddit='hello',
+            target_email='test@test.com',
+            cron_trigger={'hour': 6},
+        )
+
+        self.assertEqual((job.hour, job.minute, job.day_of_week), (6, 0, None))
+        self.assertEqual(job.cron_trigger, {'hour': 6, 'minute': 0})
+
+        job.cron_trigger = {'hour': 7, 'minute': 15, 'day_of_week': 'mon'}
+
+        self.assertEqual(
+            job.cron_trigger,
+            {'hour': 7, 'minute': 15, 'day_of_week': 'mon'},
+        )
+        self.assertEqual(job.cron_trigger_str, '07:15AM')
+
+    def test_threads_content_hash_ignores_ups(self):
+        self.assertEqual(
+            models.threads_content_hash([SubredditThread('/a', '', 'A', 1, '')]),
+            models.threads_content_hash([SubredditThread('/a', '', 'A', 5, '')]),
+        )
+        self.assertNotEqual(
+            models.threads_content_hash([SubredditThread('/a', '', 'A', 1, '')]),
+            models.threads_content_hash([SubredditThread('/a', '', 'B', 1, '')]),
+        )
+
+    def test_job_model_digest_threads(self):
+        r_threads = [
+            SubredditThread('/a', '', 'A', 1, ''),
+            SubredditThread('/b', '', 'B', 1, ''),
+        ]
+        job = models.Job(
+            subreddit='hello',
+            target_email='test@test.com',
+            cron_trigger={'hour': 6},
+        )
+        job.last_thread_ids = ['/a']
+        job.last_content_hash = models.threads_content_hash(r_threads)
+
+        self.assertEqual(job.digest_threads(r_threads), r_threads)
+
+        job.digest_mode = models.DIGEST_MODE_SKIP_UNCHANGED
+        self.assertEqual(job.digest_threads(r_threads), [])
+        self.assertEqual(job.digest_threads(r_threads[:1]), r_threads[:1])
+
+        job.digest_mode = models.DIGEST_MODE_NEW_ONLY
+        self.assertEqual(job.digest_threads(r_threads), r_threads[1:])
@@ -0,0 +1,92 @@
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+from rcollate import db, outbox
+
+class MockMessage(object):
+    subject = 'Top threads'
+    html_body = '<p>threads</p>'
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        db.init()
+        self.db_conn = db.open_conn()
+
+        self.mailer = MagicMock()
+        self.mailer.deliver.return_value = (True, None)
+        self.delivery = outbox.OutboxDelivery(self.mailer, max_attempts=2)
+
+    def tearDown(self):
+        db.get_engine().execute(db.outbox_table.delete())
+        db.close_conn(self.db_conn)
+
+    def enqueue(self, idempotency_key='job1@60'):
+        return outbox.enqueue(
+            idempotency_key, 'test@test.com', 'hello', MockMessage(),
+        )
+
+    def get_message(self):
+        return dict(self.db_conn.execute(db.outbox_table.select()).fetchone())
+
+    def test_enqueue_idempotent(self):
+        self.assertTrue(self.enqueue())
+        self.assertFalse(self.enqueue())
+        self.assertTrue(self.enqueue('job1@120'))
+
+        self.assertEqual(db.get_outbox_counts(self.db_conn), {'pending': 2})
+
+    def test_deliver_due(self):
+        self.enqueue()
+
+        self.assertEqual(self.delivery.deliver_due(), 1)
+
+        self.mailer.build_message.assert_called_once_with(
+            'Top threads', '<p>threads</p>'
+        )
+        self.assertEqual(self.mailer.deliver.call_args[1]['target_email'], 'test@test.com')
+        self.assertEqual(self.get_message()['status'], 'sent')
+        self.assertEqual(self.delivery.stats['sent'], 1)
+
+        self.assertEqual(self.delivery.deliver_due(), 0)
+
+    def test_deliver_retry_then_dead(self):
+        self.mailer.deliver.return_value = (False, 'status_code=451')
+        self.enqueue()
+
+        self.delivery.deliver_due()
+
+        message = self.get_message()
+        self.assertEqual(message['status'], 'pending')
+        self.assertEqual(message['attempts'], 1)
+        self.assertEqual(message['last_error'], 'status_code=451')
+        self.assertGreater(message['next_attempt_at'], time.time())
+
+        # Not due again until the back off has passed
+        self.assertEqual(self.delivery.deliver_due(), 0)
+
+        with patch('rcollate.outbox.time.time', return_value=time.time() + 3600):
+            self.delivery.deliver_due()
+
+        message = self.get_message()
+        self.assertEqual(message['status'], 'dead')
+        self.assertEqual(message['attempts'], 2)
+        self.assertEqual(self.delivery.stats, {'sent': 0, 'retried': 1, 'dead': 1})
+
+    def test_claimed_messages_leased(self):
+        self.enqueue()
+
+        now = time.time()
+        claimed = db.claim_outbox_messages(self.db_conn, now, 10, 60)
+        self.assertEqual(len(claimed), 1)
+
+        # Claimed by a sender that has not finished (or has died)
+        self.assertEqual(db.claim_outbox_messages(self.db_conn, now, 10, 60), [])
+        self.assertEqual(
+            len(db.claim_outbox_messages(self.db_conn, now + 61, 10, 60)), 1
+        )
+
+    def test_backoff_seconds(self):
+        self.assertEqual(outbox.backoff_seconds(1), outbox.BACKOFF_SECONDS)
+        self.assertEqual(outbox.backoff_seconds(2), outbox.BACKOFF_SECONDS * 2)
+        self.assertEqual(outbox.backoff_seconds(50), outbox.MAX_BACKOFF_SECONDS)
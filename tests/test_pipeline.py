@@ -0,0 +1,62 @@
+import threading
+import unittest
+
+from rcollate.pipeline import Pipeline, Stage
+
+def double(x):
+    return x * 2
+
+def fan_out(x):
+    return [x, x + 1]
+
+def fail_on_odd(x):
+    if x % 2:
+        raise ValueError(x)
+    return x
+
+class PipelineTest(unittest.TestCase):
+    def build_pipeline(self, threaded):
+        self.results = []
+        self.results_lock = threading.Lock()
+
+        def collect(x):
+            with self.results_lock:
+                self.results.append(x)
+
+        return Pipeline([
+            Stage('fan_out', fan_out, workers=2, queue_size=1),
+            Stage('fail_on_odd', fail_on_odd, workers=2, queue_size=1),
+            Stage('double', double, workers=3, queue_size=1),
+            Stage('collect', collect),
+        ], threaded=threaded)
+
+    def test_inline(self):
+        pipeline = self.build_pipeline(threaded=False)
+        pipeline.submit(2)
+        pipeline.submit(4)
+
+        self.assertEqual(self.results, [4, 8])
+
+        stats = pipeline.stats
+        self.assertEqual(stats['fan_out']['processed'], 2)
+        self.assertEqual(stats['fail_on_odd']['processed'], 2)
+        self.assertEqual(stats['fail_on_odd']['failed'], 2)
+        self.assertEqual(stats['collect']['processed'], 2)
+
+    def test_threaded(self):
+        pipeline = self.build_pipeline(threaded=True)
+        pipeline.start()
+
+        for i in range(0, 20, 2):
+            pipeline.submit(i)
+
+        pipeline.join()
+        pipeline.stop()
+
+        self.assertEqual(sorted(self.results), list(range(0, 40, 4)))
+
+        stats = pipeline.stats
+        self.assertEqual(stats['double']['workers'], 3)
+        self.assertEqual(stats['double']['queue_size'], 1)
+        self.assertEqual(stats['double']['queue_depth'], 0)
+        self.assertEqual(stats['fail_on_odd']['failed'], 10)
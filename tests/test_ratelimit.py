@@ -0,0 +1,88 @@
+import threading
+import time
+import unittest
+
+from rcollate.ratelimit import (
+    PRIORITY_BACKGROUND,
+    PRIORITY_INTERACTIVE,
+    RateLimiter,
+)
+
+class RateLimiterTest(unittest.TestCase):
+    def test_burst(self):
+        rate_limiter = RateLimiter(rate=1, burst=5)
+
+        start_time = time.monotonic()
+        for _ in range(5):
+            rate_limiter.acquire()
+
+        self.assertLess(time.monotonic() - start_time, 0.5)
+        self.assertEqual(rate_limiter.stats['throttled'], 0)
+
+    def test_throttled(self):
+        rate_limiter = RateLimiter(rate=50, burst=1)
+
+        start_time = time.monotonic()
+        for _ in range(6):
+            rate_limiter.acquire()
+
+        self.assertGreaterEqual(time.monotonic() - start_time, 0.09)
+        self.assertEqual(rate_limiter.stats['requests'], 6)
+        self.assertEqual(rate_limiter.stats['throttled'], 5)
+
+    def test_priority(self):
+        rate_limiter = RateLimiter(rate=20, burst=1)
+        rate_limiter.acquire()
+
+        order = []
+
+        def acquire(name, priority):
+            rate_limiter.acquire(priority)
+            order.append(name)
+
+        threads = [
+            threading.Thread(target=acquire, args=('background', PRIORITY_BACKGROUND)),
+        ]
+        threads[0].start()
+        time.sleep(0.01)
+
+        for i in range(2):
+            threads.append(threading.Thread(
+                target=acquire, args=('interactive', PRIORITY_INTERACTIVE)
+            ))
+            threads[-1].start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(order, ['interactive', 'interactive', 'background'])
+
+    def test_server_budget_exhausted(self):
+        rate_limiter = RateLimiter(rate=1000, burst=10)
+        rate_limiter.update(remaining=0, seconds_to_reset=0.1)
+
+        start_time = time.monotonic()
+        rate_limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start_time, 0.09)
+
+    def test_back_off(self):
+        rate_limiter = RateLimiter(rate=1000, burst=10)
+        rate_limiter.back_off(retry_after=0.1)
+
+        start_time = time.monotonic()
+        rate_limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start_time, 0.09)
+        self.assertEqual(rate_limiter.stats['back_offs'], 1)
+
+    def test_back_off_grows(self):
+        rate_limiter = RateLimiter(rate=1000, burst=10)
+
+        delays = []
+        for _ in range(3):
+            delays.append(rate_limiter.back_off())
+            # The headers of the 429 itself don't count as a success
+            rate_limiter.update(remaining=10, seconds_to_reset=60, rate_limited=True)
+        self.assertEqual(delays, [2, 4, 8])
+
+        rate_limiter.update(remaining=10, seconds_to_reset=60)
+        self.assertEqual(rate_limiter.back_off(), 2)
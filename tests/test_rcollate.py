@@ -1,4 +1,10 @@
 import base64
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
 from unittest.mock import patch
 
@@ -6,6 +12,8 @@ from flask_socketio import SocketIO
 
 import rcollate
 from rcollate.reddit import Subreddit
+from rcollate.subreddit_index import INDEX_FILE_NAME, SubredditIndex
+from test_db import TempDataDir
 
 DEFAULT_CRON_TRIGGER = {'hour': 7}
 VALID_EMAIL_TIME = '7:00am'
@@ -19,8 +27,20 @@ VALID_EMAIL = 'test@test.com'
 def mock_subreddit_exists(subreddit):
     return subreddit in VALID_SUBREDDITS
 
+def mock_subreddits_exist(subreddits):
+    return {subreddit: subreddit in VALID_SUBREDDITS for subreddit in subreddits}
+
+temp_data_dir = TempDataDir()
+
+def setUpModule():
+    temp_data_dir.start()
+
+def tearDownModule():
+    temp_data_dir.stop()
+
 class RCollateTestCase(unittest.TestCase):
     def setUp(self):
+        rcollate.create_app()
         rcollate.app.testing = True
         rcollate.app.config['WTF_CSRF_ENABLED'] = False
         self.app = rcollate.app.test_client()
@@ -30,11 +50,17 @@ class RCollateTestCase(unittest.TestCase):
             mock_subreddit_exists
         )
         self.subreddit_exists_patcher.start()
+        self.subreddits_exist_patcher = patch(
+            'rcollate.reddit.subreddits_exist',
+            mock_subreddits_exist
+        )
+        self.subreddits_exist_patcher.start()
 
     def tearDown(self):
         self.clear_jobs()
 
         self.subreddit_exists_patcher.stop()
+        self.subreddits_exist_patcher.stop()
 
     def create_job(self, subreddit=VALID_SUBREDDIT, target_email=VALID_EMAIL):
         with rcollate.app.app_context():
@@ -73,6 +99,161 @@ class JobsIndexPageTest(RCollateTestCase):
         rv = self.app.get('/jobs/', headers=self.auth_headers)
         self.assertIn('Job [' + job.job_key + ']', str(rv.data))
 
+    @patch('rcollate.rcollate.JOBS_PAGE_SIZE', 1)
+    def test_pages(self):
+        first_job = self.create_job(subreddit='hello')
+        second_job = self.create_job(subreddit='world')
+
+        rv = self.app.get('/jobs/', headers=self.auth_headers)
+        self.assertIn('Job [' + first_job.job_key + ']', str(rv.data))
+        self.assertNotIn('Job [' + second_job.job_key + ']', str(rv.data))
+        self.assertIn('after=%d' % first_job.job_id, str(rv.data))
+
+        rv = self.app.get(
+            '/jobs/?after=%d' % first_job.job_id, headers=self.auth_headers
+        )
+        self.assertNotIn('Job [' + first_job.job_key + ']', str(rv.data))
+        self.assertIn('Job [' + second_job.job_key + ']', str(rv.data))
+        self.assertNotIn('Next page', str(rv.data))
+
+    def test_filter(self):
+        first_job = self.create_job(subreddit='hello')
+        second_job = self.create_job(subreddit='world')
+
+        rv = self.app.get('/jobs/?subreddit=world', headers=self.auth_headers)
+        self.assertNotIn('Job [' + first_job.job_key + ']', str(rv.data))
+        self.assertIn('Job [' + second_job.job_key + ']', str(rv.data))
+
+class JobsImportTest(RCollateTestCase):
+    def test_no_auth(self):
+        rv = self.app.post('/jobs/import/', data='')
+        self.assertEqual(rv.status_code, 401)
+
+    def test_import(self):
+        rv = self.app.post(
+            '/jobs/import/?format=jsonl',
+            data='{"subreddit": "hello", "target_email": "test@test.com", "hour": 7}\n'
+                 '{"subreddit": "world", "target_email": "test@test.com", "hour": 8}\n',
+            headers=self.auth_headers,
+        )
+
+        self.assertEqual(rv.status_code, 200)
+        with rcollate.app.app_context():
+            jobs = rcollate.db.get_jobs(rcollate.rcollate.get_db_conn())
+        self.assertEqual(
+            sorted(job.subreddit for job in jobs.values()), ['hello', 'world']
+        )
+
+    def test_import_invalid(self):
+        rv = self.app.post(
+            '/jobs/import/',
+            data='subreddit,target_email,hour\nhello,test@test.com,7\n%s,test@test.com,7\n' % (
+                INVALID_SUBREDDIT,
+            ),
+            headers=self.auth_headers,
+        )
+
+        self.assertEqual(rv.status_code, 400)
+        self.assertIn('Subreddit test not found', str(rv.data))
+        with rcollate.app.app_context():
+            self.assertEqual(rcollate.db.get_jobs(rcollate.rcollate.get_db_conn()), {})
+
+    def test_import_wrong_types(self):
+        rv = self.app.post(
+            '/jobs/import/?format=jsonl',
+            data='{"subreddit": "hello", "target_email": "test@test.com", "hour": 7}\n'
+                 '{"subreddit": 5, "target_email": "test@test.com", "hour": 7}\n'
+                 '{"subreddit": "hello", "target_email": 5, "hour": 7}\n',
+            headers=self.auth_headers,
+        )
+
+        self.assertEqual(rv.status_code, 400)
+        self.assertEqual(
+            [error['line'] for error in json.loads(rv.data.decode('utf-8'))['errors']],
+            [2, 3],
+        )
+        with rcollate.app.app_context():
+            self.assertEqual(rcollate.db.get_jobs(rcollate.rcollate.get_db_conn()), {})
+
+class JobRunsIndexPageTest(RCollateTestCase):
+    def test_no_auth(self):
+        rv = self.app.get('/jobs/runs/')
+        self.assertEqual(rv.status_code, 401)
+
+    def test_runs(self):
+        with rcollate.app.app_context():
+            rcollate.rcollate._record_job_runs([{
+                'job_key': 'a',
+                'subreddit': 'slowsubreddit',
+                'fire_time': 60,
+                'started_at': time.time(),
+                'lag_seconds': 1.5,
+                'fetch_seconds': 2.5,
+                'render_seconds': 0.1,
+                'send_seconds': 0.2,
+                'thread_count': 10,
+                'message_size': 1000,
+                'outcome': 'sent',
+                'error': None,
+            }])
+
+        rv = self.app.get('/jobs/runs/', headers=self.auth_headers)
+
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn('slowsubreddit', str(rv.data))
+        self.assertIn('2.500s', str(rv.data))
+
+        with rcollate.app.app_context():
+            rcollate.db.purge_job_runs(rcollate.rcollate.get_db_conn(), float('inf'))
+
+class MetricsTest(RCollateTestCase):
+    def test_no_auth(self):
+        rv = self.app.get('/metrics')
+        self.assertEqual(rv.status_code, 401)
+
+    def test_metrics(self):
+        self.create_job()
+        rv = self.app.get('/metrics', headers=self.auth_headers)
+
+        self.assertEqual(rv.status_code, 200)
+        self.assertTrue(rv.content_type.startswith('text/plain; version=0.0.4'))
+        self.assertRegex(
+            rv.data.decode('utf-8'), r'\nrcollate_db_query_seconds_count [1-9]'
+        )
+
+class JobsExportTest(RCollateTestCase):
+    def test_no_auth(self):
+        rv = self.app.get('/jobs/export.csv')
+        self.assertEqual(rv.status_code, 401)
+
+    def test_export(self):
+        first_job = self.create_job(subreddit='hello')
+        self.create_job(subreddit='world')
+
+        rv = self.app.get('/jobs/export.csv?subreddit=hello', headers=self.auth_headers)
+
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.mimetype, 'text/csv')
+        self.assertEqual(rv.data.decode('utf-8').splitlines(), [
+            'job_key,subreddit,target_email,hour,minute,day_of_week,thread_limit,time_filter,digest_mode',
+            '{},hello,{},7,0,,{},{},always'.format(
+                first_job.job_key, VALID_EMAIL,
+                first_job.thread_limit, first_job.time_filter,
+            ),
+        ])
+
+    def test_export_jsonl(self):
+        job = self.create_job(subreddit='hello')
+
+        rv = self.app.get('/jobs/export.jsonl', headers=self.auth_headers)
+
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn('"job_key": "{}"'.format(job.job_key), rv.data.decode('utf-8'))
+
+    def test_export_unknown_format(self):
+        rv = self.app.get('/jobs/export.xml', headers=self.auth_headers)
+        self.assertEqual(rv.status_code, 404)
+
 class JobsNewPageTest(RCollateTestCase):
     def test_get_status_code(self):
         rv = self.app.get('/jobs/new/')
@@ -113,6 +294,33 @@ class JobsShowPageTest(RCollateTestCase):
         self.assertEqual(rv.status_code, 200)
         self.assertIn(job.job_key, str(rv.data))
 
+class QueryStatsTest(RCollateTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.query_stats_patcher = patch(
+            'rcollate.rcollate.query_stats_enabled', False
+        )
+        self.query_stats_patcher.start()
+        rcollate.rcollate.enable_query_stats()
+
+    def tearDown(self):
+        self.query_stats_patcher.stop()
+
+        super().tearDown()
+
+    def test_get_valid_job_single_query(self):
+        job = self.create_job()
+        rv = self.app.get('/jobs/%s/' % job.job_key)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.headers['X-Query-Count'], '1')
+
+    def test_delete_valid_job_queries(self):
+        job = self.create_job()
+        rv = self.app.post('/jobs/%s/delete/' % job.job_key)
+        self.assertEqual(rv.status_code, 302)
+        self.assertEqual(rv.headers['X-Query-Count'], '2')
+
 class JobsDeletePageTest(RCollateTestCase):
     def test_delete_invalid_job(self):
         rv = self.app.post('/jobs/nonexistentjobkey/delete/')
@@ -163,12 +371,58 @@ class JobsRunPageTest(RCollateTestCase):
         self.assertEqual(rv.status_code, 404)
         self.assertIn('Job nonexistentjobkey not found', str(rv.data))
 
-    @patch('rcollate.scheduler.mailer.send_threads')
-    def test_post_valid_job(self, mock_send_threads):
+    @patch('rcollate.scheduler.manual_runs', new_callable=set)
+    @patch('rcollate.scheduler.manual_run_executor')
+    def test_post_valid_job(self, mock_manual_run_executor, mock_manual_runs):
         job = self.create_job()
         rv = self.app.post('/jobs/%s/run/' % job.job_key)
         self.assertEqual(rv.status_code, 302)
         self.assertIn('/jobs/%s/' % job.job_key, rv.location)
+        self.assertEqual(mock_manual_run_executor.submit.call_count, 1)
+
+    @patch('rcollate.scheduler.manual_runs', new_callable=set)
+    @patch('rcollate.scheduler.manual_run_executor')
+    def test_post_valid_job_repeated(self, mock_manual_run_executor, mock_manual_runs):
+        job = self.create_job()
+        self.app.post('/jobs/%s/run/' % job.job_key)
+        rv = self.app.post('/jobs/%s/run/' % job.job_key)
+        self.assertEqual(rv.status_code, 302)
+        with self.app.session_transaction() as session:
+            self.assertIn(
+                ('message', "A test email is already being sent"),
+                session['_flashes'],
+            )
+        self.assertEqual(mock_manual_run_executor.submit.call_count, 1)
+
+    @patch('rcollate.scheduler.manual_runs', new_callable=set)
+    @patch('rcollate.scheduler.manual_run_executor')
+    def test_post_valid_job_xhr(self, mock_manual_run_executor, mock_manual_runs):
+        job = self.create_job()
+        rv = self.app.post(
+            '/jobs/%s/run/' % job.job_key,
+            headers={'X-Requested-With': 'XMLHttpRequest'},
+        )
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(json.loads(rv.data.decode('utf-8')), {'started': True})
+        with self.app.session_transaction() as session:
+            self.assertNotIn('_flashes', session)
+
+    def test_run_progress(self):
+        client = rcollate.socketio.test_client(rcollate.app)
+        client.emit('job_run_subscribe', {'job_key': 'job1'})
+        client.get_received()
+
+        rcollate.rcollate._report_job_progress('job1', 'fetched')
+        rcollate.rcollate._report_job_progress('job2', 'fetched')
+
+        received = client.get_received()
+        client.disconnect()
+
+        self.assertEqual(received, [{
+            'name': 'job_run_progress',
+            'args': [{'job_key': 'job1', 'status': 'fetched'}],
+            'namespace': '/',
+        }])
 
 class SubredditSearchTest(RCollateTestCase):
     def mock_subreddit_search(subreddit):
@@ -179,13 +433,16 @@ class SubredditSearchTest(RCollateTestCase):
 
     @patch('rcollate.reddit.subreddit_search', mock_subreddit_search)
     def test_search(self):
-        client = rcollate.socketio.test_client(rcollate.app)
-        client.emit('subreddit_search_request', {
-            'subreddit': 'test',
-        })
-        received = client.get_received()
-        print(received)
-        client.disconnect()
+        # The app's index may have been built by another test module
+        index = SubredditIndex(os.path.join(temp_data_dir.path, INDEX_FILE_NAME))
+        with patch('rcollate.rcollate.subreddit_index', index):
+            client = rcollate.socketio.test_client(rcollate.app)
+            client.emit('subreddit_search_request', {
+                'subreddit': 'test',
+            })
+            received = client.get_received()
+            print(received)
+            client.disconnect()
 
 class HelpersTest(RCollateTestCase):
     def test_get_job_by_job_key(self):
@@ -194,3 +451,28 @@ class HelpersTest(RCollateTestCase):
             rcollate.rcollate._get_job_by_job_key(job.job_key).job_id,
             job.job_id
         )
+
+    def test_get_job_url_by_job_key(self):
+        self.assertEqual(
+            rcollate.rcollate._get_job_url_by_job_key('abc'),
+            'http://localhost:5000/jobs/abc/',
+        )
+        self.assertEqual(
+            rcollate.rcollate._get_job_url_by_job_key('def'),
+            'http://localhost:5000/jobs/def/',
+        )
+
+class ImportTest(unittest.TestCase):
+    def test_import_has_no_side_effects(self):
+        # Importing must not need config or touch the working directory
+        with tempfile.TemporaryDirectory() as cwd:
+            env = dict(os.environ, CONFIG_DIR=os.path.join(cwd, 'missing'))
+            env['PYTHONPATH'] = os.pathsep.join(sys.path)
+
+            subprocess.check_call(
+                [sys.executable, '-c', 'import rcollate, rcollate.worker'],
+                cwd=cwd,
+                env=env,
+            )
+
+            self.assertEqual(os.listdir(cwd), [])
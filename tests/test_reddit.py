@@ -1,7 +1,13 @@
+import threading
+import time
 import unittest
 from unittest.mock import patch
 
+from prawcore import ResponseException
+
 from rcollate import reddit
+from rcollate.ratelimit import PRIORITY_INTERACTIVE, RateLimiter
+from test_db import TempDataDir
 
 VALID_SUBREDDITS = ['test1', 'test2']
 VALID_SUBREDDIT = VALID_SUBREDDITS[0]
@@ -12,7 +18,7 @@ class MockPrawNotFound(Exception):
 
 class MockPrawSubreddit(object):
     def __init__(self, name, *args, **kwargs):
-        self.display_name = ''
+        self.display_name = name
         self.permalink = ''
         self.selftext = ''
         self.title = ''
@@ -32,26 +38,121 @@ class MockPrawSubreddits(object):
             raise MockPrawNotFound()
 
 class MockPraw(object):
+    def __init__(self):
+        self.info_requests = 0
+
     def subreddit(self, name, *args, **kwargs):
         return MockPrawSubreddit(name)
 
+    def get(self, path, params):
+        self.info_requests += 1
+        return [
+            MockPrawSubreddit(name.upper())
+            for name in params['sr_name'].split(',')
+            if name in VALID_SUBREDDITS
+        ]
+
     @property
     def subreddits(self):
         return MockPrawSubreddits()
 
 mock_praw = MockPraw()
 
+temp_data_dir = TempDataDir()
+
+def setUpModule():
+    temp_data_dir.start()
+    reset_caches()
+
+def tearDownModule():
+    reset_caches()
+    temp_data_dir.stop()
+
+def reset_caches():
+    # Rebuilt on next use, against cache_db_file as currently patched
+    reddit._thread_cache = None
+    reddit._subreddit_exists_cache = None
+
 class RedditTest(unittest.TestCase):
     def setUp(self):
         self.praw_patcher = patch('rcollate.reddit._reddit', mock_praw)
         self.praw_patcher.start()
 
+        reddit._get_thread_cache().clear()
+        reddit._get_subreddit_exists_cache().clear()
+        reddit._known_subreddits.clear()
+        mock_praw.info_requests = 0
+
     def tearDown(self):
         self.praw_patcher.stop()
 
     def test_top_subreddit_threads(self):
         r_threads = reddit.top_subreddit_threads('test', 'day', 10)
 
+    @patch('rcollate.reddit._fetch_top_subreddit_threads')
+    def test_top_subreddit_threads_cached(self, mock_fetch):
+        mock_fetch.return_value = [
+            reddit.SubredditThread('/r/test/1', '', 'Thread', 1, '')
+        ] * 10
+
+        self.assertEqual(len(reddit.top_subreddit_threads('test', 'day', 10)), 10)
+        self.assertEqual(len(reddit.top_subreddit_threads('Test', 'day', 5)), 5)
+        self.assertEqual(mock_fetch.call_count, 1)
+
+        reddit.top_subreddit_threads('test', 'day', 20)
+        reddit.top_subreddit_threads('test', 'week', 5)
+        self.assertEqual(mock_fetch.call_count, 3)
+
+    @patch('rcollate.reddit._fetch_top_subreddit_threads')
+    def test_top_subreddit_threads_cached_short_listing(self, mock_fetch):
+        mock_fetch.return_value = []
+
+        reddit.top_subreddit_threads('test', 'day', 10)
+        reddit.top_subreddit_threads('test', 'day', 20)
+        self.assertEqual(mock_fetch.call_count, 1)
+
+    @patch('rcollate.reddit._fetch_top_subreddit_threads')
+    def test_top_subreddit_threads_concurrent_misses(self, mock_fetch):
+        def fetch(subreddit, time_filter, thread_limit):
+            time.sleep(0.1)
+            return [reddit.SubredditThread('/r/test/1', '', 'Thread', 1, '')] * 10
+        mock_fetch.side_effect = fetch
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(
+                reddit.top_subreddit_threads('test', 'day', 10)
+            ))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(mock_fetch.call_count, 1)
+        self.assertEqual([len(r_threads) for r_threads in results], [10] * 5)
+        self.assertEqual(reddit._listing_fetch_locks, {})
+
+    def test_shorter_listing_does_not_replace_longer(self):
+        r_thread = reddit.SubredditThread('/r/test/1', '', 'Thread', 1, '')
+        reddit._set_cached_top_subreddit_threads('test', 'day', 20, [r_thread] * 20)
+        reddit._set_cached_top_subreddit_threads('test', 'day', 5, [r_thread] * 5)
+
+        cached = reddit._get_thread_cache().peek('test:day')
+        self.assertEqual(cached['thread_limit'], 20)
+        self.assertEqual(len(cached['threads']), 20)
+
+    def test_cache_hit_stats(self):
+        thread_cache = reddit._get_thread_cache()
+
+        with patch.object(thread_cache, 'hits', 3), \
+                patch.object(thread_cache, 'persistent_hits', 2):
+            stats = reddit._cache_hit_stats()
+
+        self.assertEqual(stats[('thread_cache', 'memory')], 3)
+        self.assertEqual(stats[('thread_cache', 'persistent')], 2)
+
     def test_valid_subreddit_exists(self):
         self.assertTrue(reddit.subreddit_exists(VALID_SUBREDDIT))
 
@@ -59,5 +160,164 @@ class RedditTest(unittest.TestCase):
     def test_invalid_subreddit_exists(self):
         self.assertFalse(reddit.subreddit_exists(INVALID_SUBREDDIT))
 
+    @patch('rcollate.reddit.NotFound', MockPrawNotFound)
+    @patch('rcollate.reddit._fetch_subreddit_exists')
+    def test_subreddit_exists_cached(self, mock_fetch_subreddit_exists):
+        mock_fetch_subreddit_exists.side_effect = lambda name: name in VALID_SUBREDDITS
+
+        for _ in range(2):
+            self.assertTrue(reddit.subreddit_exists(VALID_SUBREDDIT))
+            self.assertFalse(reddit.subreddit_exists(INVALID_SUBREDDIT))
+
+        self.assertEqual(mock_fetch_subreddit_exists.call_count, 2)
+
+    @patch('rcollate.reddit._fetch_subreddit_exists')
+    def test_known_subreddit_exists(self, mock_fetch_subreddit_exists):
+        reddit.add_known_subreddits(['Known'])
+
+        self.assertTrue(reddit.subreddit_exists('known'))
+        self.assertEqual(mock_fetch_subreddit_exists.call_count, 0)
+
+    def test_subreddits_exist(self):
+        reddit.add_known_subreddits(['known'])
+
+        self.assertEqual(
+            reddit.subreddits_exist(['known', 'test1', 'test2', 'test3']),
+            {'known': True, 'test1': True, 'test2': True, 'test3': False},
+        )
+        self.assertEqual(mock_praw.info_requests, 1)
+
+        reddit.subreddits_exist(['test1', 'test3'])
+        self.assertEqual(mock_praw.info_requests, 1)
+
     def test_subreddit_search(self):
         reddit.subreddit_search(VALID_SUBREDDIT)
+
+class MockAsyncBackend(object):
+    def top_subreddit_threads_many(self, listings):
+        return [
+            [{'permalink': '', 'selftext': '', 'title': '', 'ups': 0, 'url': ''}] * thread_limit
+            for _, _, thread_limit in listings
+        ]
+
+    def subreddit_exists(self, subreddit):
+        return subreddit in VALID_SUBREDDITS
+
+class MockResponse(object):
+    def __init__(self, status_code, headers):
+        self.status_code = status_code
+        self.headers = headers
+
+class MockPrawRateLimiter(object):
+    def __init__(self):
+        self.remaining = 10
+        self.reset_timestamp = time.time() + 60
+
+class MockPrawCore(object):
+    def __init__(self):
+        self._rate_limiter = MockPrawRateLimiter()
+
+class MockPrawWithRateLimit(object):
+    def __init__(self):
+        self._core = MockPrawCore()
+
+class RateLimitTest(unittest.TestCase):
+    def test_retry_after_429(self):
+        responses = [
+            ResponseException(MockResponse(429, {'retry-after': '0'})),
+            ['result'],
+        ]
+
+        def fn():
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        with patch.object(reddit._get_rate_limiter(), 'back_off') as mock_back_off:
+            self.assertEqual(
+                reddit._rate_limited(PRIORITY_INTERACTIVE, fn),
+                ['result'],
+            )
+        mock_back_off.assert_called_once_with(0.0)
+
+    @patch('rcollate.reddit._reddit', MockPrawWithRateLimit())
+    @patch('rcollate.reddit._rate_limiter', RateLimiter(rate=1000, burst=10))
+    def test_back_off_grows_across_429s(self):
+        def fn():
+            raise ResponseException(MockResponse(429, {}))
+
+        rate_limiter = reddit._get_rate_limiter()
+        back_off = rate_limiter.back_off
+        delays = []
+
+        with patch.object(rate_limiter, 'acquire'), patch.object(
+            rate_limiter, 'back_off',
+            side_effect=lambda retry_after: delays.append(back_off(retry_after)),
+        ):
+            with self.assertRaises(ResponseException):
+                reddit._rate_limited(PRIORITY_INTERACTIVE, fn)
+
+        self.assertEqual(delays, [2, 4, 8])
+
+    def test_other_errors_raised(self):
+        def fn():
+            raise ResponseException(MockResponse(500, {}))
+
+        with self.assertRaises(ResponseException):
+            reddit._rate_limited(PRIORITY_INTERACTIVE, fn)
+
+@patch('rcollate.reddit._reddit', None)
+class RedditURLTest(unittest.TestCase):
+    @patch('praw.Reddit')
+    def test_default_urls(self, mock_praw_reddit):
+        reddit._get_reddit()
+
+        self.assertEqual(mock_praw_reddit.call_args[1]['reddit_url'], reddit.REDDIT_URL)
+        self.assertEqual(mock_praw_reddit.call_args[1]['oauth_url'], reddit.OAUTH_URL)
+
+    @patch.dict('rcollate.reddit.settings', {
+        'reddit_url': 'http://127.0.0.1:8000',
+        'reddit_oauth_url': 'http://127.0.0.1:8001',
+    })
+    @patch('praw.Reddit')
+    def test_configured_urls(self, mock_praw_reddit):
+        reddit._get_reddit()
+
+        self.assertEqual(
+            mock_praw_reddit.call_args[1]['reddit_url'], 'http://127.0.0.1:8000'
+        )
+        self.assertEqual(
+            mock_praw_reddit.call_args[1]['oauth_url'], 'http://127.0.0.1:8001'
+        )
+
+@patch.dict('rcollate.reddit.settings', {'reddit_backend': 'aiohttp'})
+@patch('rcollate.reddit._async_backend', MockAsyncBackend())
+class AsyncBackendTest(unittest.TestCase):
+    def setUp(self):
+        reddit._get_thread_cache().clear()
+
+    def test_subreddit_exists(self):
+        self.assertTrue(reddit.subreddit_exists(VALID_SUBREDDIT))
+        self.assertFalse(reddit.subreddit_exists(INVALID_SUBREDDIT))
+
+    @patch('rcollate.reddit._fetch_top_subreddit_threads')
+    def test_prefetch_top_subreddit_threads(self, mock_fetch):
+        reddit.prefetch_top_subreddit_threads([
+            ('test1', 'day', 5),
+            ('test2', 'day', 10),
+        ])
+
+        self.assertEqual(len(reddit.top_subreddit_threads('test1', 'day', 5)), 5)
+        self.assertEqual(len(reddit.top_subreddit_threads('test2', 'day', 10)), 10)
+        self.assertEqual(mock_fetch.call_count, 0)
+
+    def test_prefetch_counted_once(self):
+        thread_cache = reddit._get_thread_cache()
+        hits, misses = thread_cache.hits, thread_cache.misses
+
+        reddit.prefetch_top_subreddit_threads([('test1', 'day', 5)])
+        reddit.top_subreddit_threads('test1', 'day', 5)
+
+        self.assertEqual(thread_cache.hits - hits, 1)
+        self.assertEqual(thread_cache.misses - misses, 0)
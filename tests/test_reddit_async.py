@@ -0,0 +1,159 @@
+import asyncio
+import threading
+import unittest
+
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+from rcollate.reddit_async import AsyncRedditBackend
+
+VALID_SUBREDDITS = ['test1', 'test2']
+
+def thread_data(i):
+    return {
+        'data': {
+            'permalink': '/r/test1/{}'.format(i),
+            'selftext': '',
+            'title': 'Thread {}'.format(i),
+            'ups': i,
+            'url': '',
+        }
+    }
+
+class FakeRedditServer(object):
+    def __init__(self):
+        self.token_requests = 0
+        self.tokens = []
+
+        app = web.Application()
+        app.router.add_post('/api/v1/access_token', self.access_token)
+        app.router.add_get('/r/{subreddit}/top', self.top)
+        app.router.add_post('/api/search_reddit_names', self.search_reddit_names)
+        app.router.add_get('/api/info', self.info)
+
+        self.loop = asyncio.new_event_loop()
+        self.runner = web.AppRunner(app)
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        self.loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.port)
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def authorized(self, request):
+        return request.headers.get('Authorization') == 'bearer {}'.format(self.tokens[-1])
+
+    async def access_token(self, request):
+        self.token_requests += 1
+        self.tokens.append('token{}'.format(self.token_requests))
+        return web.json_response({
+            'access_token': self.tokens[-1],
+            'expires_in': 3600,
+        })
+
+    async def top(self, request):
+        if not self.authorized(request):
+            return web.Response(status=401)
+
+        limit = int(request.query['limit'])
+        start = int(request.query.get('after') or 0)
+        end = min(start + limit, 150)
+
+        return web.json_response({
+            'data': {
+                'children': [thread_data(i) for i in range(start, end)],
+                'after': str(end) if end < 150 else None,
+            }
+        })
+
+    async def info(self, request):
+        return web.json_response({
+            'data': {
+                'children': [
+                    {'data': {'display_name': name}}
+                    for name in request.query['sr_name'].split(',')
+                    if name in VALID_SUBREDDITS
+                ],
+            }
+        })
+
+    async def search_reddit_names(self, request):
+        data = await request.post()
+        query = data['query']
+
+        if data['exact'] == 'true':
+            if query not in VALID_SUBREDDITS:
+                return web.Response(status=404)
+            return web.json_response({'names': [query]})
+
+        return web.json_response({
+            'names': [name for name in VALID_SUBREDDITS if name.startswith(query)]
+        })
+
+@unittest.skipIf(web is None, "aiohttp is not installed")
+class AsyncRedditBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeRedditServer()
+        self.backend = AsyncRedditBackend(
+            client_id='id',
+            client_secret='secret',
+            user_agent='test',
+            oauth_url=self.server.url,
+            token_url=self.server.url + '/api/v1/access_token',
+        )
+
+    def tearDown(self):
+        self.backend.close()
+        self.server.stop()
+
+    def test_top_subreddit_threads(self):
+        r_threads = self.backend.top_subreddit_threads('test1', 'day', 10)
+        self.assertEqual(len(r_threads), 10)
+        self.assertEqual(r_threads[0]['title'], 'Thread 0')
+
+    def test_top_subreddit_threads_paginated(self):
+        r_threads = self.backend.top_subreddit_threads('test1', 'day', 1000)
+        self.assertEqual(len(r_threads), 150)
+
+    def test_top_subreddit_threads_many(self):
+        results = self.backend.top_subreddit_threads_many([
+            ('test{}'.format(i), 'day', 5) for i in range(50)
+        ])
+        self.assertEqual([len(result) for result in results], [5] * 50)
+        self.assertEqual(self.server.token_requests, 1)
+
+    def test_token_refreshed_when_rejected(self):
+        self.backend.top_subreddit_threads('test1', 'day', 1)
+        self.server.tokens.append('rotated')
+
+        self.backend.top_subreddit_threads('test1', 'day', 1)
+        self.assertEqual(self.server.token_requests, 2)
+
+    def test_subreddit_exists(self):
+        self.assertTrue(self.backend.subreddit_exists('test1'))
+        self.assertFalse(self.backend.subreddit_exists('test3'))
+
+    def test_existing_subreddits(self):
+        self.assertEqual(
+            self.backend.existing_subreddits(['test1', 'test3', 'test2']),
+            ['test1', 'test2'],
+        )
+
+    def test_subreddit_search(self):
+        self.assertEqual(
+            self.backend.subreddit_search('test'),
+            [{'display_name': 'test1'}, {'display_name': 'test2'}],
+        )
@@ -1,7 +1,10 @@
+from datetime import datetime, timezone
 import unittest
 from unittest.mock import patch
 
-from rcollate import scheduler
+from rcollate import reddit, scheduler
+from rcollate.models import Job, threads_content_hash
+from rcollate.reddit import SubredditThread
 
 def mock_get_job_by_job_key(job_key):
     return {'job_key': job_key}
@@ -25,9 +28,553 @@ class StartSchedulerTest(unittest.TestCase):
 
         self.assertEqual(mock_scheduler_start.call_count, 1)
 
+    @patch.dict('rcollate.config.settings', {'scheduler_mode': 'dispatcher'})
+    @patch('rcollate.scheduler.BackgroundScheduler.add_job')
+    @patch('rcollate.scheduler.BackgroundScheduler.start')
+    def test_start_dispatcher(self, mock_scheduler_start, mock_add_job):
+        try:
+            scheduler.start(
+                ['job1', 'job2'],
+                mock_get_job_by_job_key,
+                mock_get_job_url_by_job_key,
+            )
+
+            self.assertTrue(scheduler.dispatcher)
+            self.assertEqual(scheduler.job_schedules, {})
+
+            dispatch_calls = [
+                call for call in mock_add_job.call_args_list
+                if call[0][0] == scheduler._dispatch_tick
+            ]
+            self.assertEqual(len(dispatch_calls), 1)
+            self.assertTrue(dispatch_calls[0][1]['coalesce'])
+            self.assertEqual(
+                dispatch_calls[0][1]['misfire_grace_time'],
+                scheduler.DISPATCH_MISFIRE_GRACE_TIME,
+            )
+
+            # Bookkeeping for individual jobs is skipped
+            scheduler.schedule_job(Job('hello', 'a@test.com', {'hour': 7}))
+            self.assertEqual(scheduler.job_schedules, {})
+        finally:
+            scheduler.dispatcher = False
+
+    @patch('rcollate.scheduler.BackgroundScheduler')
+    def test_start_without_scheduling(self, mock_background_scheduler):
+        scheduler.start(
+            [Job('hello', 'a@test.com', {'hour': 7}, job_key='job1')],
+            mock_get_job_by_job_key,
+            mock_get_job_url_by_job_key,
+            schedule=False,
+        )
+
+        self.assertEqual(mock_background_scheduler.call_count, 0)
+        self.assertIsNone(scheduler.scheduler)
+
+        scheduler.schedule_job(Job('hello', 'a@test.com', {'hour': 7}, job_key='job2'))
+        self.assertEqual(scheduler.job_schedules, {})
+
+    @patch('rcollate.scheduler.Mailer')
+    def test_start_refuses_claims_without_dispatcher(self, mock_mailer):
+        for extra_settings in [
+            {'job_claims': True},
+            {'scheduler_partition_count': 2},
+        ]:
+            with patch.dict('rcollate.config.settings', extra_settings):
+                with self.assertRaises(ValueError):
+                    scheduler.start(
+                        [],
+                        mock_get_job_by_job_key,
+                        mock_get_job_url_by_job_key,
+                        schedule=False,
+                    )
+
+        self.assertEqual(mock_mailer.call_count, 0)
+
+    @patch.dict('rcollate.config.settings', {
+        'scheduler_mode': 'dispatcher',
+        'scheduler_partition_count': 2,
+        'scheduler_partition': 2,
+    })
+    @patch('rcollate.scheduler.Mailer')
+    def test_start_refuses_partition_out_of_range(self, mock_mailer):
+        with self.assertRaises(ValueError):
+            scheduler.start(
+                [],
+                mock_get_job_by_job_key,
+                mock_get_job_url_by_job_key,
+                schedule=False,
+            )
+
+        self.assertEqual(mock_mailer.call_count, 0)
+
+class StopTest(unittest.TestCase):
+    @patch('rcollate.scheduler.mailer', None)
+    @patch('rcollate.scheduler.scheduler', None)
+    @patch('rcollate.scheduler.outbox_delivery', None)
+    @patch('rcollate.scheduler.dispatch_executor')
+    @patch('rcollate.scheduler.pipeline')
+    @patch('rcollate.reddit._async_backend')
+    def test_stop(self, mock_async_backend, mock_pipeline, mock_dispatch_executor):
+        scheduler.stop()
+
+        mock_dispatch_executor.shutdown.assert_called_once_with()
+        mock_pipeline.join.assert_called_once_with()
+        mock_async_backend.close.assert_called_once_with()
+        self.assertIsNone(reddit._async_backend)
+
 class HelpersTest(unittest.TestCase):
     @patch('rcollate.scheduler.run_job')
     @patch('rcollate.scheduler.get_job_by_job_key', mock_get_job_by_job_key)
     def test_run_job_by_job_key(self, mock_run_job):
         scheduler._run_job_by_job_key('test')
-        mock_run_job.assert_called_once_with({'job_key': 'test'})
+        self.assertEqual(mock_run_job.call_args[0], ({'job_key': 'test'},))
+
+    @patch('rcollate.scheduler.run_jobs')
+    @patch('rcollate.scheduler.get_jobs_by_job_keys')
+    @patch('rcollate.scheduler.pending_job_keys', {})
+    def test_run_pending_jobs(self, mock_get_jobs_by_job_keys, mock_run_jobs):
+        scheduler._queue_job_by_job_key('job1')
+        scheduler._queue_job_by_job_key('job2')
+        scheduler._run_pending_jobs()
+
+        self.assertEqual(
+            sorted(mock_get_jobs_by_job_keys.call_args[0][0]),
+            ['job1', 'job2'],
+        )
+        self.assertEqual(mock_run_jobs.call_count, 1)
+
+        scheduler._run_pending_jobs()
+        self.assertEqual(mock_run_jobs.call_count, 1)
+
+    @patch('rcollate.scheduler.run_jobs')
+    @patch('rcollate.scheduler.get_due_jobs')
+    def test_dispatch_due_jobs(self, mock_get_due_jobs, mock_run_jobs):
+        job = Job('hello', 'a@test.com', {'hour': 7}, job_key='job1')
+        mock_get_due_jobs.return_value = [job]
+
+        scheduler._dispatch_due_jobs(datetime(2017, 5, 1, 7, 15))
+
+        mock_get_due_jobs.assert_called_once_with(7, 15, 'mon')
+        mock_run_jobs.assert_called_once_with(
+            [job], fire_time=int(datetime(2017, 5, 1, 7, 15).timestamp()),
+        )
+
+    @patch('rcollate.scheduler.run_jobs')
+    @patch('rcollate.scheduler.get_due_jobs')
+    def test_dispatch_no_due_jobs(self, mock_get_due_jobs, mock_run_jobs):
+        mock_get_due_jobs.return_value = []
+
+        scheduler._dispatch_due_jobs(datetime(2017, 5, 1, 7, 15))
+
+        self.assertEqual(mock_run_jobs.call_count, 0)
+
+def submit_inline(fn, *args):
+    fn(*args)
+
+@patch('rcollate.scheduler.dispatch_executor.submit', submit_inline)
+@patch('rcollate.scheduler.last_dispatched_fire_time', None)
+@patch('rcollate.scheduler._dispatch_due_jobs')
+class DispatchTickTest(unittest.TestCase):
+    def dispatched_minutes(self, mock_dispatch_due_jobs):
+        minutes = [
+            (call[0][0].hour, call[0][0].minute)
+            for call in mock_dispatch_due_jobs.call_args_list
+        ]
+        mock_dispatch_due_jobs.reset_mock()
+        return minutes
+
+    def tick(self, hour, minute, second=0):
+        scheduler._dispatch_tick(
+            datetime(2017, 5, 1, hour, minute, second, tzinfo=timezone.utc)
+        )
+
+    def test_dispatch_tick(self, mock_dispatch_due_jobs):
+        self.tick(7, 15)
+        self.assertEqual(self.dispatched_minutes(mock_dispatch_due_jobs), [(7, 15)])
+
+        # A late tick still dispatches its own minute, and only once
+        self.tick(7, 16, 59)
+        self.tick(7, 16, 59)
+        self.assertEqual(self.dispatched_minutes(mock_dispatch_due_jobs), [(7, 16)])
+
+    def test_missed_minutes_caught_up(self, mock_dispatch_due_jobs):
+        self.tick(7, 15)
+        self.dispatched_minutes(mock_dispatch_due_jobs)
+
+        self.tick(7, 18, 2)
+
+        self.assertEqual(
+            self.dispatched_minutes(mock_dispatch_due_jobs),
+            [(7, 16), (7, 17), (7, 18)],
+        )
+
+    @patch('rcollate.scheduler.DISPATCH_CATCH_UP_MINUTES', 2)
+    def test_catch_up_limited(self, mock_dispatch_due_jobs):
+        self.tick(7, 15)
+        self.dispatched_minutes(mock_dispatch_due_jobs)
+
+        self.tick(7, 20)
+
+        self.assertEqual(
+            self.dispatched_minutes(mock_dispatch_due_jobs), [(7, 19), (7, 20)],
+        )
+
+class JobClaimsTest(unittest.TestCase):
+    @patch('rcollate.scheduler.run_job')
+    @patch('rcollate.scheduler.get_job_by_job_key', mock_get_job_by_job_key)
+    @patch('rcollate.scheduler.claim_job_keys')
+    @patch('rcollate.scheduler.job_claims', True)
+    def test_run_job_by_job_key_claimed(self, mock_claim_job_keys, mock_run_job):
+        mock_claim_job_keys.return_value = ['test']
+        scheduler._run_job_by_job_key('test')
+        self.assertEqual(mock_run_job.call_args[0], ({'job_key': 'test'},))
+
+        job_keys, fire_time = mock_claim_job_keys.call_args[0]
+        self.assertEqual(job_keys, ['test'])
+        self.assertEqual(fire_time % 60, 0)
+
+    @patch('rcollate.scheduler.run_job')
+    @patch('rcollate.scheduler.claim_job_keys')
+    @patch('rcollate.scheduler.job_claims', True)
+    def test_run_job_by_job_key_already_claimed(self, mock_claim_job_keys, mock_run_job):
+        mock_claim_job_keys.return_value = []
+        scheduler._run_job_by_job_key('test')
+        self.assertEqual(mock_run_job.call_count, 0)
+
+    @patch('rcollate.scheduler.partition_count', 2)
+    def test_owns_job_key(self):
+        job_keys = ['job{}'.format(i) for i in range(100)]
+
+        with patch('rcollate.scheduler.partition', 0):
+            partition0 = set(filter(scheduler.owns_job_key, job_keys))
+        with patch('rcollate.scheduler.partition', 1):
+            partition1 = set(filter(scheduler.owns_job_key, job_keys))
+
+        self.assertEqual(partition0 | partition1, set(job_keys))
+        self.assertEqual(partition0 & partition1, set())
+        self.assertTrue(partition0 and partition1)
+
+    @patch('rcollate.scheduler.run_jobs')
+    @patch('rcollate.scheduler.get_due_jobs')
+    @patch('rcollate.scheduler.claim_job_keys')
+    @patch('rcollate.scheduler.job_claims', True)
+    @patch('rcollate.scheduler.partition_count', 2)
+    def test_dispatch_due_jobs_partitioned(
+        self, mock_claim_job_keys, mock_get_due_jobs, mock_run_jobs,
+    ):
+        jobs = [
+            Job('hello', 'a@test.com', {'hour': 7}, job_key='job{}'.format(i))
+            for i in range(10)
+        ]
+        mock_get_due_jobs.return_value = jobs
+        mock_claim_job_keys.side_effect = lambda job_keys, fire_time: job_keys[1:]
+
+        now = datetime(2017, 5, 1, 7, 15, 3)
+        scheduler._dispatch_due_jobs(now)
+
+        owned = [job for job in jobs if scheduler.owns_job_key(job.job_key)]
+        fire_time = int(datetime(2017, 5, 1, 7, 15).timestamp())
+        mock_claim_job_keys.assert_called_once_with(
+            [job.job_key for job in owned], fire_time,
+        )
+        mock_run_jobs.assert_called_once_with(owned[1:], fire_time=fire_time)
+
+class LagTest(unittest.TestCase):
+    def test_scheduled_time(self):
+        now = datetime(2017, 7, 12, 7, 30, 20, tzinfo=timezone.utc)
+
+        self.assertEqual(
+            scheduler._scheduled_time(Job('a', 'a@test.com', {'hour': 7, 'minute': 30}), now),
+            datetime(2017, 7, 12, 7, 30, tzinfo=timezone.utc),
+        )
+        self.assertEqual(
+            scheduler._scheduled_time(Job('a', 'a@test.com', {'hour': 23}), now),
+            datetime(2017, 7, 11, 23, 0, tzinfo=timezone.utc),
+        )
+
+    @patch('rcollate.scheduler.manual_runs', new_callable=set)
+    @patch('rcollate.scheduler.lag_seconds')
+    def test_manual_runs_ignored(self, mock_lag_seconds, mock_manual_runs):
+        mock_manual_runs.add('b')
+
+        scheduler._observe_lag([
+            Job('a', 'a@test.com', {'hour': 7}, job_key='a'),
+            Job('b', 'a@test.com', {'hour': 7}, job_key='b'),
+        ])
+
+        self.assertEqual(mock_lag_seconds.observe.call_count, 1)
+
+@patch('rcollate.scheduler.get_job_url_by_job_key', mock_get_job_url_by_job_key)
+class JobRunHistoryTest(unittest.TestCase):
+    @patch('rcollate.scheduler.record_job_runs')
+    @patch('rcollate.scheduler.mailer')
+    @patch('rcollate.reddit.top_subreddit_threads')
+    def test_history_recorded(
+        self, mock_top_subreddit_threads, mock_mailer, mock_record_job_runs,
+    ):
+        mock_top_subreddit_threads.return_value = [
+            SubredditThread('', '', 'Thread', 1, '')
+        ] * 10
+        mock_mailer.render_threads.return_value.html_body = 'body'
+        mock_mailer.send_message.return_value = True
+
+        scheduler.run_jobs([
+            Job('hello', 'a@test.com', {'hour': 7}, thread_limit=3, job_key='a'),
+        ], fire_time=60)
+
+        (row,), = mock_record_job_runs.call_args[0]
+        self.assertEqual(row['job_key'], 'a')
+        self.assertEqual(row['fire_time'], 60)
+        self.assertEqual(row['thread_count'], 3)
+        self.assertEqual(row['message_size'], 4)
+        self.assertEqual(row['outcome'], scheduler.OUTCOME_SENT)
+        for stage in ['lag', 'fetch', 'render', 'send']:
+            self.assertGreaterEqual(row['{}_seconds'.format(stage)], 0)
+
+    @patch('rcollate.scheduler.record_job_runs')
+    @patch('rcollate.reddit.top_subreddit_threads')
+    def test_failed_fetch_recorded(self, mock_top_subreddit_threads, mock_record_job_runs):
+        mock_top_subreddit_threads.side_effect = Exception('fetch failed')
+
+        scheduler.run_jobs([
+            Job('hello', 'a@test.com', {'hour': 7}, job_key='a'),
+        ], fire_time=60)
+
+        (row,), = mock_record_job_runs.call_args[0]
+        self.assertEqual(row['outcome'], scheduler.OUTCOME_FAILED)
+        self.assertEqual(row['error'], 'fetch failed')
+        self.assertIsNone(row['render_seconds'])
+
+@patch('rcollate.scheduler.manual_runs', new_callable=set)
+@patch('rcollate.scheduler.get_job_url_by_job_key', mock_get_job_url_by_job_key)
+@patch('rcollate.scheduler.record_job_runs')
+@patch('rcollate.scheduler.update_job_digests')
+@patch('rcollate.scheduler.mailer')
+@patch('rcollate.reddit.top_subreddit_threads')
+class DigestModeTest(unittest.TestCase):
+    r_threads = [
+        SubredditThread('/a', '', 'A', 1, ''),
+        SubredditThread('/b', '', 'B', 1, ''),
+    ]
+
+    def test_skip_unchanged(
+        self, mock_top_subreddit_threads, mock_mailer, mock_update_job_digests,
+        mock_record_job_runs, mock_manual_runs,
+    ):
+        mock_top_subreddit_threads.return_value = self.r_threads
+        job = Job(
+            'hello', 'a@test.com', {'hour': 7}, job_key='a',
+            digest_mode='skip_unchanged',
+        )
+        job.last_content_hash = threads_content_hash(self.r_threads)
+
+        scheduler.run_jobs([job])
+
+        self.assertEqual(mock_mailer.render_threads.call_count, 0)
+        self.assertEqual(mock_update_job_digests.call_count, 0)
+        (row,), = mock_record_job_runs.call_args[0]
+        self.assertEqual(row['outcome'], scheduler.OUTCOME_SKIPPED)
+
+    def test_new_only(
+        self, mock_top_subreddit_threads, mock_mailer, mock_update_job_digests,
+        mock_record_job_runs, mock_manual_runs,
+    ):
+        mock_top_subreddit_threads.return_value = self.r_threads
+        mock_mailer.send_message.return_value = True
+        job = Job(
+            'hello', 'a@test.com', {'hour': 7}, job_key='a',
+            digest_mode='new_only',
+        )
+        job.last_thread_ids = ['/a']
+
+        scheduler.run_jobs([job])
+
+        self.assertEqual(
+            mock_mailer.render_threads.call_args[1]['r_threads'], self.r_threads[1:]
+        )
+        mock_update_job_digests.assert_called_once_with([
+            ('a', ['/a', '/b'], threads_content_hash(self.r_threads)),
+        ])
+
+    def test_manual_run_sends_everything(
+        self, mock_top_subreddit_threads, mock_mailer, mock_update_job_digests,
+        mock_record_job_runs, mock_manual_runs,
+    ):
+        mock_top_subreddit_threads.return_value = self.r_threads
+        mock_mailer.send_message.return_value = True
+        job = Job(
+            'hello', 'a@test.com', {'hour': 7}, job_key='a',
+            digest_mode='new_only',
+        )
+        job.last_thread_ids = ['/a', '/b']
+        mock_manual_runs.add('a')
+
+        scheduler.run_jobs([job])
+
+        self.assertEqual(
+            mock_mailer.render_threads.call_args[1]['r_threads'], self.r_threads
+        )
+        self.assertEqual(mock_update_job_digests.call_count, 0)
+
+def run_inline(fn, *args):
+    fn(*args)
+
+@patch('rcollate.scheduler.manual_runs', new_callable=set)
+@patch('rcollate.scheduler.get_job_url_by_job_key', mock_get_job_url_by_job_key)
+class RunJobNowTest(unittest.TestCase):
+    @patch('rcollate.scheduler.job_progress')
+    @patch('rcollate.scheduler.manual_run_executor')
+    def test_run_job_now_collapsed(
+        self, mock_manual_run_executor, mock_job_progress, mock_manual_runs,
+    ):
+        job = Job('hello', 'a@test.com', {'hour': 7}, job_key='a')
+
+        self.assertTrue(scheduler.run_job_now(job))
+        self.assertFalse(scheduler.run_job_now(job))
+
+        self.assertEqual(mock_manual_run_executor.submit.call_count, 1)
+        mock_job_progress.assert_called_once_with('a', 'queued')
+
+    @patch('rcollate.scheduler.job_progress')
+    @patch('rcollate.scheduler.manual_run_executor.submit', run_inline)
+    @patch('rcollate.scheduler.mailer')
+    @patch('rcollate.reddit.top_subreddit_threads')
+    def test_run_job_now_progress(
+        self, mock_top_subreddit_threads, mock_mailer, mock_job_progress,
+        mock_manual_runs,
+    ):
+        mock_top_subreddit_threads.return_value = []
+        mock_mailer.send_message.return_value = True
+        job = Job('hello', 'a@test.com', {'hour': 7}, job_key='a')
+
+        self.assertTrue(scheduler.run_job_now(job))
+
+        self.assertEqual(
+            [call[0] for call in mock_job_progress.call_args_list],
+            [('a', 'queued'), ('a', 'fetched'), ('a', 'rendered'), ('a', 'sent')],
+        )
+        self.assertEqual(scheduler.manual_runs, set())
+
+    @patch('rcollate.scheduler.job_progress')
+    @patch('rcollate.scheduler.manual_run_executor.submit', run_inline)
+    @patch('rcollate.reddit.top_subreddit_threads')
+    def test_run_job_now_failed(
+        self, mock_top_subreddit_threads, mock_job_progress, mock_manual_runs,
+    ):
+        mock_top_subreddit_threads.side_effect = Exception('fetch failed')
+        job = Job('hello', 'a@test.com', {'hour': 7}, job_key='a')
+
+        self.assertTrue(scheduler.run_job_now(job))
+
+        mock_job_progress.assert_called_with('a', 'failed')
+        self.assertEqual(scheduler.manual_runs, set())
+
+class OutboxTest(unittest.TestCase):
+    @patch('rcollate.scheduler.outbox.enqueue')
+    @patch('rcollate.scheduler.outbox_delivery')
+    @patch('rcollate.scheduler.mailer')
+    def test_send_job_run_enqueued(self, mock_mailer, mock_outbox_delivery, mock_enqueue):
+        job_run = scheduler.JobRun([
+            (Job('hello', 'a@test.com', {'hour': 7}, job_key='b'), []),
+            (Job('world', 'a@test.com', {'hour': 7}, job_key='a'), []),
+        ], fire_time=60)
+        job_run.message = 'message'
+
+        scheduler._send_job_run(job_run)
+
+        mock_enqueue.assert_called_once_with(
+            'a+b@60',
+            target_email='a@test.com',
+            subreddit='hello+world',
+            message='message',
+        )
+        self.assertEqual(mock_mailer.send_message.call_count, 0)
+        self.assertEqual(mock_outbox_delivery.wake.call_count, 1)
+
+    def test_manual_run_idempotency_key(self):
+        job_run = scheduler.JobRun([
+            (Job('hello', 'a@test.com', {'hour': 7}, job_key='a'), []),
+        ], fire_time=60)
+        self.assertEqual(job_run.idempotency_key, 'a@60')
+
+        job_run.manual_run_id = 'run1'
+        self.assertEqual(job_run.idempotency_key, 'manual:a@run1')
+
+    @patch('rcollate.scheduler.manual_runs', new_callable=set)
+    @patch('rcollate.scheduler.record_job_runs', None)
+    @patch('rcollate.scheduler.get_job_url_by_job_key', mock_get_job_url_by_job_key)
+    @patch('rcollate.scheduler.job_progress')
+    @patch('rcollate.scheduler.manual_run_executor.submit', run_inline)
+    @patch('rcollate.scheduler.outbox.enqueue')
+    @patch('rcollate.scheduler.outbox_delivery')
+    @patch('rcollate.scheduler.mailer')
+    @patch('rcollate.reddit.top_subreddit_threads')
+    def test_manual_runs_not_deduplicated(
+        self, mock_top_subreddit_threads, mock_mailer, mock_outbox_delivery,
+        mock_enqueue, mock_job_progress, mock_manual_runs,
+    ):
+        mock_top_subreddit_threads.return_value = []
+        mock_enqueue.return_value = True
+        job = Job('hello', 'a@test.com', {'hour': 7}, job_key='a')
+
+        scheduler.run_job(job)
+        scheduler.run_job_now(job)
+        scheduler.run_job_now(job)
+
+        idempotency_keys = [call[0][0] for call in mock_enqueue.call_args_list]
+        self.assertEqual(len(set(idempotency_keys)), 3)
+        self.assertTrue(idempotency_keys[1].startswith('manual:a@'))
+        mock_job_progress.assert_called_with('a', 'queued_for_delivery')
+
+        mock_enqueue.return_value = False
+        scheduler.run_job_now(job)
+        mock_job_progress.assert_called_with('a', 'already_sent')
+
+@patch('rcollate.scheduler.record_job_runs', None)
+class RunJobsTest(unittest.TestCase):
+    @patch('rcollate.scheduler.get_job_url_by_job_key', mock_get_job_url_by_job_key)
+    @patch('rcollate.scheduler.mailer')
+    @patch('rcollate.reddit.top_subreddit_threads')
+    def test_run_jobs_grouped_by_subreddit(self, mock_top_subreddit_threads, mock_mailer):
+        mock_top_subreddit_threads.return_value = [
+            SubredditThread('', '', 'Thread', 1, '')
+        ] * 10
+
+        scheduler.run_jobs([
+            Job('hello', 'a@test.com', {'hour': 7}, thread_limit=3, job_key='a'),
+            Job('Hello', 'b@test.com', {'hour': 7}, thread_limit=10, job_key='b'),
+            Job('world', 'c@test.com', {'hour': 7}, thread_limit=5, job_key='c'),
+        ])
+
+        self.assertEqual(mock_top_subreddit_threads.call_count, 2)
+        mock_top_subreddit_threads.assert_any_call('hello', 'day', 10)
+        mock_top_subreddit_threads.assert_any_call('world', 'day', 5)
+
+        rendered_thread_counts = {
+            call[1]['job_view_url']: len(call[1]['r_threads'])
+            for call in mock_mailer.render_threads.call_args_list
+        }
+        self.assertEqual(rendered_thread_counts, {'a': 3, 'b': 10, 'c': 5})
+        self.assertEqual(mock_mailer.send_message.call_count, 3)
+
+    @patch('rcollate.scheduler.consolidate_digests', True)
+    @patch('rcollate.scheduler.get_job_url_by_job_key', mock_get_job_url_by_job_key)
+    @patch('rcollate.scheduler.mailer')
+    @patch('rcollate.reddit.top_subreddit_threads')
+    def test_run_jobs_consolidated(self, mock_top_subreddit_threads, mock_mailer):
+        mock_top_subreddit_threads.return_value = []
+
+        scheduler.run_jobs([
+            Job('hello', 'a@test.com', {'hour': 7}, job_key='a1'),
+            Job('world', 'A@test.com', {'hour': 7}, job_key='a2'),
+            Job('hello', 'b@test.com', {'hour': 7}, job_key='b'),
+        ])
+
+        self.assertEqual(mock_mailer.render_digest.call_count, 1)
+        self.assertEqual(
+            [section['job_view_url'] for section in mock_mailer.render_digest.call_args[0][0]],
+            ['a1', 'a2'],
+        )
+        self.assertEqual(mock_mailer.render_threads.call_count, 1)
+        self.assertEqual(mock_mailer.send_message.call_count, 2)
@@ -0,0 +1,131 @@
+import smtplib
+import unittest
+from unittest.mock import patch
+
+from rcollate.smtp_pool import SMTPConnectionPool
+
+class MockSMTP(object):
+    instances = []
+
+    def __init__(self, host, port, timeout):
+        self.sent = []
+        self.noop_status = 250
+        self.disconnected = False
+        self.socket_error = False
+        self.reject = None
+        self.logged_in = False
+        MockSMTP.instances.append(self)
+
+    def ehlo(self):
+        pass
+
+    def starttls(self):
+        pass
+
+    def login(self, username, password):
+        self.logged_in = True
+
+    def noop(self):
+        return self.noop_status, b'OK'
+
+    def sendmail(self, from_addr, to_addrs, msg, mail_options, rcpt_options):
+        if self.disconnected:
+            raise smtplib.SMTPServerDisconnected()
+        if self.socket_error:
+            raise ConnectionResetError()
+        if self.reject is not None:
+            raise self.reject
+        self.sent.append(msg)
+        return {}
+
+    def quit(self):
+        pass
+
+    def close(self):
+        pass
+
+@patch('rcollate.smtp_pool.smtplib.SMTP', MockSMTP)
+class SMTPConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        MockSMTP.instances = []
+        self.pool = SMTPConnectionPool(
+            'localhost',
+            username='user',
+            password='password',
+            max_messages_per_connection=3,
+        )
+
+    def send(self):
+        return self.pool.sendmail('a@test.com', ['b@test.com'], 'msg')
+
+    def test_reuses_connection(self):
+        for _ in range(3):
+            self.assertEqual(self.send().status_code, 250)
+
+        self.assertEqual(len(MockSMTP.instances), 1)
+        self.assertEqual(len(MockSMTP.instances[0].sent), 3)
+        self.assertTrue(MockSMTP.instances[0].logged_in)
+
+    def test_max_messages_per_connection(self):
+        for _ in range(4):
+            self.send()
+
+        self.assertEqual(len(MockSMTP.instances), 2)
+
+    def test_reconnect_on_disconnect(self):
+        self.send()
+        MockSMTP.instances[0].disconnected = True
+
+        self.assertEqual(self.send().status_code, 250)
+        self.assertEqual(len(MockSMTP.instances), 2)
+        self.assertEqual(self.pool.reconnects, 1)
+
+    def test_reconnect_on_socket_error(self):
+        self.send()
+        MockSMTP.instances[0].socket_error = True
+
+        self.assertEqual(self.send().status_code, 250)
+        self.assertEqual(len(MockSMTP.instances), 2)
+
+    def test_permanent_rejection(self):
+        self.send()
+        MockSMTP.instances[0].reject = smtplib.SMTPDataError(554, b'Rejected')
+
+        response = self.send()
+
+        self.assertEqual(response.status_code, 554)
+        self.assertEqual(response.error, b'Rejected')
+        self.assertEqual(len(MockSMTP.instances), 1)
+        self.assertEqual(len(MockSMTP.instances[0].sent), 1)
+        self.assertEqual(self.pool.reconnects, 0)
+
+        MockSMTP.instances[0].reject = None
+        self.assertEqual(self.send().status_code, 250)
+        self.assertEqual(len(MockSMTP.instances), 1)
+
+    def test_recipients_refused(self):
+        self.send()
+        MockSMTP.instances[0].reject = smtplib.SMTPRecipientsRefused({
+            'b@test.com': (550, b'No such user'),
+        })
+
+        self.assertEqual(self.send().status_code, 550)
+        self.assertEqual(len(MockSMTP.instances), 1)
+        self.assertEqual(self.pool.reconnects, 0)
+
+    def test_keepalive_drops_dead_connections(self):
+        self.send()
+        MockSMTP.instances[0].noop_status = 421
+
+        self.pool.keepalive()
+        self.send()
+
+        self.assertEqual(len(MockSMTP.instances), 2)
+
+    def test_stale_connection_checked_before_reuse(self):
+        self.pool.keepalive_interval = 0
+        self.send()
+        MockSMTP.instances[0].noop_status = 421
+
+        self.assertEqual(self.send().status_code, 250)
+        self.assertEqual(len(MockSMTP.instances), 2)
@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+from rcollate.subreddit_index import SubredditIndex
+
+class SubredditIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'index.json')
+        self.index = SubredditIndex(self.path, match_limit=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_matches_ranked_by_popularity(self):
+        self.index.add('Python')
+        self.index.add('pythonhelp', 5)
+        self.index.add('pytest')
+        self.index.add('rust')
+
+        self.assertEqual(self.index.matches('PY'), ['pythonhelp', 'pytest', 'Python'])
+        self.assertEqual(self.index.matches('pyth'), ['pythonhelp', 'Python'])
+        self.assertEqual(self.index.matches('go'), [])
+
+    def test_job_subreddits_ranked_first(self):
+        self.index.add('news', 1)
+        self.index.add('newsbot', 1)
+        self.index.add_job_subreddit('newsbot')
+
+        self.assertEqual(self.index.matches('new'), ['newsbot', 'news'])
+
+    def test_search_miss_then_hit(self):
+        search_fn = MagicMock(return_value=['python', 'pythonhelp'])
+
+        self.assertEqual(self.index.search('pyt', search_fn), ['python', 'pythonhelp'])
+        # Complete results for 'pyt' also answer longer prefixes
+        self.assertEqual(self.index.search('pytho', search_fn), ['python', 'pythonhelp'])
+        self.assertEqual(self.index.search('pytx', search_fn), [])
+
+        self.assertEqual(search_fn.call_count, 1)
+        self.assertEqual(self.index.stats['hits'], 2)
+        self.assertEqual(self.index.stats['misses'], 1)
+
+    def test_incomplete_search_only_covers_its_prefix(self):
+        search_fn = MagicMock(return_value=['a{}'.format(i) for i in range(10)])
+
+        self.index.search('a', search_fn)
+        self.index.search('a', search_fn)
+        self.assertEqual(search_fn.call_count, 1)
+
+        search_fn.return_value = ['ab']
+        self.assertEqual(self.index.search('ab', search_fn), ['ab'])
+        self.assertEqual(search_fn.call_count, 2)
+
+    def test_save_and_load(self):
+        self.index.search('pyt', MagicMock(return_value=['python']))
+        self.index.add_job_subreddit('pytest')
+        self.index.save()
+
+        loaded_index = SubredditIndex(self.path, match_limit=3)
+        loaded_index.load()
+
+        search_fn = MagicMock()
+        self.assertEqual(loaded_index.search('pyth', search_fn), ['python'])
+        self.assertEqual(search_fn.call_count, 0)
@@ -0,0 +1,53 @@
+import threading
+import unittest
+from unittest.mock import patch
+
+from rcollate import scheduler, worker
+
+WORKER_SETTINGS = {
+    'embedded_scheduler': False,
+    'scheduler_mode': 'dispatcher',
+}
+
+class WorkerTest(unittest.TestCase):
+    @patch.dict('rcollate.config.settings', WORKER_SETTINGS)
+    @patch('rcollate.scheduler.stop')
+    @patch('rcollate.rcollate.create_app')
+    def test_run(self, mock_create_app, mock_stop):
+        stopping = threading.Event()
+        stopping.set()
+
+        self.assertTrue(worker.run(stopping))
+
+        mock_create_app.assert_called_once_with(schedule=True)
+        self.assertEqual(mock_stop.call_count, 1)
+
+    @patch('rcollate.rcollate.create_app')
+    def test_run_refused(self, mock_create_app):
+        stopping = threading.Event()
+        stopping.set()
+
+        for changes in [
+            {'embedded_scheduler': True},
+            {'scheduler_mode': 'per_job'},
+        ]:
+            worker_settings = dict(WORKER_SETTINGS, **changes)
+            with patch.dict('rcollate.config.settings', worker_settings):
+                self.assertIsNotNone(worker.check_settings())
+                self.assertFalse(worker.run(stopping))
+
+        # embedded_scheduler defaults to true, so it has to be turned off
+        with patch.dict('rcollate.config.settings', {'scheduler_mode': 'dispatcher'}):
+            self.assertIsNotNone(worker.check_settings())
+
+        self.assertEqual(mock_create_app.call_count, 0)
+
+class StartSchedulingTest(unittest.TestCase):
+    @patch('rcollate.scheduler.BackgroundScheduler')
+    @patch('rcollate.scheduler.scheduler', None)
+    def test_start_scheduling_once(self, mock_background_scheduler):
+        scheduler.start_scheduling([])
+        scheduler.start_scheduling([])
+
+        self.assertEqual(mock_background_scheduler.call_count, 1)
+        self.assertEqual(mock_background_scheduler.return_value.start.call_count, 1)